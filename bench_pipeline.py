@@ -0,0 +1,518 @@
+import argparse
+import asyncio
+import gzip
+import importlib
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess as sp
+import sys
+import tempfile
+import threading
+import time
+
+import fakeserver
+
+# Consts
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+GAMES = {'minecraft': 'MC', 'terraria': 'TE'} # Game module to settings key
+LOG_CHAN_ID = 1001
+BOT_CHAN_ID = 1002
+BENCH_LINE_RE = re.compile(r'bench (\d+) (\d+\.\d+)')
+DONE_RE = re.compile(re.escape(fakeserver.DONE_MARKER) + r' (\d+)')
+CONNECT_TIMEOUT = 20 # Seconds to wait for the controller to come up and the client to connect
+DRAIN_TIMEOUT = 30 # Seconds to wait for the last log lines to reach Discord after the game is done
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+class FakeChannel:
+    """
+    Stand-in for a Discord text channel. Records everything sent to it and, for log output from
+    fakeserver, when each numbered line arrived. An optional delay per send mimics Discord's
+    per-channel send queue.
+    """
+
+    def __init__(self, send_delay=0):
+        """
+        Initializes a new FakeChannel.
+
+        Args:
+            send_delay: (Optional) Seconds each send takes. Sends are serialized like Discord's.
+                        Defaults to 0
+
+        Returns:
+            A newly initialized FakeChannel object
+        """
+
+        self.send_delay = send_delay
+        self.messages = []
+        self.uploads = 0
+        self.latencies = []
+        self.seen = set()
+        self.done = None # Line count from the game's done marker, once it shows up
+        self.__lock = None
+
+
+    async def send(self, content=None, file=None):
+        """
+        Post a message, optionally with a file (a (filename, data) pair here instead of a
+        discord.File).
+
+        Args:
+            content: (Optional) The message text
+            file:    (Optional) The attachment as a (filename, data) pair
+        """
+
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+
+        async with self.__lock:
+            if self.send_delay:
+                await asyncio.sleep(self.send_delay)
+
+            now = time.time()
+            text = content or ''
+            self.messages.append(text)
+            if file is not None:
+                self.uploads += 1
+                text += '\n' + gzip.decompress(file[1]).decode('utf-8', 'replace')
+
+            for seq, stamp in BENCH_LINE_RE.findall(text):
+                self.seen.add(int(seq))
+                self.latencies.append(now - float(stamp))
+            match = DONE_RE.search(text)
+            if match:
+                self.done = int(match.group(1))
+
+
+class FakeGuild:
+    """
+    Stand-in for a Discord guild, just enough for ControllerClient.bind()
+    """
+
+    def __init__(self, channels):
+        """
+        Initializes a new FakeGuild.
+
+        Args:
+            channels: A dict of channel id to FakeChannel
+
+        Returns:
+            A newly initialized FakeGuild object
+        """
+
+        self.channels = channels
+
+
+    def get_channel(self, chan_id):
+        """
+        Look up a channel.
+
+        Args:
+            chan_id: The channel id
+
+        Returns:
+            The FakeChannel, or None
+        """
+
+        return self.channels.get(chan_id)
+
+
+class FakeClient:
+    """
+    Stand-in for the Discord client: an event loop on its own thread for the sends to run on
+    """
+
+    def __init__(self):
+        """
+        Initializes a new FakeClient and starts its event loop thread.
+
+        Returns:
+            A newly initialized FakeClient object
+        """
+
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever)
+        thread.daemon = True
+        thread.start()
+
+
+    def close(self):
+        """
+        Stop the event loop.
+        """
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class StageMonitor:
+    """
+    Tracks CPU time and peak memory of the processes making up one stage of the pipeline
+    """
+
+    def __init__(self, pid):
+        """
+        Initializes a new StageMonitor and takes the starting CPU time.
+
+        Args:
+            pid: The process id to watch
+
+        Returns:
+            A newly initialized StageMonitor object
+        """
+
+        self.pid = pid
+        self.start_cpu = _cpu_time(pid)
+        self.cpu = 0
+        self.peak_rss = 0
+
+
+    def sample(self):
+        """
+        Update the CPU time and peak memory. Call this every so often while the process is alive.
+        """
+
+        cpu = _cpu_time(self.pid)
+        if cpu is not None and self.start_cpu is not None:
+            self.cpu = cpu - self.start_cpu
+        self.peak_rss = max(self.peak_rss, _rss(self.pid))
+
+
+def _cpu_time(pid):
+    """
+    Get the CPU time (user + system) a process has used.
+
+    Args:
+        pid: The process id
+
+    Returns:
+        The CPU time in seconds, or None if the process is gone
+    """
+
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+def _rss(pid):
+    """
+    Get the resident memory of a process.
+
+    Args:
+        pid: The process id
+
+    Returns:
+        The resident memory in bytes, or 0 if the process is gone
+    """
+
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def free_port():
+    """
+    Find a free local port for the controller.
+
+    Returns:
+        The port number
+    """
+
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(check, timeout, interval=0.05):
+    """
+    Poll until a check passes.
+
+    Args:
+        check:    Callable returning something truthy once we're done waiting
+        timeout:  Max seconds to wait
+        interval: (Optional) Seconds between checks. Defaults to 0.05
+
+    Returns:
+        The last result of the check
+    """
+
+    deadline = time.monotonic() + timeout
+    result = check()
+    while not result and time.monotonic() < deadline:
+        time.sleep(interval)
+        result = check()
+    return result
+
+
+def setup_env(games, work_dir, args):
+    """
+    Build the settings for the benchmark runs and put each game's fake server where its controller
+    expects to find the real one. Settings are read once per process, so this has to cover every
+    game before any of them is imported.
+
+    Args:
+        games:    The game names
+        work_dir: The scratch directory
+        args:     The parsed command line arguments
+
+    Returns:
+        The environment for the controller processes (and this one)
+    """
+
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+
+    env = dict(os.environ)
+    env.update({'PATH': f'{bin_dir}{os.pathsep}{env.get("PATH", "")}',
+                'SECRET': os.urandom(16).hex(),
+                'GUILD_ID': '1',
+                'BOT_CHAN_ID': str(BOT_CHAN_ID),
+                'LOG_BURST_WINDOW': str(args.burst_window),
+                'CMD_RATE': '1000',
+                'CMD_BURST': '1000',
+                'PYTHONUNBUFFERED': '1'})
+
+    for game in games:
+        env.update(setup_game(game, work_dir, bin_dir, args))
+    return env
+
+
+def setup_game(game, work_dir, bin_dir, args):
+    """
+    Set up the directory and fake server for one game.
+
+    Args:
+        game:     The game name
+        work_dir: The scratch directory
+        bin_dir:  The directory put in front of the controllers' PATH
+        args:     The parsed command line arguments
+
+    Returns:
+        The game's settings
+    """
+
+    key = GAMES[game]
+    game_dir = os.path.join(work_dir, game)
+    os.makedirs(game_dir)
+
+    # The controllers run 'java ... -jar server.jar' and 'bash TerrariaServer ...'
+    fake = (f'exec {sys.executable} {os.path.join(REPO_DIR, "fakeserver.py")} {game} '
+            f'--rate {args.rate} --length {args.length} --duration {args.duration} "$@"\n')
+    script = os.path.join(bin_dir, 'java') if game == 'minecraft' else os.path.join(game_dir,
+                                                                                  'TerrariaServer')
+    with open(script, 'w') as f:
+        f.write('#!/bin/sh\n' + fake)
+    os.chmod(script, 0o755)
+
+    return {f'{key}_DIR': game_dir,
+            f'{key}_STATE_DIR': os.path.join(game_dir, '.serverbot'),
+            f'{key}_LOG_CHAN_ID': str(LOG_CHAN_ID),
+            f'{key}C_PORT': str(free_port()),
+            f'{key}_START_TIMEOUT': '30',
+            f'{key}_LOG_FILTER': args.log_filter or ''}
+
+
+def run(game, env, args):
+    """
+    Run one benchmark: start the real controller for a game against fakeserver, connect the real
+    client class to it with a fake Discord, start the game, let it log for a while and poll it with
+    commands, then stop everything and measure.
+
+    Args:
+        game: The game name
+        env:  The environment from setup_env()
+        args: The parsed command line arguments
+
+    Returns:
+        A dict of results
+    """
+
+    key = GAMES[game]
+    port = int(env[f'{key}C_PORT'])
+    module = importlib.import_module(game)
+    from tracing import percentiles # Like the game, only once the environment is set up
+
+    def upload(self, summary, filename, data):
+        self._post(self.logchan.send(summary, file=(filename, data)), 'log')
+
+    client_class = type(f'Bench{module.CLIENT_CLASS.__name__}',
+                        (module.CLIENT_CLASS,),
+                        {'_logchan_upload': upload})
+
+    controller = sp.Popen([sys.executable, f'{game}.py'],
+                          cwd=REPO_DIR,
+                          env=env,
+                          stdout=None if args.verbose else sp.DEVNULL,
+                          stderr=None if args.verbose else sp.DEVNULL)
+    discord = FakeClient()
+    logchan = FakeChannel(args.discord_delay)
+    botchan = FakeChannel()
+    results = {'game': game}
+
+    try:
+        # Wait for the controller to listen. A bare connect is just a failed handshake to it
+        def listening():
+            try:
+                socket.create_connection(('localhost', port), timeout=1).close()
+                return True
+            except OSError:
+                return False
+        if not wait_for(listening, CONNECT_TIMEOUT):
+            raise RuntimeError('Controller did not start listening')
+
+        client = client_class(discord, FakeGuild({LOG_CHAN_ID: logchan, BOT_CHAN_ID: botchan}))
+        if not wait_for(lambda: client.connected, CONNECT_TIMEOUT):
+            raise RuntimeError('Client did not connect to the controller')
+
+        stages = {'controller': StageMonitor(controller.pid), 'bot': StageMonitor(os.getpid())}
+
+        # Start the game. The reply comes once it's logged its startup line
+        start = time.perf_counter()
+        reply = client.request('start').result(60)
+        results['startup'] = time.perf_counter() - start
+        if 'started' not in reply:
+            raise RuntimeError(f'Game did not start: {reply}')
+
+        # Find the game process from the controller's state file
+        with open(os.path.join(env[f'{key}_STATE_DIR'], 'state.json')) as f:
+            stages['game'] = StageMonitor(json.load(f)['pid'])
+
+        # Poll with commands while the log streams, until the done marker reaches Discord
+        commands = {'ping': [], 'players': []}
+        errors = 0
+        stream_start = time.perf_counter()
+        deadline = time.monotonic() + args.duration + DRAIN_TIMEOUT
+        while logchan.done is None and time.monotonic() < deadline:
+            for cmd, latencies in commands.items():
+                sent = time.perf_counter()
+                try:
+                    reply = client.request(cmd).result(10)
+                    if reply.startswith('ERR'):
+                        errors += 1
+                    else:
+                        latencies.append(time.perf_counter() - sent)
+                except Exception:
+                    errors += 1
+            for stage in stages.values():
+                stage.sample()
+            time.sleep(args.cmd_interval)
+        elapsed = time.perf_counter() - stream_start
+
+        for stage in stages.values():
+            stage.sample()
+
+        client.request('stop').result(30)
+
+        results.update({
+            'lines_sent': logchan.done,
+            'lines_received': len(logchan.seen),
+            'elapsed': elapsed,
+            'throughput': len(logchan.seen) / elapsed if elapsed else 0,
+            'log_latency': percentiles(logchan.latencies),
+            'commands': {cmd: percentiles(latencies) for cmd, latencies in commands.items()},
+            'command_errors': errors,
+            'discord_messages': len(logchan.messages),
+            'discord_uploads': logchan.uploads,
+            'stages': {name: {'cpu': stage.cpu,
+                              'cpu_pct': 100 * stage.cpu / elapsed if elapsed else 0,
+                              'peak_rss': stage.peak_rss}
+                       for name, stage in stages.items()}})
+        return results
+
+    finally:
+        controller.terminate()
+        controller.wait()
+        discord.close()
+
+        # Don't leave a game running if something went wrong before we could stop it
+        try:
+            with open(os.path.join(env[f'{key}_STATE_DIR'], 'state.json')) as f:
+                os.kill(json.load(f)['pid'], 9)
+        except (OSError, ValueError, KeyError):
+            pass
+
+
+def report(results):
+    """
+    Print the results of a run.
+
+    Args:
+        results: What run() returned
+    """
+
+    def ms(summary):
+        if not summary:
+            return 'no samples'
+        return '  '.join(f'{name} {value * 1000:8.1f}ms' for name, value in summary.items()
+                         if name != 'count') + f'  (n={summary["count"]})'
+
+    if results['lines_sent'] is None:
+        sent = 'an unknown number of (the game never finished reaching Discord)'
+        lost = 'unknown'
+    else:
+        sent = f'{results["lines_sent"]:,}'
+        lost = f'{results["lines_sent"] - results["lines_received"]:,}'
+    print(f'{results["game"]}: startup {results["startup"]:.2f}s, {results["lines_received"]:,} of '
+          f'{sent} lines in {results["elapsed"]:.1f}s '
+          f'({results["throughput"]:,.0f} lines/sec delivered, {lost} lost)')
+    print(f'  Discord: {results["discord_messages"]:,} messages, {results["discord_uploads"]:,} '
+          f'uploads')
+    print(f'  {"log e2e":>10}: {ms(results["log_latency"])}')
+    for cmd, summary in results['commands'].items():
+        print(f'  {cmd:>10}: {ms(summary)}')
+    print(f'  {"errors":>10}: {results["command_errors"]}')
+    print(f'  {"stage":>10}  {"cpu":>8}  {"cpu%":>6}  {"peak rss":>10}')
+    for name, stage in results['stages'].items():
+        print(f'  {name:>10}  {stage["cpu"]:>7.2f}s  {stage["cpu_pct"]:>5.1f}%  '
+              f'{stage["peak_rss"] / 1048576:>8.1f}MB')
+
+
+# Main
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the game log and command pipeline '
+                                                 'end to end against a fake game server')
+    parser.add_argument('games', nargs='*', metavar='game',
+                        help=f'games to benchmark: {", ".join(sorted(GAMES))} (default: all)')
+    parser.add_argument('-r', '--rate', type=float, default=2000, help='log lines/sec (0 = max)')
+    parser.add_argument('-l', '--length', type=int, default=100, help='characters per log line')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='seconds of log output')
+    parser.add_argument('-w', '--burst-window', type=float, default=2,
+                        help='LOG_BURST_WINDOW for the client, in seconds')
+    parser.add_argument('--discord-delay', type=float, default=0,
+                        help='seconds each log channel send takes, to mimic Discord rate limits')
+    parser.add_argument('--cmd-interval', type=float, default=0.5,
+                        help='seconds between ping/players probes while logging')
+    parser.add_argument('--log-filter', help='rules file for the controller log filter')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show controller output')
+    args = parser.parse_args()
+    games = args.games or sorted(GAMES)
+    for game in games:
+        if game not in GAMES:
+            parser.error(f'unknown game: {game}')
+
+    # The client side reads its settings at import time, so it has to see the same env
+    work_dir = tempfile.mkdtemp(prefix='bench-pipeline-')
+    try:
+        env = setup_env(games, work_dir, args)
+        os.environ.update(env)
+        all_results = [run(game, env, args) for game in games]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(all_results, indent=2))
+    else:
+        for results in all_results:
+            report(results)
@@ -0,0 +1,131 @@
+import argparse
+import multiprocessing as mp
+import subprocess as sp
+import sys
+import threading
+import time
+
+from procreader import LineReader
+
+# Child process that spits out lines as fast as it can, in big blocks so it isn't the bottleneck.
+# Every 1000th line has bad UTF-8 to make sure the reader copes with it
+EMITTER = '''
+import sys
+n, length = int(sys.argv[1]), int(sys.argv[2])
+line = b'[12:34:56] [Server thread/INFO]: ' + b'x' * max(0, length - 34) + b'\\n'
+bad = b'[12:34:56] [Server thread/WARN]: \\xff\\xfe bad bytes\\n'
+block = bad + line * 999
+out = sys.stdout.buffer
+for _ in range(n // 1000):
+    out.write(block)
+if n % 1000:
+    out.write(block[:len(bad) + len(line) * (n % 1000 - 1)])
+out.flush()
+'''
+
+
+def spawn(lines, length):
+    """
+    Start an emitter process.
+
+    Args:
+        lines:  The number of lines it should print
+        length: The length of each line
+
+    Returns:
+        The Popen object for the emitter
+    """
+
+    return sp.Popen([sys.executable, '-c', EMITTER, str(lines), str(length)], stdout=sp.PIPE)
+
+
+def start_sink():
+    """
+    Set up a stand-in for the IPC connection to the client, with a thread draining the other end so
+    sends don't block.
+
+    Returns:
+        The sending end of the pipe and the draining thread
+    """
+
+    recv_conn, send_conn = mp.Pipe(duplex=False)
+
+    def drain():
+        try:
+            while True:
+                recv_conn.recv_bytes()
+        except EOFError:
+            pass
+
+    drainer = threading.Thread(target=drain)
+    drainer.daemon = True
+    drainer.start()
+    return send_conn, drainer
+
+
+def bench_readline(lines, length):
+    """
+    The old path: readline() and bytes.decode() one line at a time, one IPC send per line.
+
+    Returns:
+        The number of lines read
+    """
+
+    proc = spawn(lines, length)
+    conn, drainer = start_sink()
+    count = 0
+    while True:
+        line = proc.stdout.readline()
+        if not line:
+            break
+        conn.send_bytes(f'LOG |{bytes.decode(line, errors="replace")}'.encode())
+        count += 1
+    conn.close()
+    drainer.join()
+    proc.wait()
+    return count
+
+
+def bench_linereader(lines, length):
+    """
+    The new path: big non-blocking reads split into batches by LineReader, one IPC send per batch.
+
+    Returns:
+        The number of lines read
+    """
+
+    proc = spawn(lines, length)
+    conn, drainer = start_sink()
+    reader = LineReader(proc.stdout)
+    count = 0
+    while not reader.eof:
+        batch = reader.read()
+        if batch:
+            conn.send_bytes(f'LOG |{"".join(batch)}'.encode())
+            count += len(batch)
+    conn.close()
+    drainer.join()
+    proc.wait()
+    return count
+
+
+# Main
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare game output reader throughput')
+    parser.add_argument('-n', '--lines', type=int, default=500000, help='lines per run')
+    parser.add_argument('-l', '--length', type=int, default=120, help='bytes per line')
+    parser.add_argument('-r', '--runs', type=int, default=3, help='runs per reader (best is kept)')
+    args = parser.parse_args()
+
+    for name, bench in (('readline', bench_readline), ('LineReader', bench_linereader)):
+        best = None
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            count = bench(args.lines, args.length)
+            elapsed = time.perf_counter() - start
+            if count != args.lines:
+                print(f'{name}: read {count} lines, expected {args.lines}')
+                sys.exit(1)
+            best = elapsed if best is None else min(best, elapsed)
+        print(f'{name:>12}: {args.lines / best:>12,.0f} lines/sec ({best:.3f}s)')
@@ -0,0 +1,118 @@
+import json
+import re
+
+import config
+
+__all__ = ['clean', 'escape', 'pack', 'encode_batch', 'decode_batch']
+
+# Consts
+CONTROL_RE = re.compile(r'§.?|[\x00-\x1f\x7f]+') # Minecraft's format codes and control characters
+MARKDOWN_RE = re.compile(r'([\\*_~`|>])')
+
+# Load Env
+CONFIG = config.load()
+CHAT_BATCH_WINDOW = CONFIG.get('CHAT_BATCH_WINDOW', float, 1)
+CHAT_MSG_MAX = CONFIG.get('CHAT_MSG_MAX', int, 256)
+
+
+def clean(text, limit=CHAT_MSG_MAX):
+    """
+    Make a Discord message safe to put on a game console: one line, no control characters or format
+    codes, and no longer than the limit.
+
+    Args:
+        text:  The message
+        limit: (Optional) The max length. Defaults to CHAT_MSG_MAX
+
+    Returns:
+        The cleaned up message, possibly empty
+    """
+
+    text = ' '.join(CONTROL_RE.sub(' ', text).split())
+    if len(text) > limit:
+        text = text[:limit - 3] + '...'
+    return text
+
+
+def escape(text):
+    """
+    Make game chat safe to post on Discord, so players can't ping everyone or mess with the
+    formatting.
+
+    Args:
+        text: The chat text
+
+    Returns:
+        The escaped text
+    """
+
+    return MARKDOWN_RE.sub(r'\\\1', text).replace('@', '@\u200b') # Zero width space
+
+
+def pack(parts, limit, sep):
+    """
+    Group strings into as few chunks as possible, each no longer than the limit when joined with
+    the separator. A part that's too long on its own gets a chunk to itself.
+
+    Args:
+        parts: The list of strings
+        limit: The max length of a chunk
+        sep:   What the parts of a chunk will be joined with
+
+    Returns:
+        A list of lists of parts
+    """
+
+    chunks = []
+    size = 0
+    for part in parts:
+        if chunks and size + len(sep) + len(part) <= limit:
+            chunks[-1].append(part)
+            size += len(sep) + len(part)
+        else:
+            chunks.append([part])
+            size = len(part)
+    return chunks
+
+
+def encode_batch(messages):
+    """
+    Encode a batch of Discord messages as the argument to a controller's chat command. This keeps
+    the whole batch on one line.
+
+    Args:
+        messages: A list of (name, text) pairs
+
+    Returns:
+        The encoded batch
+    """
+
+    return json.dumps([[name, text] for name, text in messages])
+
+
+def decode_batch(args):
+    """
+    Decode the argument to a controller's chat command, cleaning up the names and messages.
+
+    Args:
+        args: The encoded batch
+
+    Returns:
+        A list of (name, text) pairs, leaving out anything malformed or empty
+    """
+
+    try:
+        batch = json.loads(args or '')
+    except ValueError:
+        return []
+    if not isinstance(batch, list):
+        return []
+
+    messages = []
+    for entry in batch:
+        if isinstance(entry, list) and len(entry) == 2 and all(isinstance(x, str) for x in entry):
+            name = clean(entry[0], 32)
+            text = clean(entry[1])
+            if name and text:
+                messages.append((name, text))
+    return messages
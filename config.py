@@ -0,0 +1,262 @@
+import ipaddress
+import os
+import socket
+
+import dotenv as de
+
+__all__ = ['Config', 'ConfigError', 'GameConfig', 'load']
+
+# Consts
+REQUIRED = object() # Default for settings that have to be there
+
+# Globals
+_config = None
+
+
+class ConfigError(Exception):
+    """
+    A setting is missing or can't be parsed
+    """
+
+
+class Config:
+    """
+    Typed view of the settings in the environment (and the .env file). Use load() to get the shared
+    instance so the .env file is only parsed once per process.
+
+    General settings are attributes. Game specific settings come from game(), so a game that isn't
+    set up only causes an error if something actually asks for its settings.
+    """
+
+    def __init__(self, environ=None):
+        """
+        Initializes a new Config and parses the general settings.
+
+        Args:
+            environ: (Optional) A dict of settings. Defaults to a copy of os.environ
+
+        Returns:
+            A newly initialized Config object
+
+        Raises:
+            ConfigError: If a general setting is missing or bad
+        """
+
+        self.environ = dict(os.environ if environ is None else environ)
+        self.__games = {}
+
+        self.discord_token = self.get('DISCORD_TOKEN', default=None)
+        self.guild_id = self.get('GUILD_ID', int, None)
+        self.bot_chan_id = self.get('BOT_CHAN_ID', int, None)
+        self.secret = self.get('SECRET', str.encode)
+        self.plugins = self.get('PLUGINS', _split_list, ['minecraft', 'terraria'])
+        self.allow_remote_ipc = bool(self.get('ALLOW_REMOTE_IPC', int, 0))
+
+
+    def get(self, name, cast=str, default=REQUIRED):
+        """
+        Get a single setting.
+
+        Args:
+            name:    The name of the setting
+            cast:    (Optional) Function to convert the string value with. Defaults to str
+            default: (Optional) The value to use if the setting is missing or empty. Defaults to
+                     making the setting required
+
+        Returns:
+            The converted setting, or the default
+
+        Raises:
+            ConfigError: If the setting is required but missing or can't be converted
+        """
+
+        value = self.environ.get(name)
+        if value is None or value.strip() == '':
+            if default is REQUIRED:
+                raise ConfigError(f'Missing required setting {name}')
+            return default
+
+        try:
+            return cast(value.strip())
+        except ValueError:
+            raise ConfigError(f'Bad value for {name}: {value!r}')
+
+
+    def game(self, key):
+        """
+        Get the settings for a game. These are parsed the first time they're asked for.
+
+        Args:
+            key: The setting name prefix for the game (e.g. 'MC' for MC_DIR, MCC_PORT, ...)
+
+        Returns:
+            The GameConfig for the game
+
+        Raises:
+            ConfigError: If a required setting for the game is missing or bad
+        """
+
+        if key not in self.__games:
+            self.__games[key] = GameConfig(self, key)
+        return self.__games[key]
+
+
+class GameConfig:
+    """
+    Typed settings for one game, all named after its key: <KEY>_DIR, <KEY>_LOG_CHAN_ID,
+    <KEY>C_PORT, <KEY>_PREFIX, <KEY>_START_TIMEOUT, <KEY>_LOG_FILTER, <KEY>_STATE_DIR,
+    <KEY>_METRICS_PORT, <KEY>_CHAT_CHAN_ID, <KEY>C_HOST, <KEY>_CONTROLLERS, <KEY>_SERVERS and
+    <KEY>_MIN_FREE_MB. Controllers are only reached over loopback unless ALLOW_REMOTE_IPC is set
+    """
+
+    def __init__(self, config, key):
+        """
+        Initializes a new GameConfig.
+
+        Args:
+            config: The Config to read settings from
+            key:    The setting name prefix for the game
+
+        Returns:
+            A newly initialized GameConfig object
+
+        Raises:
+            ConfigError: If a required setting is missing or bad
+        """
+
+        self.key = key
+        self.dir = config.get(f'{key}_DIR')
+        self.log_chan_id = config.get(f'{key}_LOG_CHAN_ID', int)
+        self.port = config.get(f'{key}C_PORT', int)
+        self.prefix = config.get(f'{key}_PREFIX', default=key.lower())
+        self.start_timeout = config.get(f'{key}_START_TIMEOUT', int, 120)
+        self.log_filter = config.get(f'{key}_LOG_FILTER', default=None)
+        self.state_dir = config.get(f'{key}_STATE_DIR', default=os.path.join(self.dir, '.serverbot'))
+        self.metrics_port = config.get(f'{key}_METRICS_PORT', int, None)
+        self.chat_chan_id = config.get(f'{key}_CHAT_CHAN_ID', int, None)
+        self.listen_host = config.get(f'{key}C_HOST', default='localhost')
+        self.controllers = config.get(f'{key}_CONTROLLERS', _split_endpoints,
+                                      [('localhost', self.port)])
+        self.servers = config.get(f'{key}_SERVERS', _split_servers,
+                                  {_server_name(self.dir): self.dir})
+        self.min_free_mb = config.get(f'{key}_MIN_FREE_MB', int, 0)
+
+        # The controller connection is authenticated but not encrypted, so keep it off the network
+        # unless the operator says otherwise
+        if not config.allow_remote_ipc:
+            for host in [self.listen_host] + [host for host, _ in self.controllers]:
+                if not _is_loopback(host):
+                    raise ConfigError(f'{host} is not a loopback address. Controller connections '
+                                      'are not encrypted, so tunnel them (e.g. over SSH) or set '
+                                      'ALLOW_REMOTE_IPC=1 on a network you trust')
+
+
+def load():
+    """
+    Get the shared Config, parsing the .env file the first time.
+
+    Returns:
+        The Config for this process
+
+    Raises:
+        ConfigError: If a general setting is missing or bad
+    """
+
+    global _config
+
+    if _config is None:
+        de.load_dotenv()
+        _config = Config()
+    return _config
+
+
+def _split_list(value):
+    """
+    Split a comma separated setting into a list, dropping empty entries.
+
+    Args:
+        value: The setting value
+
+    Returns:
+        The list of stripped entries
+    """
+
+    return [entry.strip() for entry in value.split(',') if entry.strip()]
+
+
+def _split_endpoints(value):
+    """
+    Split a comma separated list of host:port controller addresses.
+
+    Args:
+        value: The setting value
+
+    Returns:
+        The list of (host, port)
+
+    Raises:
+        ValueError: If an entry has no port or a bad one
+    """
+
+    endpoints = []
+    for entry in _split_list(value):
+        [host, sep, port] = entry.rpartition(':')
+        if not sep or not host:
+            raise ValueError(entry)
+        endpoints.append((host.strip('[]'), int(port)))
+    return endpoints
+
+
+def _split_servers(value):
+    """
+    Split a comma separated list of name=dir server directories. A bare dir is named after its last
+    path component.
+
+    Args:
+        value: The setting value
+
+    Returns:
+        The dict of name to dir, in the order given
+    """
+
+    servers = {}
+    for entry in _split_list(value):
+        [name, sep, path] = entry.partition('=')
+        if sep:
+            servers[name.strip()] = path.strip()
+        else:
+            servers[_server_name(entry)] = entry
+    return servers
+
+
+def _server_name(path):
+    """
+    Name a server after its directory.
+
+    Args:
+        path: The server directory
+
+    Returns:
+        The last component of the path
+    """
+
+    return os.path.basename(os.path.normpath(path))
+
+
+def _is_loopback(host):
+    """
+    Check whether a host name or address only ever means this machine.
+
+    Args:
+        host: The host name or address
+
+    Returns:
+        True if every address it resolves to is a loopback address
+    """
+
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, None)]
+        return bool(addresses) and all(ipaddress.ip_address(address.split('%')[0]).is_loopback
+                                       for address in addresses)
+    except (OSError, ValueError):
+        return False
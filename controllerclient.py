@@ -0,0 +1,904 @@
+import asyncio
+import concurrent.futures as cf
+import io
+import json
+import math
+import multiprocessing.connection as mpc
+import socket
+import threading
+import time
+
+import chat
+import config
+import fleet
+import metrics
+import tracing
+from logburst import LogBurst
+
+__all__ = ['ControllerClient', 'set_nodelay', 'send_text', 'recv_text']
+
+# Consts
+DETACH_POLL_INTERVAL = 1 # Max seconds the reader goes without checking whether it should stop
+
+# Load Env
+SECRET = config.load().secret
+
+
+def set_nodelay(conn):
+    """
+    Turn off Nagle's algorithm on a connection. Replies often go out right behind a LOG message, and
+    without this they sit waiting for the first one to be acked (40ms with delayed acks).
+
+    Args:
+        conn: The multiprocessing Connection
+    """
+
+    with socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def send_text(conn, text):
+    """
+    Send a message over a controller connection. Messages go as UTF-8 text rather than pickles, so
+    neither end ever unpickles anything that came in off the network.
+
+    Args:
+        conn: The multiprocessing Connection
+        text: The message
+    """
+
+    conn.send_bytes(text.encode('utf-8'))
+
+
+def recv_text(conn):
+    """
+    Receive a message sent with send_text().
+
+    Args:
+        conn: The multiprocessing Connection
+
+    Returns:
+        The message
+    """
+
+    return conn.recv_bytes().decode('utf-8', errors='replace')
+
+
+class _Endpoint:
+    """
+    One controller a ControllerClient talks to, and everything it keeps per connection
+    """
+
+    def __init__(self, host, port):
+        """
+        Initializes a new, unconnected _Endpoint.
+
+        Args:
+            host: The host the controller runs on
+            port: The port the controller listens on
+
+        Returns:
+            A newly initialized _Endpoint object
+        """
+
+        self.host = host
+        self.port = port
+        self.label = f'{host}:{port}'
+        self.conn = None
+        self.reader = None
+        self.requests = {}
+        self.next_tag = 0
+        self.send_lock = threading.Lock() # Connection.send isn't thread safe
+        self.logburst = None
+        self.chatburst = None
+        self.load = None # The last heartbeat, None until the controller sends one
+        self.seen = time.monotonic() # When we last heard anything from the controller
+        self.pinged = 0 # When we last sent the controller a heartbeat
+
+
+    @property
+    def connected(self):
+        """
+        True if we currently have an open connection to the controller
+        """
+
+        conn = self.conn
+        return conn is not None and not conn.closed
+
+
+    @property
+    def running(self):
+        """
+        The name of the server the controller last said it's running, or None
+        """
+
+        return self.load.get('running') if self.connected and self.load else None
+
+
+class ControllerClient:
+    """
+    Base class for the serverbot side of a game controller. It handles all communication with the
+    game's controllers: keeping connections up, posting what the controllers send to the bot and
+    log channels, and sending them commands.
+
+    A game can have controllers on several hosts (a fleet). Each sends a heartbeat with its host's
+    free CPU and memory and what it's running. Commands go to the controller running a server, or
+    to the one named with a leading '@<host>'. 'start [server]' goes to the least loaded host that
+    can run the server, and 'hosts' lists the controllers. With a single controller everything
+    works as if there was no fleet.
+
+    If the game has a chat channel, chat() batches messages from it for the controllers to put in
+    game, and in-game chat the controllers send back is posted there in bursts like the log.
+
+    Subclasses just set name (used in messages) and help_msg (served here without asking a
+    controller), and pick their defaults. The client is meant to be
+    created once and kept for the life of the bot. When Discord reconnects, call bind() with the
+    refreshed objects instead of making a new one, so we never end up with two connections to the
+    same controller.
+    """
+
+    name = 'Game'
+    help_msg = None
+
+    def __init__(self, client, guild, prefix, port, botchanid, logchanid, chatchanid=None,
+                 state=None, controllers=None, min_free_mb=0):
+        """
+        Initializes a new ControllerClient and starts its reader threads.
+
+        Args:
+            client:      The Discord client to interact with
+            guild:       The Discord server (guild) the bot should respond on
+            prefix:      The Discord command prefix
+            port:        The port the controller runs on
+            botchanid:   The id of the Discord server bot channel
+            logchanid:   The id of the Discord server log channel for this game
+            chatchanid:  (Optional) The id of the Discord channel to bridge to in-game chat.
+                         Defaults to None (no chat bridge)
+            state:       (Optional) What detach() returned from the client we're replacing. We pick
+                         up its connections, buffered log output and chat, and waiting requests.
+                         Defaults to None (connect from scratch)
+            controllers: (Optional) The list of (host, port) of the game's controllers. Defaults
+                         to None (just the one on localhost at port)
+            min_free_mb: (Optional) The free memory in MB a host needs for servers to be placed
+                         on it. Defaults to 0
+
+        Returns:
+            A newly initialized ControllerClient object
+        """
+
+        # Set up members
+        self.prefix = prefix
+        self.botchanid = botchanid
+        self.logchanid = logchanid
+        self.chatchanid = chatchanid
+        self.min_free_mb = min_free_mb
+        self.client = None
+        self.guild = None
+        self.logchan = None
+        self.botchan = None
+        self.chatchan = None
+        self.bind(client, guild)
+
+        self.__endpoints = [_Endpoint(host, port) for host, port in controllers or
+                            [('localhost', port)]]
+        self.port = self.__endpoints[0].port
+        self.__default = self.__endpoints[0] # Where commands go when no server is running
+        self.__stop = threading.Event()
+        self.__chat_out = [] # (name, text) from the chat channel, waiting to go to the game
+        self.__lock = threading.Lock()
+
+        # Metrics. A client that replaces this one takes these over
+        game = self.name.lower()
+        self.__received = {}
+        self.__connects = {}
+        self.__send_errors = {}
+        for ep in self.__endpoints:
+            ep.logburst = LogBurst(self._logchan_send, self._logchan_upload, self.name)
+            ep.chatburst = LogBurst(self._chatchan_send, self._chatchan_upload,
+                                    f'{self.name} chat', window=chat.CHAT_BATCH_WINDOW)
+            self.__received[ep] = metrics.counter('serverbot_bot_messages_received_total',
+                                                  'Messages received from the controller',
+                                                  game=game, host=ep.label)
+            self.__connects[ep] = metrics.counter('serverbot_bot_controller_connects_total',
+                                                  'Times we connected to the controller',
+                                                  game=game, host=ep.label)
+            self.__send_errors[ep] = metrics.counter('serverbot_bot_ipc_send_errors_total',
+                                                     'Commands that could not be sent to the '
+                                                     'controller', game=game, host=ep.label)
+            metrics.gauge('serverbot_bot_controller_connected',
+                          'Whether the controller is connected',
+                          lambda ep=ep: 1 if ep.connected else 0, game=game, host=ep.label)
+            metrics.gauge('serverbot_bot_pending_requests',
+                          'Requests waiting for a controller reply',
+                          lambda ep=ep: len(ep.requests), game=game, host=ep.label)
+            metrics.gauge('serverbot_bot_host_cpu_free', 'Idle CPU fraction on the controller host',
+                          lambda ep=ep: ep.load['cpu_free'] if ep.load else math.nan, game=game,
+                          host=ep.label)
+            metrics.gauge('serverbot_bot_host_memory_free_bytes',
+                          'Available memory on the controller host',
+                          lambda ep=ep: ep.load['mem_free'] if ep.load else math.nan, game=game,
+                          host=ep.label)
+        self.__posts = {chan: metrics.counter('serverbot_bot_discord_posts_total',
+                                              'Messages and uploads posted to Discord', game=game,
+                                              channel=chan)
+                        for chan in ('bot', 'log', 'chat')}
+        self.__post_queue = metrics.gauge('serverbot_bot_discord_queue_depth',
+                                          'Posts to Discord that have not gone out yet', game=game)
+        metrics.gauge('serverbot_bot_log_buffered_chars', 'Log output waiting to be posted',
+                      lambda: sum(ep.logburst.size for ep in self.__endpoints), game=game)
+
+        # Take over from the client we're replacing
+        if state is not None:
+            self.__take_over(state)
+
+        self.start()
+
+
+    def bind(self, client, guild):
+        """
+        Point the client at a (possibly refreshed) Discord client and guild. Channels are looked up
+        again from the guild. The controller connections are left alone.
+
+        Args:
+            client: The Discord client to interact with
+            guild:  The Discord server (guild) the bot should respond on
+        """
+
+        self.client = client
+        self.guild = guild
+        self.logchan = guild.get_channel(self.logchanid)
+        self.botchan = guild.get_channel(self.botchanid)
+        if self.chatchanid is not None:
+            self.chatchan = guild.get_channel(self.chatchanid)
+
+
+    def start(self):
+        """
+        Start any reader threads that aren't already running. Safe to call as often as you like.
+
+        Returns:
+            True if a new thread was started, False if they were all running
+        """
+
+        started = False
+        with self.__lock:
+            for ep in self.__endpoints:
+                if ep.reader is not None and ep.reader.is_alive():
+                    continue
+
+                # Start a daemon reader thread
+                ep.reader = threading.Thread(target=self.__read_thread, args=(ep,))
+                ep.reader.daemon = True
+                ep.reader.start()
+                started = True
+        return started
+
+
+    def detach(self, timeout=DETACH_POLL_INTERVAL * 5):
+        """
+        Stop the reader threads without closing the connections, and hand over everything a
+        replacement client needs to carry on where this one left off. This blocks until the readers
+        have stopped. The client is dead afterwards.
+
+        Args:
+            timeout: (Optional) Max seconds to wait for each reader to stop. Defaults to a few poll
+                     intervals
+
+        Returns:
+            The state to pass to the new client's constructor
+
+        Raises:
+            TimeoutError: If a reader didn't stop in time. The client keeps running
+        """
+
+        self.__stop.set()
+        for ep in self.__endpoints:
+            reader = ep.reader
+            if reader is not None and reader is not threading.current_thread():
+                reader.join(timeout)
+                if reader.is_alive():
+                    self.__stop.clear()
+                    self.start()
+                    raise TimeoutError(f'{self.name} reader thread for {ep.label} did not stop')
+
+        with self.__lock:
+            state = {'endpoints': {ep.label: {'conn': ep.conn,
+                                              'log': ep.logburst.take(),
+                                              'chat': ep.chatburst.take(),
+                                              'requests': ep.requests,
+                                              'next_tag': ep.next_tag,
+                                              'load': ep.load}
+                                   for ep in self.__endpoints},
+                     'default': self.__default.label,
+                     'chat_out': self.__chat_out}
+            for ep in self.__endpoints:
+                ep.conn = None
+                ep.requests = {}
+            self.__chat_out = []
+
+        return state
+
+
+    @property
+    def connected(self):
+        """
+        True if we currently have an open connection to any of the controllers
+        """
+
+        return any(ep.connected for ep in self.__endpoints)
+
+
+    @property
+    def connections(self):
+        """
+        How many of the controllers we're connected to
+        """
+
+        return sum(1 for ep in self.__endpoints if ep.connected)
+
+
+    @property
+    def labels(self):
+        """
+        The host:port of each controller
+        """
+
+        return [ep.label for ep in self.__endpoints]
+
+
+    @property
+    def reader_alive(self):
+        """
+        True if all the reader threads are running
+        """
+
+        return all(ep.reader is not None and ep.reader.is_alive() for ep in self.__endpoints)
+
+
+    def hosts(self):
+        """
+        Describe each controller and the load on its host, as of its last heartbeat.
+
+        Returns:
+            A printable summary, one line per controller
+        """
+
+        lines = []
+        for ep in self.__endpoints:
+            if not ep.connected:
+                status = 'not connected'
+            elif ep.load is None:
+                status = 'connected, no heartbeat yet'
+            else:
+                status = fleet.describe(ep.load)
+            lines.append(f'{ep.label} - {status}')
+        return f'{self.name} hosts:\n' + '\n'.join(lines)
+
+
+    def __take_over(self, state):
+        """
+        Pick up the connections and everything else from a client we're replacing.
+
+        Args:
+            state: What the old client's detach() returned
+        """
+
+        # State from before there were several controllers is all for the first one
+        endpoints = state.get('endpoints')
+        if endpoints is None:
+            endpoints = {self.__endpoints[0].label: state}
+
+        by_label = {ep.label: ep for ep in self.__endpoints}
+        for label, ep_state in endpoints.items():
+            ep = by_label.get(label)
+
+            # Controllers that aren't configured any more get dropped
+            if ep is None:
+                if ep_state['conn'] is not None:
+                    ep_state['conn'].close()
+                self.__fail_requests(ep_state['requests'], label)
+                continue
+
+            ep.conn = ep_state['conn']
+            ep.logburst.add(ep_state['log'])
+            ep.chatburst.add(ep_state.get('chat', ''))
+            ep.requests = ep_state['requests']
+            ep.next_tag = ep_state['next_tag']
+            ep.load = ep_state.get('load')
+
+        self.__default = by_label.get(state.get('default'), self.__default)
+        self.__chat_out = state.get('chat_out', [])
+        if self.__chat_out:
+            self.client.loop.call_soon_threadsafe(self.__send_chat)
+
+
+    def __where(self, ep):
+        """
+        Say which controller a message is about, if there's more than one.
+
+        Args:
+            ep: The _Endpoint
+
+        Returns:
+            ' on <host:port>', or an empty string with a single controller
+        """
+
+        return f' on {ep.label}' if len(self.__endpoints) > 1 else ''
+
+
+    def __read_thread(self, ep):
+        """
+        The read thread for one controller. This will attempt to create a connection to the
+        controller and listen for incoming data. This thread will stay alive until the process
+        closes.
+
+        Args:
+            ep: The _Endpoint to read from
+        """
+
+        while not self.__stop.is_set():
+
+            # First connect to the server, unless we took over a live connection
+            try:
+                if ep.conn is None or ep.conn.closed:
+                    ep.load = None
+                    ep.conn = mpc.Client((ep.host, ep.port), authkey=SECRET)
+                    set_nodelay(ep.conn)
+                    self.__connects[ep].inc()
+                    self._botchan_send(f'{self.name} server manager{self.__where(ep)} connected!')
+                ep.seen = time.monotonic()
+
+            # Leaving unassigned or closing skips the next loop. Unreachable or misconfigured
+            # hosts just get retried
+            except (EOFError, OSError, mpc.AuthenticationError):
+                if ep.conn is not None:
+                    ep.conn.close()
+                self.__stop.wait(10) # Wait a reasonable amount of time and chek again
+
+            # Read loop
+            while ep.conn and (not ep.conn.closed) and (not self.__stop.is_set()):
+
+                # Try to read and direct messages appropriately. Post any buffered log output or
+                # chat once nothing new has come in for its burst window. Don't block for too long
+                # so we notice if we're being detached or the controller stops sending heartbeats.
+                # We send the controller heartbeats too, so it notices if we go away
+                try:
+                    now = time.monotonic()
+                    if now - ep.pinged >= fleet.HEARTBEAT_INTERVAL:
+                        with ep.send_lock:
+                            send_text(ep.conn, 'heartbeat')
+                        ep.pinged = now
+
+                    if ep.load is not None and time.monotonic() - ep.seen > fleet.HEARTBEAT_TIMEOUT:
+                        self.__drop(ep, f'ERR: The {self.name} server manager{self.__where(ep)} '
+                                        'stopped responding. Attempting to reconnect')
+                        break
+
+                    timeouts = [burst.timeout() for burst in (ep.logburst, ep.chatburst)]
+                    timeout = min((t for t in timeouts if t is not None), default=None)
+                    if timeout is None or timeout > DETACH_POLL_INTERVAL:
+                        if not ep.conn.poll(DETACH_POLL_INTERVAL):
+                            continue
+                    elif not ep.conn.poll(timeout):
+                        for burst in (ep.logburst, ep.chatburst):
+                            if burst.timeout() == 0:
+                                burst.flush()
+                        continue
+                    line = recv_text(ep.conn)
+                    ep.seen = time.monotonic()
+                    self.__received[ep].inc()
+                    [status, msg] = line.split('|', 1)
+                    status = status.strip()
+
+                    # Replies to request() go back to whoever asked instead of the channel. Traced
+                    # requests get the controller's timestamps after a '+' on the tag
+                    if '@' in status:
+                        [status, tag] = [part.strip() for part in status.split('@', 1)]
+                        [tag, _, stamps] = tag.partition('+')
+                        with self.__lock:
+                            future = ep.requests.pop(tag, None)
+                        if future is not None:
+                            tracing.reply(getattr(future, 'trace', None), stamps)
+                            if future.set_running_or_notify_cancel():
+                                future.set_result(msg if status == 'OK' else f'{status}: {msg}')
+                            continue
+
+                    if status == 'LOG':
+                        ep.logburst.add(msg)
+                    elif status == 'LOAD':
+                        try:
+                            ep.load = json.loads(msg)
+                        except ValueError:
+                            pass # A garbled heartbeat still shows the controller is alive
+                    elif status == 'CHAT':
+                        if self.chatchan is not None:
+                            ep.chatburst.add(chat.escape(msg))
+                    elif status == 'OK':
+                        self._botchan_send(msg)
+                    else:
+                        self._botchan_send(f'{status}: {msg}')
+
+                # Close the connection so we end the loop and try to reconnect at the top
+                except (EOFError, OSError):
+                    self.__drop(ep, f'ERR: The {self.name} server manager{self.__where(ep)} '
+                                    'crashed. Attempting to reconnect')
+
+
+    def __drop(self, ep, msg):
+        """
+        Close a controller connection so its reader reconnects, posting what's buffered and
+        failing the requests still waiting on it.
+
+        Args:
+            ep:  The _Endpoint
+            msg: What to tell the bot channel
+        """
+
+        self._botchan_send(msg)
+        ep.conn.close()
+        ep.logburst.flush()
+        ep.chatburst.flush()
+        with self.__lock:
+            requests = ep.requests
+            ep.requests = {}
+        self.__fail_requests(requests, ep.label)
+
+
+    def try_send(self, msg, trace=None):
+        """
+        Try to send a message to a controller. If we fail, print an error to the bot channel. We
+        don't need to handle the failure here since the reader reads in a tight loop so a connection
+        failure will be caught there as well and will trigger a reconnect.
+
+        Args:
+            msg:   The message to try to send
+            trace: (Optional) The Trace for the command. Traced commands go through request() so
+                   the reply carries the controller's timestamps. Defaults to None
+        """
+
+        # Any replies after the first aren't matched to the request, so they still get posted
+        if trace is not None:
+            future = self.request(msg, trace)
+            future.add_done_callback(lambda future: self.__post_traced(future, trace))
+            return
+
+        try:
+            ep, msg = self.__route(msg)
+        except LookupError as e:
+            self._botchan_send(f'ERR: {e.args[0]}')
+            return
+        if ep is None:
+            self._botchan_send(msg)
+            return
+
+        try:
+            with ep.send_lock:
+                send_text(ep.conn, msg)
+        except (OSError, AttributeError):
+            # We lost connection. We'll just log it and let the read loop handle reconnecting
+            self.__send_errors[ep].inc()
+            self._botchan_send(f'Could not send command to {self.name} server '
+                               f'manager{self.__where(ep)}')
+
+
+    def request(self, msg, trace=None):
+        """
+        Send a command to a controller and get the reply back instead of having it posted to the
+        bot channel. Only use this for commands that send exactly one reply.
+
+        Args:
+            msg:   The command to send
+            trace: (Optional) The Trace for the command. The controller's timestamps are added to
+                   it when the reply comes in. Defaults to None
+
+        Returns:
+            A concurrent.futures.Future resolving to the reply text. Fails with ConnectionError if
+            the command can't be sent (or there's no controller to send it to) or the connection
+            drops before the reply comes in
+        """
+
+        future = cf.Future()
+        future.trace = trace
+        try:
+            ep, msg = self.__route(msg)
+        except LookupError as e:
+            future.set_exception(ConnectionError(e.args[0]))
+            return future
+        if ep is None:
+            future.set_result(msg)
+            return future
+
+        with self.__lock:
+            ep.next_tag += 1
+            tag = str(ep.next_tag)
+            ep.requests[tag] = future
+
+        # Forget the request once it's answered, failed or given up on (e.g. the bot's wait timed
+        # out and cancelled it), so a controller that never answers doesn't leave it behind
+        future.add_done_callback(lambda _: self.__forget(ep, tag))
+
+        tracing.mark(trace, 'bot')
+        try:
+            with ep.send_lock:
+                send_text(ep.conn, f'@{tag}{"" if trace is None else "+"} {msg}')
+        except (OSError, AttributeError):
+            self.__send_errors[ep].inc()
+            with self.__lock:
+                ep.requests.pop(tag, None)
+            future.set_exception(ConnectionError(f'Could not send command to {self.name} server '
+                                                 f'manager{self.__where(ep)}'))
+
+        return future
+
+
+    def __route(self, msg):
+        """
+        Work out which controller a command is for. A leading '@<host>' picks one (by host:port,
+        host, or the host name it reports). Otherwise start is placed on the least loaded host and
+        everything else goes to the controller running a server. The hosts and help commands are
+        answered here.
+
+        Args:
+            msg: The command
+
+        Returns:
+            (the _Endpoint, the command to send it), or (None, the reply) for commands we answer
+
+        Raises:
+            LookupError: With the reason if there's no controller to send the command to
+        """
+
+        [cmd, args] = (msg.split(None, 1) + [''])[:2]
+        if cmd == 'hosts':
+            return None, self.hosts()
+        if cmd == 'help' and not args and self.help_msg:
+            return None, self.help_msg
+
+        # Sent to a particular controller
+        if cmd.startswith('@'):
+            target = cmd[1:].lower()
+            matches = [ep for ep in self.__endpoints if target == ep.label.lower()]
+            matches = matches or [ep for ep in self.__endpoints if target == ep.host.lower()]
+            matches = matches or [ep for ep in self.__endpoints
+                                  if ep.load and target == str(ep.load.get('host')).lower()]
+            if len(matches) != 1:
+                raise LookupError(f'{"No" if not matches else "More than one"} {self.name} host '
+                                  f'matches {cmd} (see !{self.prefix} hosts)')
+            if not args:
+                raise LookupError(f'Usage: !{self.prefix} @<host> <command>')
+            if args.split()[0] == 'start':
+                self.__default = matches[0]
+            return matches[0], args
+
+        if len(self.__endpoints) == 1:
+            return self.__endpoints[0], msg
+
+        # Start it where it's running already (the controller says so), or on the best host
+        running = [ep for ep in self.__endpoints if ep.running]
+        if cmd == 'start':
+            server = args.strip() or None
+            ep = next((ep for ep in running if server is not None and ep.running == server), None)
+            if ep is None:
+                ep = self.__place(server)
+            self.__default = ep
+            return ep, msg
+
+        if len(running) > 1:
+            raise LookupError(f'{self.name} servers are running on '
+                              f'{", ".join(ep.label for ep in running)}. Pick one with '
+                              f'!{self.prefix} @<host> {msg}')
+        if running:
+            return running[0], msg
+        if self.__default.connected:
+            return self.__default, msg
+        return next((ep for ep in self.__endpoints if ep.connected), self.__default), msg
+
+
+    def __place(self, server):
+        """
+        Pick the controller to start a server on, and say where it's going.
+
+        Args:
+            server: The name of the server, or None for the controller's default
+
+        Returns:
+            The _Endpoint to start it on
+
+        Raises:
+            LookupError: With the reason if no controller can start it
+        """
+
+        candidates = [(ep, ep.load) for ep in self.__endpoints if ep.connected and ep.load]
+        if not candidates:
+            raise LookupError(f'No {self.name} server managers are connected')
+        if server is not None and not any(server in load.get('servers', ())
+                                          for _, load in candidates):
+            raise LookupError(f'No {self.name} host has a server called {server} (see '
+                              f'!{self.prefix} hosts)')
+
+        placed = fleet.place(candidates, server, self.min_free_mb * 1024 * 1024)
+        if placed is None:
+            raise LookupError(f'No {self.name} host can start {server or "a server"} right now. '
+                              f'It needs to be idle with {self.min_free_mb} MB free (see '
+                              f'!{self.prefix} hosts)')
+
+        ep, load = placed
+        self._botchan_send(f'Starting {server or "the server"} on {ep.label}, the least loaded '
+                           f'host ({load.get("cpu_free", 0) * 100:.0f}% cpu and '
+                           f'{load.get("mem_free", 0) / fleet.GIB:.1f} GiB free)')
+        return ep
+
+
+    def __forget(self, ep, tag):
+        """
+        Stop waiting for the reply to a request.
+
+        Args:
+            ep:  The _Endpoint it was sent to
+            tag: The request's tag
+        """
+
+        with self.__lock:
+            ep.requests.pop(tag, None)
+
+
+    def chat(self, name, text):
+        """
+        Queue a message from the chat channel for the game. Messages are sent to the controllers
+        in one batch per chat window. Call this on the Discord client's event loop.
+
+        Args:
+            name: Who said it
+            text: What they said
+        """
+
+        with self.__lock:
+            self.__chat_out.append((name, text))
+            first = len(self.__chat_out) == 1
+        if first:
+            self.client.loop.call_later(chat.CHAT_BATCH_WINDOW, self.__send_chat)
+
+
+    def __send_chat(self):
+        """
+        Send the queued chat channel messages as a single chat command to every controller running
+        a server (or the one commands go to, if none are).
+        """
+
+        with self.__lock:
+            messages = self.__chat_out
+            self.__chat_out = []
+        if not messages:
+            return
+
+        targets = [ep for ep in self.__endpoints if ep.running]
+        if not targets:
+            targets = [self.__route('chat')[0]]
+        for ep in targets:
+            try:
+                with ep.send_lock:
+                    send_text(ep.conn, f'chat {chat.encode_batch(messages)}')
+            except (OSError, AttributeError):
+                self.__send_errors[ep].inc()
+
+
+    def __post_traced(self, future, trace):
+        """
+        Post the reply to a traced try_send() to the bot channel and finish the trace once it's
+        out.
+
+        Args:
+            future: The request() future, already done
+            trace:  The Trace for the command
+        """
+
+        try:
+            reply = future.result()
+        except ConnectionError as e:
+            reply = f'ERR: {e}'
+
+        sent = self._botchan_send(reply)
+        sent.add_done_callback(lambda _: tracing.finish(trace, 'discord'))
+
+
+    def __fail_requests(self, requests, label):
+        """
+        Fail requests still waiting for a reply. Used when a connection drops.
+
+        Args:
+            requests: The dict of tag to future
+            label:    The host:port of the controller they were sent to
+        """
+
+        where = f' on {label}' if len(self.__endpoints) > 1 else ''
+        for future in requests.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ConnectionError(f'Lost connection to {self.name} server '
+                                                     f'manager{where}'))
+
+
+    def _logchan_send(self, msg):
+        """
+        Send a message to the log channel.
+
+        Args:
+            msg: The message to send
+        """
+
+        self._post(self.logchan.send(msg), 'log')
+
+
+    def _logchan_upload(self, summary, filename, data):
+        """
+        Send a file to the log channel.
+
+        Args:
+            summary:  The message to send along with the file
+            filename: The name to give the file
+            data:     The contents of the file as bytes
+        """
+
+        import discord # Only the bot needs this, the controllers run without it
+
+        file = discord.File(io.BytesIO(data), filename=filename)
+        self._post(self.logchan.send(summary, file=file), 'log')
+
+
+    def _chatchan_send(self, msg):
+        """
+        Send a message to the chat channel.
+
+        Args:
+            msg: The message to send
+        """
+
+        self._post(self.chatchan.send(msg), 'chat')
+
+
+    def _chatchan_upload(self, summary, filename, data):
+        """
+        Send a file to the chat channel.
+
+        Args:
+            summary:  The message to send along with the file
+            filename: The name to give the file
+            data:     The contents of the file as bytes
+        """
+
+        import discord # Only the bot needs this, the controllers run without it
+
+        file = discord.File(io.BytesIO(data), filename=filename)
+        self._post(self.chatchan.send(summary, file=file), 'chat')
+
+
+    def _botchan_send(self, msg):
+        """
+        Send a message to the bot channel.
+
+        Args:
+            msg: The message to send
+
+        Returns:
+            A concurrent.futures.Future that's done once Discord has the message
+        """
+
+        return self._post(self.botchan.send(msg), 'bot')
+
+
+    def _post(self, coro, chan):
+        """
+        Run a Discord send on the client's event loop, keeping count of the posts still queued.
+
+        Args:
+            coro: The send coroutine
+            chan: Which channel it's for, 'bot', 'log' or 'chat'
+
+        Returns:
+            A concurrent.futures.Future that's done once the send is
+        """
+
+        self.__posts[chan].inc()
+        self.__post_queue.inc()
+        future = asyncio.run_coroutine_threadsafe(coro, self.client.loop)
+        future.add_done_callback(lambda _: self.__post_queue.dec())
+        return future
@@ -1 +1 @@
-cp *.py /opt/serverbot/
+cp *.py *.rules /opt/serverbot/
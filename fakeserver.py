@@ -0,0 +1,233 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+# Consts
+TICK = 0.01 # Seconds between batches of output when emitting at a fixed rate
+FAST_BATCH = 1000 # Lines per write when emitting as fast as possible
+DONE_MARKER = 'bench done'
+
+# Globals
+out_lock = threading.Lock()
+
+
+class Minecraft:
+    """
+    Output and console commands of a vanilla Minecraft server, close enough for the controller
+    """
+
+    startup = ['Starting minecraft server version 1.20.1',
+               'Loading properties',
+               'Default game type: SURVIVAL',
+               'Starting Minecraft server on *:25565',
+               'Preparing level "world"',
+               'Preparing start region for dimension minecraft:overworld',
+               'Time elapsed: 2345 ms',
+               'Done (3.210s)! For help, type "help"']
+
+
+    @staticmethod
+    def format(text):
+        """
+        Format a line of server output.
+
+        Args:
+            text: The message
+
+        Returns:
+            The log line, with a newline
+        """
+
+        return f'[{time.strftime("%H:%M:%S")}] [Server thread/INFO]: {text}\n'
+
+
+    @staticmethod
+    def command(cmd):
+        """
+        Work out what the server prints for a console command.
+
+        Args:
+            cmd: The command
+
+        Returns:
+            The list of messages to print and whether the server should exit
+        """
+
+        name, _, args = cmd.partition(' ')
+        if name == 'stop':
+            return ['Stopping the server', 'Saving worlds'], True
+        elif name == 'list':
+            return ['There are 0 of a max of 20 players online: '], False
+        elif name == 'save-all':
+            return ['Saving the game (this may take a moment!)', 'Saved the game'], False
+        elif name in ('save-on', 'save-off'):
+            state = 'enabled' if name == 'save-on' else 'disabled'
+            return [f'Automatic saving is now {state}'], False
+        elif name == 'say':
+            return [f'[Server] {args}'], False
+        elif name == 'tellraw':
+            return [], False
+        elif name == 'whitelist':
+            return [f'Whitelist {args}'], False
+        return ['Unknown or incomplete command, see below for error'], False
+
+
+class Terraria:
+    """
+    Output and console commands of a Terraria dedicated server, close enough for the controller
+    """
+
+    startup = ['Terraria Server v1.4.4.9',
+               'Resetting game objects 100%',
+               'Loading world data: 100%',
+               'Settling liquids 100%',
+               'Listening on port 7777',
+               "Type 'help' for a list of commands.",
+               '',
+               ': Server started']
+
+
+    @staticmethod
+    def format(text):
+        """
+        Format a line of server output.
+
+        Args:
+            text: The message
+
+        Returns:
+            The log line, with a newline
+        """
+
+        return f'{text}\n'
+
+
+    @staticmethod
+    def command(cmd):
+        """
+        Work out what the server prints for a console command.
+
+        Args:
+            cmd: The command
+
+        Returns:
+            The list of messages to print and whether the server should exit
+        """
+
+        name, _, args = cmd.partition(' ')
+        if name == 'exit':
+            return ['Saving world data: 100%', 'Validating world save: 100%',
+                    'Backing up world file'], True
+        elif name == 'playing':
+            return ['No players connected.'], False
+        elif name == 'save':
+            return ['Saving world data: 100%', 'Validating world save: 100%',
+                    'Backing up world file'], False
+        elif name == 'say':
+            return [f'<Server> {args}'], False
+        return ['Invalid command.'], False
+
+
+GAMES = {'minecraft': Minecraft, 'terraria': Terraria}
+
+
+def write(text):
+    """
+    Write output without interleaving with the other thread.
+
+    Args:
+        text: The output to write
+    """
+
+    with out_lock:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+
+def console_thread(game):
+    """
+    Answer console commands until told to stop, then exit the whole process.
+
+    Args:
+        game: The game class to act like
+    """
+
+    for cmd in sys.stdin:
+        cmd = cmd.strip()
+        if not cmd:
+            continue
+        msgs, stop = game.command(cmd)
+        write(''.join(game.format(msg) for msg in msgs))
+        if stop:
+            os._exit(0)
+
+    # Console closed. The real servers just sit there, so we do too
+    while True:
+        time.sleep(3600)
+
+
+def emit(game, rate, length, duration):
+    """
+    Print numbered, timestamped log lines so whoever ends up receiving them can work out throughput
+    and latency. Each line is 'bench <seq> <epoch time> <padding>'.
+
+    Args:
+        game:     The game class to act like
+        rate:     Lines per second, or 0 for as fast as possible
+        length:   The length to pad the message part of each line to
+        duration: Seconds to keep emitting for
+
+    Returns:
+        The number of lines printed
+    """
+
+    sent = 0
+    start = time.time()
+    while True:
+        now = time.time()
+        elapsed = now - start
+        if elapsed >= duration:
+            break
+
+        due = int(elapsed * rate) if rate else sent + FAST_BATCH
+        stamp = f'{now:.6f}'
+        batch = []
+        while sent < due:
+            msg = f'bench {sent} {stamp} '
+            batch.append(game.format(msg + 'x' * max(0, length - len(msg))))
+            sent += 1
+        write(''.join(batch))
+
+        if rate:
+            time.sleep(TICK)
+
+    write(game.format(f'{DONE_MARKER} {sent}'))
+    return sent
+
+
+# Main
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Stand-in game server for benchmarking')
+    parser.add_argument('game', choices=sorted(GAMES), help='which server to act like')
+    parser.add_argument('-r', '--rate', type=float, default=1000, help='log lines/sec (0 = max)')
+    parser.add_argument('-l', '--length', type=int, default=100, help='characters per log line')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='seconds of log output')
+    parser.add_argument('--startup-delay', type=float, default=0.5, help='seconds to "load"')
+
+    # Ignore whatever the controller passes the real server (e.g. -jar server.jar nogui)
+    args, _ = parser.parse_known_args()
+    game = GAMES[args.game]
+
+    console = threading.Thread(target=console_thread, args=(game,))
+    console.daemon = True
+    console.start()
+
+    for msg in game.startup:
+        write(game.format(msg))
+        time.sleep(args.startup_delay / len(game.startup))
+
+    emit(game, args.rate, args.length, args.duration)
+    console.join()
@@ -0,0 +1,145 @@
+import os
+import socket
+
+import config
+
+__all__ = ['HEARTBEAT_INTERVAL', 'HEARTBEAT_TIMEOUT', 'LoadSampler', 'score', 'place', 'describe']
+
+# Consts
+HEARTBEAT_MISSES = 3 # Heartbeats a controller can miss before the bot drops its connection
+GIB = 1024 ** 3
+
+# Load Env
+HEARTBEAT_INTERVAL = config.load().get('HEARTBEAT_INTERVAL', float, 5)
+HEARTBEAT_TIMEOUT = HEARTBEAT_INTERVAL * HEARTBEAT_MISSES
+
+
+class LoadSampler:
+    """
+    Measures how busy this host is, for the controller's heartbeats. CPU is measured over the time
+    since the last sample, so sample once per heartbeat.
+    """
+
+    def __init__(self):
+        """
+        Initializes a new LoadSampler, taking the first CPU reading.
+
+        Returns:
+            A newly initialized LoadSampler object
+        """
+
+        self.host = socket.gethostname()
+        self.__last_cpu = _cpu_times()
+
+
+    def sample(self):
+        """
+        Measure the host's free memory and CPU.
+
+        Returns:
+            A dict with the host name, cpus, cpu_free (idle fraction since the last sample),
+            mem_free and mem_total (bytes)
+        """
+
+        idle, total = _cpu_times()
+        last_idle, last_total = self.__last_cpu
+        self.__last_cpu = (idle, total)
+        cpu_free = (idle - last_idle) / (total - last_total) if total > last_total else 1.0
+        mem_free, mem_total = _memory()
+
+        return {'host': self.host,
+                'cpus': os.cpu_count() or 1,
+                'cpu_free': round(cpu_free, 3),
+                'mem_free': mem_free,
+                'mem_total': mem_total}
+
+
+def score(load):
+    """
+    Work out how loaded a host is from its heartbeat. Whichever of CPU and memory is scarcer wins.
+
+    Args:
+        load: The heartbeat payload
+
+    Returns:
+        A number from 0 (idle) to 1 (flat out)
+    """
+
+    mem_used = 1 - load['mem_free'] / load['mem_total'] if load.get('mem_total') else 1
+    return max(1 - load.get('cpu_free', 0), mem_used)
+
+
+def place(candidates, server=None, min_free=0):
+    """
+    Pick the least loaded controller to start a server on. A controller is eligible if it isn't
+    running a server already, has the server, and has enough free memory. Ties go to the one with
+    the most free memory.
+
+    Args:
+        candidates: A list of (key, load) for the controllers with a fresh heartbeat
+        server:     (Optional) The name of the server to start. Defaults to None (any)
+        min_free:   (Optional) The free memory in bytes a host needs. Defaults to 0
+
+    Returns:
+        The (key, load) picked, or None if no controller is eligible
+    """
+
+    eligible = [(key, load) for key, load in candidates
+                if not load.get('running')
+                and (server is None or server in load.get('servers', ()))
+                and load.get('mem_free', 0) >= min_free]
+    return min(eligible, key=lambda c: (score(c[1]), -c[1].get('mem_free', 0)), default=None)
+
+
+def describe(load):
+    """
+    Describe a controller's last heartbeat for the hosts command.
+
+    Args:
+        load: The heartbeat payload
+
+    Returns:
+        A one line summary
+    """
+
+    running = load.get('running')
+    return (f'{load.get("host", "?")}: cpu {load.get("cpu_free", 0) * 100:.0f}% free of '
+            f'{load.get("cpus", "?")}, memory {load.get("mem_free", 0) / GIB:.1f}/'
+            f'{load.get("mem_total", 0) / GIB:.1f} GiB free, servers '
+            f'{", ".join(load.get("servers", ())) or "none"}, '
+            + (f'running {running} ({load.get("players", 0)} online)' if running else 'idle'))
+
+
+def _cpu_times():
+    """
+    Read the total and idle CPU time from /proc/stat.
+
+    Returns:
+        (idle, total) in clock ticks, or (0, 0) if they can't be read
+    """
+
+    try:
+        with open('/proc/stat') as f:
+            fields = [int(field) for field in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return 0, 0
+    return fields[3] + (fields[4] if len(fields) > 4 else 0), sum(fields) # idle + iowait
+
+
+def _memory():
+    """
+    Read the available and total memory from /proc/meminfo.
+
+    Returns:
+        (available, total) in bytes, or (0, 0) if they can't be read
+    """
+
+    info = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                [name, _, value] = line.partition(':')
+                info[name] = int(value.split()[0]) * 1024 # kB
+    except (OSError, ValueError, IndexError):
+        return 0, 0
+    return info.get('MemAvailable', info.get('MemFree', 0)), info.get('MemTotal', 0)
@@ -0,0 +1,209 @@
+import gzip
+import re
+import time
+
+import config
+
+__all__ = ['LogBurst', 'split_msg']
+
+# Consts
+DISCORD_MSG_LEN_MAX = 1990 # Leave a little room for error
+SUMMARY_EXC_LEN_MAX = 200
+ERROR_RE = re.compile(r'/(ERROR|FATAL|SEVERE)\]|\bERROR\b|Exception|\bError:')
+EXCEPTION_RE = re.compile(r'[\w$.]*(Exception|Error)\b.*')
+HINT_RE = re.compile(r'ERROR|FATAL|SEVERE|Exception|Error') # Every line the two above match has one
+
+# Load Env
+CONFIG = config.load()
+LOG_BURST_WINDOW = CONFIG.get('LOG_BURST_WINDOW', float, 2)
+LOG_BURST_ATTACH_SIZE = CONFIG.get('LOG_BURST_ATTACH_SIZE', int, 8192)
+LOG_BURST_MAX_SIZE = CONFIG.get('LOG_BURST_MAX_SIZE', int, 4194304)
+
+
+def split_msg(text, limit=DISCORD_MSG_LEN_MAX):
+    """
+    Split text into as few Discord sized messages as possible. Lines are kept together where they
+    fit and any single line longer than the limit is cut into limit sized pieces so the send can't
+    fail on length.
+
+    Args:
+        text:  The text to split
+        limit: (Optional) The max length of a single message. Defaults to DISCORD_MSG_LEN_MAX
+
+    Returns:
+        A list of non-empty messages
+    """
+
+    msgs = []
+    buf = ''
+    for line in text.splitlines(keepends=True):
+
+        # Hard split any line that can't fit in a message on its own
+        while len(line) > limit:
+            if buf:
+                msgs.append(buf)
+                buf = ''
+            msgs.append(line[:limit])
+            line = line[limit:]
+
+        # Start a new message if this line would overflow the current one
+        if len(buf) + len(line) > limit:
+            msgs.append(buf)
+            buf = ''
+        buf += line
+
+    if buf:
+        msgs.append(buf)
+
+    # Discord rejects empty messages
+    return [msg for msg in msgs if msg.strip()]
+
+
+class LogBurst:
+    """
+    Collects log output headed for a Discord log channel over a short window and posts it in one go.
+    Small bursts get split into regular messages. Bursts over the attach size (crashes, startup
+    spam) get uploaded as a single gzipped text file with a short summary line instead of dozens of
+    messages.
+
+    This isn't thread safe. It's meant to be owned by the single reader thread of a client.
+    """
+
+    def __init__(self,
+                 send,
+                 upload,
+                 name,
+                 window=LOG_BURST_WINDOW,
+                 attach_size=LOG_BURST_ATTACH_SIZE,
+                 max_size=LOG_BURST_MAX_SIZE):
+        """
+        Initializes a new, empty LogBurst.
+
+        Args:
+            send:        Callback taking a single message to post
+            upload:      Callback taking (summary, filename, data) to post a file attachment
+            name:        The name of the game, used in the summary line and filename
+            window:      (Optional) Seconds to collect output before posting it. Defaults to env var
+            attach_size: (Optional) Burst size in characters above which we upload an attachment
+                         instead of sending messages. Defaults to env var
+            max_size:    (Optional) Burst size in characters at which we post immediately, even if
+                         the window hasn't passed, to bound memory. Defaults to env var
+
+        Returns:
+            A newly initialized LogBurst object
+        """
+
+        self.send = send
+        self.upload = upload
+        self.name = name
+        self.window = window
+        self.attach_size = attach_size
+        self.max_size = max_size
+        self.__buf = []
+        self.__size = 0
+        self.__start = None
+
+
+    def add(self, text):
+        """
+        Add some log output to the current burst, posting it if it's grown too large.
+
+        Args:
+            text: The log output to add
+        """
+
+        if not text:
+            return
+
+        if self.__start is None:
+            self.__start = time.monotonic()
+        self.__buf.append(text)
+        self.__size += len(text)
+
+        if self.__size >= self.max_size:
+            self.flush()
+
+
+    @property
+    def size(self):
+        """
+        The number of characters of log output waiting to be posted
+        """
+
+        return self.__size
+
+
+    def timeout(self):
+        """
+        Get how long the reader can wait for more output before the current burst is due.
+
+        Returns:
+            The number of seconds until the burst should be posted, or None if there's nothing
+            buffered (wait forever)
+        """
+
+        if self.__start is None:
+            return None
+        return max(0, self.__start + self.window - time.monotonic())
+
+
+    def take(self):
+        """
+        Take everything buffered so far without posting it, e.g. to hand it to another LogBurst.
+
+        Returns:
+            The buffered log output
+        """
+
+        text = ''.join(self.__buf)
+        self.__buf = []
+        self.__size = 0
+        self.__start = None
+        return text
+
+
+    def flush(self):
+        """
+        Post everything buffered so far, either as chunked messages or as a single attachment
+        depending on the size of the burst.
+        """
+
+        if not self.__buf:
+            return
+
+        size = self.__size
+        text = self.take()
+
+        if size <= self.attach_size:
+            for msg in split_msg(text):
+                self.send(msg)
+            return
+
+        # Too big for messages. Summarize and attach. These can be hundreds of thousands of lines,
+        # so only look closer at the lines a cheap keyword search turns up
+        line_count = text.count('\n') + (not text.endswith('\n'))
+        errors = 0
+        first_exc = None
+        pos = 0
+        while True:
+            hint = HINT_RE.search(text, pos)
+            if not hint:
+                break
+            start = text.rfind('\n', 0, hint.start()) + 1
+            end = text.find('\n', hint.end())
+            end = len(text) if end == -1 else end
+            line = text[start:end]
+            pos = end + 1
+
+            if ERROR_RE.search(line):
+                errors += 1
+            if first_exc is None:
+                match = EXCEPTION_RE.search(line)
+                if match:
+                    first_exc = match.group(0).strip()[:SUMMARY_EXC_LEN_MAX]
+
+        summary = f'{self.name} log burst: {line_count} lines, {errors} errors'
+        if first_exc:
+            summary += f', first exception: `{first_exc}`'
+        filename = f'{self.name.lower()}-{time.strftime("%Y%m%d-%H%M%S")}.log.gz'
+        self.upload(summary[:DISCORD_MSG_LEN_MAX], filename, gzip.compress(str.encode(text)))
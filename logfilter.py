@@ -0,0 +1,230 @@
+import re
+import time
+
+__all__ = ['LogFilter']
+
+# Consts
+ACTIONS = ('drop', 'keep', 'sample', 'dedupe')
+DEDUPE_MASK_RE = re.compile(r'[0-9]+')
+GROUP_REF_RE = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(') # \1 backrefs and (?(1)...)
+GLOBAL_FLAGS_RE = re.compile(r'\(\?([aiLmsux]+)\)') # (?i) and friends
+
+
+class LogFilter:
+    """
+    Filters game output in the controller before it ever gets sent to the client (serverbot). Rules
+    are checked in order and the first one that matches a line decides what happens to it:
+
+        drop <regex>       - never send the line
+        keep <regex>       - always send the line (use before a broader drop to make exceptions)
+        sample <n> <regex> - send only every nth matching line
+        dedupe <regex>     - collapse runs of repeated lines into a single line with a count. Digits
+                             are ignored when comparing so timestamps don't break up a run
+
+    Lines that don't match any rule are sent as-is. All rules are compiled into a single regex so
+    each line only costs one match no matter how many rules there are. That moves each rule's
+    groups, so rules can't use named groups or refer back to groups by number. Flags at the start of
+    a rule like (?i) only apply to that rule.
+
+    A deduped run is held back until a different line comes along. Call expire() regularly so the
+    end of a run still goes out when the server goes quiet.
+    """
+
+    def __init__(self, rules=()):
+        """
+        Initializes a new LogFilter.
+
+        Args:
+            rules: (Optional) A list of (action, arg, pattern) tuples. arg is the sample rate for
+                   sample rules and ignored otherwise. Defaults to no rules (send everything)
+
+        Returns:
+            A newly initialized LogFilter object
+
+        Raises:
+            ValueError: If a rule has an unknown action or a bad regex, or a regex that uses named
+                        groups, numbered backreferences or flags anywhere but the start
+        """
+
+        self.rules = []
+        self.hits = []
+        self.__dedupe_key = None
+        self.__dedupe_line = None
+        self.__dedupe_count = 0
+        self.__dedupe_start = 0
+
+        alts = []
+        for i, (action, arg, pattern) in enumerate(rules):
+            if action not in ACTIONS:
+                raise ValueError(f'Unknown log filter action: {action}')
+            if action == 'sample' and (arg is None or arg < 1):
+                raise ValueError(f'Bad sample rate for log filter rule: {pattern}')
+            # Flags for the whole regex have to come first, so scope leading ones to the rule
+            # (a newline ends a (?x) comment before it can swallow the closing paren)
+            flags = ''
+            body = pattern
+            match = GLOBAL_FLAGS_RE.match(body)
+            while match:
+                flags += match[1]
+                body = body[match.end():]
+                match = GLOBAL_FLAGS_RE.match(body)
+            if flags:
+                body = f'(?{flags}:{body}\n)' if 'x' in flags else f'(?{flags}:{body})'
+            try:
+                compiled = re.compile(body)
+            except re.error as e:
+                raise ValueError(f'Bad log filter regex {pattern}: {e}')
+            if compiled.groupindex or GROUP_REF_RE.search(pattern):
+                raise ValueError(f'Log filter regex {pattern} uses named groups or group '
+                                 'references, which rules can\'t (they share one regex). Use '
+                                 '(?:...) instead')
+            self.rules.append((action, arg, pattern))
+            self.hits.append(0)
+            alts.append(f'(?P<r{i}>.*?(?:{body}))')
+
+        try:
+            self.__matcher = re.compile('|'.join(alts)) if alts else None
+        except re.error as e:
+            raise ValueError(f'Log filter rules don\'t work together: {e}')
+
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load a LogFilter from a rules file. Each non-empty line that isn't a comment (#) is an
+        action, a sample rate for sample rules, and the rest of the line is the regex.
+
+        Args:
+            path: The path to the rules file, or None/empty for no rules
+
+        Returns:
+            A newly initialized LogFilter object
+
+        Raises:
+            ValueError: If a rule can't be parsed
+        """
+
+        rules = []
+        if not path:
+            return cls(rules)
+
+        with open(path) as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+
+                tokens = line.split(None, 1)
+                action = tokens[0]
+                rest = tokens[1] if len(tokens) > 1 else ''
+                arg = None
+                if action == 'sample':
+                    tokens = rest.split(None, 1)
+                    try:
+                        arg = int(tokens[0])
+                    except (IndexError, ValueError):
+                        raise ValueError(f'{path}:{lineno}: sample needs a rate')
+                    rest = tokens[1] if len(tokens) > 1 else ''
+                if not rest:
+                    raise ValueError(f'{path}:{lineno}: missing regex')
+                rules.append((action, arg, rest))
+
+        return cls(rules)
+
+
+    def filter(self, line):
+        """
+        Run a line of game output through the rules.
+
+        Args:
+            line: The line to filter
+
+        Returns:
+            A list of lines to send, in order. This may be empty if the line was dropped, or contain
+            an extra summary line if the line ended a deduped run
+        """
+
+        text = line.rstrip('\r\n')
+        match = self.__matcher.match(text) if self.__matcher else None
+        out = []
+
+        if match is None:
+            out.extend(self.flush())
+            out.append(text + '\n')
+            return out
+
+        i = int(match.lastgroup[1:])
+        action, arg, _ = self.rules[i]
+        self.hits[i] += 1
+
+        if action == 'dedupe':
+            key = DEDUPE_MASK_RE.sub('#', text)
+            if key == self.__dedupe_key:
+                self.__dedupe_count += 1
+                return out
+            out.extend(self.flush())
+            self.__dedupe_key = key
+            self.__dedupe_line = text
+            self.__dedupe_count = 1
+            self.__dedupe_start = time.monotonic()
+            return out
+
+        out.extend(self.flush())
+        if action == 'keep' or (action == 'sample' and self.hits[i] % arg == 1 % arg):
+            out.append(text + '\n')
+        return out
+
+
+    def flush(self):
+        """
+        End the current deduped run, if any.
+
+        Returns:
+            A list with the summary line for the run, or an empty list if there wasn't one
+        """
+
+        if self.__dedupe_key is None:
+            return []
+
+        line = self.__dedupe_line
+        if self.__dedupe_count > 1:
+            line += f' (×{self.__dedupe_count})'
+        self.__dedupe_key = None
+        self.__dedupe_line = None
+        self.__dedupe_count = 0
+        return [line + '\n']
+
+
+    def expire(self, max_age):
+        """
+        End the current deduped run if it has been held back for too long, so the last line of a
+        burst doesn't wait forever on a quiet server. A run that's still going just starts over.
+
+        Args:
+            max_age: Max seconds to hold a run for (e.g. the log burst window)
+
+        Returns:
+            A list with the summary line for the run, or an empty list if there wasn't one due
+        """
+
+        if self.__dedupe_key is None or time.monotonic() - self.__dedupe_start < max_age:
+            return []
+        return self.flush()
+
+
+    def stats(self):
+        """
+        Get a printable summary of how many lines each rule has matched.
+
+        Returns:
+            The per-rule hit counters, one rule per line
+        """
+
+        if not self.rules:
+            return 'No log filter rules loaded'
+
+        lines = []
+        for (action, arg, pattern), hits in zip(self.rules, self.hits):
+            rule = f'{action} {arg} {pattern}' if action == 'sample' else f'{action} {pattern}'
+            lines.append(f'{hits:>8} {rule}')
+        return '\n'.join(lines)
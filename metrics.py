@@ -0,0 +1,384 @@
+import bisect
+import http.server
+import math
+import threading
+
+import config
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Registry', 'REGISTRY', 'counter', 'gauge', 'histogram',
+           'serve']
+
+# Consts
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Load Env
+METRICS_HOST = config.load().get('METRICS_HOST', default='localhost')
+
+
+class Counter:
+    """
+    A number that only goes up, e.g. lines read. Increment it once per batch rather than once per
+    item on hot paths. A counter that's already kept somewhere else can be given a function to
+    read it with at scrape time instead.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, func=None):
+        """
+        Initializes a new Counter at zero.
+
+        Args:
+            func: (Optional) Called with no args to get the value at scrape time. Defaults to None
+                  (use the counted value)
+
+        Returns:
+            A newly initialized Counter object
+        """
+
+        self.value = 0
+        self.func = func
+        self.__lock = threading.Lock()
+
+
+    def inc(self, amount=1):
+        """
+        Add to the counter.
+
+        Args:
+            amount: (Optional) How much to add. Defaults to 1
+        """
+
+        with self.__lock:
+            self.value += amount
+
+
+    def samples(self):
+        """
+        Get the values to expose. A broken function shows up as NaN rather than breaking the scrape.
+
+        Returns:
+            A list of (name suffix, extra labels, value)
+        """
+
+        if self.func is None:
+            return [('', {}, self.value)]
+        try:
+            return [('', {}, self.func())]
+        except Exception:
+            return [('', {}, math.nan)]
+
+
+class Gauge(Counter):
+    """
+    A number that goes up and down, e.g. players online. Either set it, or give it a function to
+    call when it's scraped so nothing has to keep it up to date.
+    """
+
+    kind = 'gauge'
+
+    def set(self, value):
+        """
+        Set the gauge.
+
+        Args:
+            value: The new value
+        """
+
+        self.value = value
+
+
+    def dec(self, amount=1):
+        """
+        Subtract from the gauge.
+
+        Args:
+            amount: (Optional) How much to subtract. Defaults to 1
+        """
+
+        self.inc(-amount)
+
+
+class Histogram:
+    """
+    Counts of observations (usually seconds) in fixed buckets, plus their sum and count
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Initializes a new, empty Histogram.
+
+        Args:
+            buckets: (Optional) The sorted upper bounds of the buckets. Defaults to LATENCY_BUCKETS
+
+        Returns:
+            A newly initialized Histogram object
+        """
+
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # The last one is +Inf
+        self.sum = 0
+        self.__lock = threading.Lock()
+
+
+    def observe(self, value):
+        """
+        Record an observation.
+
+        Args:
+            value: The value to record
+        """
+
+        i = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+    def samples(self):
+        """
+        Get the values to expose. Buckets are cumulative.
+
+        Returns:
+            A list of (name suffix, extra labels, value)
+        """
+
+        with self.__lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append(('_bucket', {'le': _format_value(bound)}, cumulative))
+        samples.append(('_sum', {}, total))
+        samples.append(('_count', {}, cumulative))
+        return samples
+
+
+class Registry:
+    """
+    All the metrics of one process, exposed in the Prometheus text format. Asking for a metric that
+    already exists (same name and labels) returns the existing one, so code that gets reloaded or
+    re-created (e.g. plugin clients) keeps counting where it left off.
+    """
+
+    def __init__(self):
+        """
+        Initializes a new, empty Registry.
+
+        Returns:
+            A newly initialized Registry object
+        """
+
+        self.__families = {} # name -> [kind, help, {sorted label items: metric}]
+        self.__lock = threading.Lock()
+
+
+    def counter(self, name, help, func=None, **labels):
+        """
+        Get or create a counter. If a function is given it replaces any previous one, so a new
+        object can take over the counter from the one it replaces.
+
+        Args:
+            name:   The metric name
+            help:   What it counts
+            func:   (Optional) Called to get the value at scrape time. Defaults to None
+            labels: Label values for this instance
+
+        Returns:
+            The Counter
+        """
+
+        metric = self.__get(Counter, name, help, labels)
+        if func is not None:
+            metric.func = func
+        return metric
+
+
+    def gauge(self, name, help, func=None, **labels):
+        """
+        Get or create a gauge. If a function is given it replaces any previous one, as for
+        counter().
+
+        Args:
+            name:   The metric name
+            help:   What it measures
+            func:   (Optional) Called to get the value at scrape time. Defaults to None
+            labels: Label values for this instance
+
+        Returns:
+            The Gauge
+        """
+
+        metric = self.__get(Gauge, name, help, labels)
+        if func is not None:
+            metric.func = func
+        return metric
+
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Get or create a histogram.
+
+        Args:
+            name:    The metric name
+            help:    What it measures
+            buckets: (Optional) The bucket upper bounds. Defaults to LATENCY_BUCKETS
+            labels:  Label values for this instance
+
+        Returns:
+            The Histogram
+        """
+
+        return self.__get(lambda: Histogram(buckets), name, help, labels, Histogram.kind)
+
+
+    def expose(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+            The exposition text
+        """
+
+        with self.__lock:
+            families = [(name, kind, help, list(metrics.items()))
+                        for name, (kind, help, metrics) in sorted(self.__families.items())]
+
+        lines = []
+        for name, kind, help, metrics in families:
+            lines.append(f'# HELP {name} {_escape(help, False)}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, metric in metrics:
+                for suffix, extra, value in metric.samples():
+                    lines.append(f'{name}{suffix}{_format_labels(labels + tuple(extra.items()))} '
+                                 f'{_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+    def __get(self, factory, name, help, labels, kind=None):
+        """
+        Get a metric, creating it (and its family) if needed.
+
+        Args:
+            factory: Makes a new metric
+            name:    The metric name
+            help:    The help text for the family
+            labels:  The dict of label values
+            kind:    (Optional) The metric type. Defaults to factory.kind
+
+        Returns:
+            The metric
+
+        Raises:
+            ValueError: If the name is already used by a different type of metric
+        """
+
+        kind = kind or factory.kind
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            family = self.__families.setdefault(name, [kind, help, {}])
+            if family[0] != kind:
+                raise ValueError(f'Metric {name} is a {family[0]}, not a {kind}')
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+            return metric
+
+
+# The shared registry for the process
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def serve(port, host=METRICS_HOST, registry=REGISTRY):
+    """
+    Serve the metrics over HTTP on a daemon thread. Any path returns them.
+
+    Args:
+        port:     The port to listen on
+        host:     (Optional) The address to listen on. Defaults to env var (localhost)
+        registry: (Optional) The registry to expose. Defaults to REGISTRY
+
+    Returns:
+        The running http.server.ThreadingHTTPServer
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = registry.expose().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+        def log_message(self, format, *args):
+            pass # Don't spam stderr once a scrape
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _escape(text, quotes=True):
+    """
+    Escape text for the exposition format.
+
+    Args:
+        text:   The text to escape
+        quotes: (Optional) Whether to escape double quotes too (label values). Defaults to True
+
+    Returns:
+        The escaped text
+    """
+
+    text = str(text).replace('\\', '\\\\').replace('\n', '\\n')
+    return text.replace('"', '\\"') if quotes else text
+
+
+def _format_labels(labels):
+    """
+    Format a label set.
+
+    Args:
+        labels: A sequence of (name, value) pairs
+
+    Returns:
+        '{name="value",...}', or an empty string for no labels
+    """
+
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    """
+    Format a sample value.
+
+    Args:
+        value: The number
+
+    Returns:
+        The number as the exposition format wants it
+    """
+
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+    return repr(value) if isinstance(value, float) else str(int(value))
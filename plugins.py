@@ -0,0 +1,177 @@
+import importlib
+import importlib.util
+import sys
+import time
+
+import config
+from controllerclient import ControllerClient
+
+__all__ = ['Plugin', 'load', 'load_enabled', 'reload', 'revert', 'stats']
+
+# Globals
+plugins = {}  # module name -> Plugin, for everything loaded so far
+failures = {} # module name -> why it didn't load
+
+
+class Plugin:
+    """
+    A loaded game plugin. A plugin is any module with a CLIENT_CLASS attribute holding its
+    ControllerClient subclass. Plugins are only imported if they're enabled in the PLUGINS setting.
+    """
+
+    def __init__(self, name, module, import_time):
+        """
+        Initializes a new Plugin record.
+
+        Args:
+            name:        The module name of the plugin
+            module:      The imported module
+            import_time: Seconds it took to import the module
+
+        Returns:
+            A newly initialized Plugin object
+        """
+
+        self.name = name
+        self.module = module
+        self.client_class = module.CLIENT_CLASS
+        self.import_time = import_time
+        self.init_time = None # Set once the client is created
+        self.previous = None  # (module, client_class, import_time) from before the last reload
+
+
+def load(name):
+    """
+    Import a plugin and add it to the registry, timing the import.
+
+    Args:
+        name: The module name of the plugin
+
+    Returns:
+        The Plugin
+
+    Raises:
+        ImportError:        If the module can't be imported or isn't a plugin
+        config.ConfigError: If the plugin's settings are missing or bad
+    """
+
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    import_time = time.perf_counter() - start
+
+    client_class = getattr(module, 'CLIENT_CLASS', None)
+    if not (isinstance(client_class, type) and issubclass(client_class, ControllerClient)):
+        raise ImportError(f'{name} has no CLIENT_CLASS')
+
+    plugin = Plugin(name, module, import_time)
+    plugins[name] = plugin
+    failures.pop(name, None)
+    return plugin
+
+
+def reload(name):
+    """
+    Re-import an already loaded plugin, e.g. after deploying a fix. The new code goes into a fresh
+    module, so the old one keeps working for the clients made from it and revert() can go back to
+    it. The registry entry is updated to the new module and client class. Existing clients are
+    left alone, it's up to the caller to replace them.
+
+    Args:
+        name: The module name of the plugin
+
+    Returns:
+        The updated Plugin
+
+    Raises:
+        KeyError:  If the plugin isn't loaded
+        Exception: Whatever the new code raises while importing. The registry isn't updated
+    """
+
+    plugin = plugins[name]
+    plugin.previous = None
+
+    start = time.perf_counter()
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f'{name} is gone')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    import_time = time.perf_counter() - start
+
+    client_class = getattr(module, 'CLIENT_CLASS', None)
+    if not (isinstance(client_class, type) and issubclass(client_class, ControllerClient)):
+        raise ImportError(f'{name} has no CLIENT_CLASS')
+
+    plugin.previous = (plugin.module, plugin.client_class, plugin.import_time)
+    sys.modules[name] = module
+    plugin.module = module
+    plugin.client_class = client_class
+    plugin.import_time = import_time
+    return plugin
+
+
+def revert(name):
+    """
+    Go back to the code a plugin had before its last reload(), e.g. because the new client failed
+    to start. Does nothing if the last reload() didn't get as far as updating the registry.
+
+    Args:
+        name: The module name of the plugin
+
+    Returns:
+        The Plugin
+
+    Raises:
+        KeyError: If the plugin isn't loaded
+    """
+
+    plugin = plugins[name]
+    if plugin.previous is not None:
+        plugin.module, plugin.client_class, plugin.import_time = plugin.previous
+        sys.modules[name] = plugin.module
+        plugin.previous = None
+    return plugin
+
+
+def load_enabled(cfg=None):
+    """
+    Load every plugin enabled in the PLUGINS setting. Plugins that fail to load are reported and
+    skipped so one broken game doesn't keep the bot from starting.
+
+    Args:
+        cfg: (Optional) The Config to read PLUGINS from. Defaults to the shared one
+
+    Returns:
+        The list of loaded Plugins, in the order they're listed in PLUGINS
+    """
+
+    cfg = cfg or config.load()
+    loaded = []
+    for name in cfg.plugins:
+        if name in plugins:
+            loaded.append(plugins[name])
+            continue
+        try:
+            loaded.append(load(name))
+        except (ImportError, config.ConfigError) as e:
+            print(f'plugins: Failed to load {name}: {e}')
+            failures[name] = str(e)
+    return loaded
+
+
+def stats():
+    """
+    Describe the loaded plugins and how long they took to import and start.
+
+    Returns:
+        A printable summary, one line per plugin
+    """
+
+    lines = []
+    for name, plugin in plugins.items():
+        init = f'{plugin.init_time * 1000:.1f}ms' if plugin.init_time is not None else 'not started'
+        lines.append(f'{name} ({plugin.client_class.name}): import {plugin.import_time * 1000:.1f}ms, '
+                     f'init {init}')
+    for name, error in failures.items():
+        lines.append(f'{name}: failed to load: {error}')
+    return '\n'.join(lines) or 'No plugins loaded'
@@ -0,0 +1,297 @@
+import json
+import os
+import subprocess as sp
+import time
+
+from procreader import LineReader
+
+__all__ = ['HeldProcess']
+
+# Consts
+STDIN_FIFO = 'stdin'
+CONSOLE_LOG = 'console.log'
+STATE_FILE = 'state.json'
+OFFSET_SAVE_INTERVAL = 1 # Max seconds between saving how far we've read
+CONSOLE_LOG_MAX = 64 * 1024 * 1024 # Empty the console log once we've read this much of it
+
+
+class HeldProcess:
+    """
+    A game server process that can outlive its controller. Instead of pipes owned by the controller,
+    the server gets its own session, reads its console from a named FIFO and writes its output to a
+    log file, all kept in a state directory along with a state file (pid and how far into the log
+    we've read). If the controller restarts, the new one adopts the server from the state file and
+    picks up reading the log where the old one left off. The log is emptied every CONSOLE_LOG_MAX
+    bytes once everything in it has been read, so a server that runs for months doesn't fill the disk.
+
+    The server opens the FIFO read/write itself, so it never sees EOF on its console while no
+    controller is around. It looks enough like a Popen (poll(), pid, stdin) for the controllers.
+    """
+
+    def __init__(self, pid, start, state_dir, popen=None, offset=0):
+        """
+        Initializes a new HeldProcess. Use launch() or adopt() instead of calling this directly.
+
+        Args:
+            pid:       The process id of the server
+            start:     The start time of the process from /proc, to spot a reused pid
+            state_dir: The state directory holding the FIFO, log and state file
+            popen:     (Optional) The Popen object if we launched the process. Defaults to None
+            offset:    (Optional) How far into the log we've already read. Defaults to 0
+
+        Returns:
+            A newly initialized HeldProcess object
+
+        Raises:
+            OSError: If the server doesn't have its console FIFO open (it exited)
+        """
+
+        self.pid = pid
+        self.start = start
+        self.state_dir = state_dir
+        self.popen = popen
+        self.offset = offset
+        self.__saved = 0
+        self.__saved_offset = None
+
+        # Don't block forever if the server is already gone and nothing has the FIFO open
+        fd = os.open(os.path.join(state_dir, STDIN_FIFO), os.O_WRONLY | os.O_NONBLOCK)
+        os.set_blocking(fd, True)
+        self.stdin = os.fdopen(fd, 'wb')
+
+
+    @classmethod
+    def launch(cls, args, cwd, state_dir):
+        """
+        Start a new held server process. Any old console log is thrown away.
+
+        Args:
+            args:      The command line to run
+            cwd:       The directory to run it in
+            state_dir: The state directory to use. Created if it doesn't exist
+
+        Returns:
+            The HeldProcess for the new server
+        """
+
+        os.makedirs(state_dir, exist_ok=True)
+        fifo = os.path.join(state_dir, STDIN_FIFO)
+        if not os.path.exists(fifo):
+            os.mkfifo(fifo, 0o600)
+
+        stdin_fd = os.open(fifo, os.O_RDWR)
+        stdout_fd = os.open(os.path.join(state_dir, CONSOLE_LOG),
+                            os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        try:
+            popen = sp.Popen(args,
+                             stdin=stdin_fd,
+                             stdout=stdout_fd,
+                             stderr=sp.STDOUT,
+                             cwd=cwd,
+                             start_new_session=True)
+        finally:
+            os.close(stdin_fd)
+            os.close(stdout_fd)
+
+        # Take over the state file, even if an old server's reader hasn't let go of it yet
+        held = cls(popen.pid, _start_time(popen.pid), state_dir, popen=popen)
+        held.__write_state(0)
+        return held
+
+
+    @classmethod
+    def adopt(cls, state_dir):
+        """
+        Pick up a server left running by a previous controller.
+
+        Args:
+            state_dir: The state directory the server was launched with
+
+        Returns:
+            The HeldProcess for the server, or None if there isn't one running
+        """
+
+        path = os.path.join(state_dir, STATE_FILE)
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            pid, start, offset = state['pid'], state['start'], state['offset']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        # Make sure it's still the same process and not just a reused pid
+        if _start_time(pid) != start:
+            os.remove(path)
+            return None
+
+        try:
+            return cls(pid, start, state_dir, offset=offset)
+        except OSError:
+            return None
+
+
+    def output(self):
+        """
+        Open the server's console log for reading, starting where we left off.
+
+        Returns:
+            A LineReader that follows the log until the server exits
+        """
+
+        fd = os.open(os.path.join(self.state_dir, CONSOLE_LOG), os.O_RDONLY)
+
+        # Past the end means the log was emptied before the offset was saved, so start over
+        if self.offset > os.fstat(fd).st_size:
+            self.offset = 0
+        os.lseek(fd, self.offset, os.SEEK_SET)
+        return LineReader(fd, follow=lambda: self.poll() is None, offset=self.offset)
+
+
+    def poll(self):
+        """
+        Check if the server process has exited.
+
+        Returns:
+            None if it's still running, otherwise its exit code (-1 if it wasn't our child so we
+            can't know)
+        """
+
+        if self.popen is not None:
+            return self.popen.poll()
+        return None if _start_time(self.pid) == self.start else -1
+
+
+    def uptime(self):
+        """
+        Get how long the server has been running.
+
+        Returns:
+            The number of seconds since the server process started
+        """
+
+        with open('/proc/uptime') as f:
+            booted = float(f.read().split()[0])
+        return booted - self.start / os.sysconf('SC_CLK_TCK')
+
+
+    def save_offset(self, offset, force=False):
+        """
+        Record how far into the log we've read (and sent on) so a new controller can resume from
+        there. To keep this cheap it's only written out when it changed, at most every so often,
+        unless forced. Nothing is written once another server has been launched with the same state
+        directory, so a reader finishing off an old server can't clobber the new one's state.
+
+        Args:
+            offset: The log offset we've handled everything up to
+            force:  (Optional) Write it out now. Defaults to False
+        """
+
+        self.offset = offset
+        now = time.monotonic()
+        if not force and (offset == self.__saved_offset or
+                          now - self.__saved < OFFSET_SAVE_INTERVAL):
+            return
+        self.__saved = now
+        self.__saved_offset = offset
+
+        if _state_pid(self.state_dir) in (None, self.pid):
+            self.__write_state(offset)
+
+
+    def checkpoint(self, reader):
+        """
+        Record how far the reader has got (see save_offset()). If it has read more than
+        CONSOLE_LOG_MAX and caught up with the server, empty the log and start both over from 0. The
+        server's output is opened for appending, so it carries on at the new end of the file. Only
+        output written in the instant between checking the size and truncating could be lost. A
+        server that's been replaced never empties the log, since it belongs to the new one now.
+
+        Args:
+            reader: The LineReader from output()
+        """
+
+        offset = reader.consumed
+        path = os.path.join(self.state_dir, CONSOLE_LOG)
+        if (offset >= CONSOLE_LOG_MAX and os.fstat(reader.fd).st_size == offset
+                and _state_pid(self.state_dir) == self.pid):
+            os.truncate(path, 0)
+            reader.rewind()
+            self.save_offset(0, force=True)
+        else:
+            self.save_offset(offset)
+
+
+    def close(self):
+        """
+        Clean up after the server has exited. The state file is removed unless another server has
+        been launched with the same state directory since.
+        """
+
+        try:
+            self.stdin.close()
+        except OSError:
+            pass
+
+        if _state_pid(self.state_dir) != self.pid:
+            return
+        try:
+            os.remove(os.path.join(self.state_dir, STATE_FILE))
+        except OSError:
+            pass
+
+
+    def __write_state(self, offset):
+        """
+        Write out the state file for this server.
+
+        Args:
+            offset: The log offset we've handled everything up to
+        """
+
+        path = os.path.join(self.state_dir, STATE_FILE)
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'pid': self.pid, 'start': self.start, 'offset': offset}, f)
+        os.replace(tmp, path)
+
+
+def _state_pid(state_dir):
+    """
+    Get which server a state directory's state file belongs to.
+
+    Args:
+        state_dir: The state directory
+
+    Returns:
+        The pid in the state file, or None if there isn't a readable one
+    """
+
+    try:
+        with open(os.path.join(state_dir, STATE_FILE)) as f:
+            return json.load(f).get('pid')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _start_time(pid):
+    """
+    Get when a process started, in clock ticks since boot.
+
+    Args:
+        pid: The process id
+
+    Returns:
+        The start time, or None if there's no such process
+    """
+
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+
+    # The command name can have spaces and parens in it, so skip past the last paren
+    fields = stat[stat.rindex(')') + 2:].split()
+    if fields[0] == 'Z':
+        return None # Zombie. It's dead, just not reaped yet
+    return int(fields[19])
@@ -0,0 +1,140 @@
+import os
+import re
+import select
+import time
+
+__all__ = ['LineReader']
+
+# Consts
+CHUNK_SIZE = 65536
+PARTIAL_LINE_MAX = 1048576 # Give up waiting for a newline after this much
+FOLLOW_INTERVAL = 0.05 # Seconds between checks for new output when following a file
+LINE_END_RE = re.compile(r'(?<=\n)') # Only \n ends a line, like readline()
+
+
+class LineReader:
+    """
+    Reads lines from a game process's stdout in big chunks instead of one readline() at a time. Each
+    read grabs whatever is available (up to the chunk size), splits off all complete lines at once
+    and keeps any partial line around for the next read. Bad UTF-8 gets replaced instead of blowing
+    up the reader.
+
+    This only works on things select() can wait on (pipes, ptys, sockets, regular files), so it's
+    Linux-only just like the rest of the controller. A regular file that's still being written (a
+    console log) can be followed like tail -f by passing a follow callback.
+    """
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE, follow=None, offset=0):
+        """
+        Initializes a new LineReader and puts the stream in non-blocking mode.
+
+        Args:
+            stream:     The file object or file descriptor to read from (usually proc.stdout)
+            chunk_size: (Optional) The max number of bytes to read at once. Defaults to CHUNK_SIZE
+            follow:     (Optional) For files, a callback returning whether more output can still be
+                        written (e.g. the process is alive). Hitting the end of the file only counts
+                        as EOF once this returns False. Defaults to None (EOF right away)
+            offset:     (Optional) Where in the stream reading starts, for the consumed count.
+                        Defaults to 0
+
+        Returns:
+            A newly initialized LineReader object
+        """
+
+        self.fd = stream if isinstance(stream, int) else stream.fileno()
+        self.chunk_size = chunk_size
+        self.follow = follow
+        self.eof = False
+        self.__buf = bytearray()
+        self.__read = offset
+        os.set_blocking(self.fd, False)
+
+
+    @property
+    def consumed(self):
+        """
+        The offset in the stream up to which lines have been handed out by read()
+        """
+
+        return self.__read - len(self.__buf)
+
+
+    def rewind(self):
+        """
+        Go back to the start of the stream, e.g. after a file we're following was truncated.
+        Anything buffered is dropped.
+        """
+
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        self.__buf.clear()
+        self.__read = 0
+
+
+    def read(self, timeout=None):
+        """
+        Wait for output and return all the complete lines that are available.
+
+        Args:
+            timeout: (Optional) The max number of seconds to wait for output. Defaults to None
+                     (wait forever)
+
+        Returns:
+            A list of decoded lines, each ending in a newline except possibly the last line before
+            EOF. The list is empty if nothing complete came in before the timeout or we hit EOF (check
+            the eof member to tell the difference)
+        """
+
+        if self.eof:
+            return []
+
+        # Wait for something to read
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except (OSError, ValueError):
+            ready = [self.fd] # Closed fd. Let the read below report EOF
+        if not ready:
+            return []
+
+        # Check before reading so output written just before the process exits isn't missed
+        following = self.follow is not None and self.follow()
+
+        try:
+            data = os.read(self.fd, self.chunk_size)
+        except BlockingIOError:
+            return []
+        except OSError:
+            data = b''
+
+        buf = self.__buf
+
+        # End of a file that's still being written. Wait a bit for more instead of spinning
+        if not data and following:
+            time.sleep(FOLLOW_INTERVAL if timeout is None else min(timeout, FOLLOW_INTERVAL))
+            return []
+
+        # EOF. Hand back whatever partial line we were holding onto
+        if not data:
+            self.eof = True
+            tail = bytes(buf)
+            buf.clear()
+            return [tail.decode('utf-8', 'replace')] if tail else []
+
+        buf += data
+        self.__read += len(data)
+
+        # Only decode up to the last newline. A newline byte is never part of a multibyte UTF-8
+        # character so this can't cut one in half
+        end = buf.rfind(b'\n') + 1
+        if not end:
+            if len(buf) < PARTIAL_LINE_MAX:
+                return []
+            end = len(buf)
+
+        # Not splitlines(). That also splits on \r, \x1c, \u2028 and so on, which players can put in
+        # chat to make the rest of their message look like a line of server output
+        text = buf[:end].decode('utf-8', 'replace')
+        del buf[:end]
+        lines = LINE_END_RE.split(text)
+        if not lines[-1]:
+            lines.pop()
+        return lines
@@ -0,0 +1,263 @@
+import collections
+import concurrent.futures as cf
+import re
+import threading
+import time
+
+import config
+
+__all__ = ['CommandWriter']
+
+# Load Env
+CONFIG = config.load()
+CMD_RATE = CONFIG.get('CMD_RATE', float, 10)
+CMD_BURST = CONFIG.get('CMD_BURST', int, 20)
+CMD_ACK_TIMEOUT = CONFIG.get('CMD_ACK_TIMEOUT', float, 10)
+
+
+class CommandWriter:
+    """
+    Owns the stdin of a game process. Everything that wants to send the server a command goes
+    through submit() so writes from different threads can't interleave. A single writer thread
+    drains the queue, writing everything that's pending in one write/flush, while keeping to an
+    overall commands per second limit plus optional minimum intervals for specific commands.
+
+    submit() returns a Future. If an ack regex was given, the Future completes with the first log
+    line matching it (fed in by the reader thread through feed()), otherwise as soon as the command
+    is written. For commands that answer over several lines, a collect regex gathers the matching
+    lines seen before the ack too.
+    """
+
+    def __init__(self,
+                 stream,
+                 rate=CMD_RATE,
+                 burst=CMD_BURST,
+                 intervals=None,
+                 ack_timeout=CMD_ACK_TIMEOUT):
+        """
+        Initializes a new CommandWriter and starts its writer thread.
+
+        Args:
+            stream:      The binary stream to write commands to (usually proc.stdin)
+            rate:        (Optional) The max commands per second. Defaults to env var
+            burst:       (Optional) How many commands can go out at once before the rate kicks in.
+                         Defaults to env var
+            intervals:   (Optional) A dict of command name (first word) to the min number of
+                         seconds between two of those commands. Defaults to no limits
+            ack_timeout: (Optional) Seconds to wait for an ack before failing the Future with a
+                         TimeoutError. Defaults to env var
+
+        Returns:
+            A newly initialized CommandWriter object
+        """
+
+        self.stream = stream
+        self.rate = rate
+        self.burst = burst
+        self.intervals = intervals or {}
+        self.ack_timeout = ack_timeout
+        self.closed = False
+        self.__queue = collections.deque()
+        self.__acks = []
+        self.__tokens = float(burst)
+        self.__refilled = time.monotonic()
+        self.__next_ok = {}
+        self.__cond = threading.Condition()
+
+        writer = threading.Thread(target=self.__write_thread)
+        writer.daemon = True
+        writer.start()
+
+
+    def submit(self, cmd, ack=None, collect=None):
+        """
+        Queue a command for the game process.
+
+        Args:
+            cmd:     The command to send, without a trailing newline
+            ack:     (Optional) A regex (string or compiled) matching the log line that confirms the
+                     command worked. Defaults to None (done once written)
+            collect: (Optional) A regex (string or compiled) matching the lines of the answer that
+                     come before the ack. Only used with ack. Defaults to None
+
+        Returns:
+            A Future for the command, with the ack line (or the list of collected lines followed by
+            the ack line, if collect is set). Fails with OSError if the writer is closed or the
+            write fails
+        """
+
+        future = cf.Future()
+        if isinstance(ack, str):
+            ack = re.compile(ack)
+        if isinstance(collect, str):
+            collect = re.compile(collect)
+        if ack is not None and collect is not None:
+            ack = (ack, collect, [])
+
+        with self.__cond:
+            if self.closed:
+                future.set_exception(OSError('Command writer is closed'))
+                return future
+            self.__queue.append((cmd.replace('\n', ''), ack, future))
+            self.__cond.notify()
+
+        return future
+
+
+    @property
+    def queued(self):
+        """
+        The number of commands waiting to be written
+        """
+
+        return len(self.__queue)
+
+
+    def feed(self, lines):
+        """
+        Check a batch of log lines against the acks we're waiting for. This is called from the
+        reader thread for every batch, so it's a no-op when nothing is waiting.
+
+        Args:
+            lines: The list of lines read from the game process
+        """
+
+        if not self.__acks:
+            return
+
+        with self.__cond:
+            self.__expire_acks()
+            for line in lines:
+                for i, (ack, future, _) in enumerate(self.__acks):
+                    if isinstance(ack, tuple):
+                        [ack, collect, collected] = ack
+                        if ack.search(line):
+                            del self.__acks[i]
+                            _resolve(future, result=collected + [line])
+                            break
+                        if collect.search(line):
+                            collected.append(line)
+                            break
+                    elif ack.search(line):
+                        del self.__acks[i]
+                        _resolve(future, result=line)
+                        break
+                if not self.__acks:
+                    break
+
+
+    def close(self):
+        """
+        Stop the writer. Anything still queued or waiting for an ack fails with an OSError.
+        """
+
+        with self.__cond:
+            self.closed = True
+            pending = [future for _, _, future in self.__queue]
+            pending += [future for _, future, _ in self.__acks]
+            self.__queue.clear()
+            self.__acks = []
+            self.__cond.notify()
+
+        for future in pending:
+            _resolve(future, exc=OSError('Command writer closed'))
+
+
+    def __expire_acks(self):
+        """
+        Fail any acks we've been waiting on for too long. Must hold the lock.
+        """
+
+        now = time.monotonic()
+        while self.__acks and self.__acks[0][2] <= now:
+            _, future, _ = self.__acks.pop(0)
+            _resolve(future, exc=TimeoutError('No acknowledgement from the server'))
+
+
+    def __take_batch(self):
+        """
+        Pull as many commands off the front of the queue as the rate limits allow. Order is kept, so
+        a rate limited command holds up everything behind it. Must hold the lock.
+
+        Returns:
+            The list of commands to write now and the number of seconds until the next one can go
+            (None if the queue is empty)
+        """
+
+        now = time.monotonic()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__refilled) * self.rate)
+        self.__refilled = now
+
+        batch = []
+        while self.__queue:
+            cmd, ack, future = self.__queue[0]
+            name = cmd.split(None, 1)[0] if cmd.strip() else ''
+
+            wait = self.__next_ok.get(name, 0) - now
+            if self.__tokens < 1:
+                wait = max(wait, (1 - self.__tokens) / self.rate)
+            if wait > 0:
+                return batch, wait
+
+            self.__queue.popleft()
+            self.__tokens -= 1
+            if name in self.intervals:
+                self.__next_ok[name] = now + self.intervals[name]
+            if ack is not None:
+                self.__acks.append((ack, future, now + self.ack_timeout))
+            batch.append((cmd, ack, future))
+
+        return batch, None
+
+
+    def __write_thread(self):
+        """
+        Writer thread. Waits for commands and writes them out in batches until closed.
+        """
+
+        while True:
+            with self.__cond:
+                batch, wait = self.__take_batch()
+                while not batch and not self.closed:
+                    if self.__acks:
+                        ack_wait = self.__acks[0][2] - time.monotonic()
+                        wait = ack_wait if wait is None else min(wait, ack_wait)
+                    self.__cond.wait(wait)
+                    self.__expire_acks()
+                    batch, wait = self.__take_batch()
+                if self.closed:
+                    break
+
+            # Write outside the lock so submit() never waits on the pipe
+            try:
+                self.stream.write(str.encode(''.join(f'{cmd}\n' for cmd, _, _ in batch)))
+                self.stream.flush()
+            except (OSError, ValueError) as e:
+                print(f'writer: Write failed: {e}')
+                for _, _, future in batch:
+                    _resolve(future, exc=OSError(f'Write failed: {e}'))
+                self.close()
+                break
+
+            for _, ack, future in batch:
+                if ack is None:
+                    _resolve(future, result=True)
+
+
+def _resolve(future, result=None, exc=None):
+    """
+    Complete a Future unless something else already did.
+
+    Args:
+        future: The Future to complete
+        result: (Optional) The result to set. Defaults to None
+        exc:    (Optional) The exception to set instead of a result. Defaults to None
+    """
+
+    try:
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+    except cf.InvalidStateError:
+        pass
@@ -0,0 +1,625 @@
+import datetime as dt
+import heapq
+import json
+import os
+import re
+import threading
+import time
+
+import config
+
+__all__ = ['Job', 'Scheduler', 'format_duration', 'parse_duration', 'parse_when', 'split_when']
+
+# Consts
+MAX_SLEEP = 60 # Recheck the clock at least this often in case the system time jumps
+MISSED_GRACE = 300 # Still run one-shot jobs missed by up to this many seconds while we were down
+DURATION_RE = re.compile(r'(?:\d+[smhd])+')
+DURATION_PART_RE = re.compile(r'(\d+)([smhd])')
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+CRON_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)] # minute, hour, day, month, weekday
+
+# Load Env
+CONFIG = config.load()
+SCHEDULE_WARNINGS = CONFIG.get('SCHEDULE_WARNINGS',
+                               lambda value: sorted({int(w) for w in value.split(',') if w.strip()},
+                                                    reverse=True),
+                               [600, 300, 60, 10])
+
+
+def parse_duration(text):
+    """
+    Parse a duration like '90s', '30m' or '1h30m'.
+
+    Args:
+        text: The duration
+
+    Returns:
+        The duration in seconds
+
+    Raises:
+        ValueError: If it isn't a valid, non-zero duration
+    """
+
+    if not DURATION_RE.fullmatch(text):
+        raise ValueError(f'Bad duration: {text} (use e.g. 90s, 30m, 1h30m)')
+    seconds = sum(int(n) * DURATION_UNITS[unit] for n, unit in DURATION_PART_RE.findall(text))
+    if not seconds:
+        raise ValueError(f'Duration must be more than 0: {text}')
+    return seconds
+
+
+def format_duration(seconds):
+    """
+    Describe a number of seconds for players, e.g. '5 minutes' or '10 seconds'.
+
+    Args:
+        seconds: The number of seconds
+
+    Returns:
+        The description, in the largest unit that divides it evenly
+    """
+
+    for name, size in (('hour', 3600), ('minute', 60)):
+        if seconds >= size and seconds % size == 0:
+            count = seconds // size
+            return f'{count} {name}{"s" if count != 1 else ""}'
+    return f'{seconds} second{"s" if seconds != 1 else ""}'
+
+
+class Cron:
+    """
+    A standard five field cron schedule (minute hour day month weekday). Fields can be *, numbers,
+    ranges, lists and steps (e.g. '*/15', '1-5', '0,30'). Like cron, a job fires if either the day
+    or the weekday matches when both are restricted. Weekdays are 0-7 with both 0 and 7 for Sunday.
+    """
+
+    def __init__(self, spec):
+        """
+        Initializes a new Cron schedule.
+
+        Args:
+            spec: The five cron fields, space separated
+
+        Returns:
+            A newly initialized Cron object
+
+        Raises:
+            ValueError: If the spec is invalid
+        """
+
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f'Cron schedules need 5 fields, got {len(fields)}: {spec}')
+
+        self.spec = spec
+        minutes, hours, days, months, weekdays = [_cron_field(field, lo, hi)
+                                                  for field, (lo, hi) in zip(fields, CRON_RANGES)]
+        self.minutes = minutes
+        self.hours = hours
+        self.days = days
+        self.months = months
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+        # Catch things like Feb 30 that parse fine but never happen
+        self.next(time.time())
+
+
+    def next(self, after):
+        """
+        Find the next time this schedule fires.
+
+        Args:
+            after: The epoch time to look after
+
+        Returns:
+            The epoch time of the next matching minute after the given time
+
+        Raises:
+            ValueError: If the schedule never fires
+        """
+
+        t = dt.datetime.fromtimestamp(after).replace(second=0, microsecond=0)
+        t += dt.timedelta(minutes=1)
+        limit = t + dt.timedelta(days=366 * 5)
+
+        # Skip ahead a month, day or hour at a time where we can instead of checking every minute
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + dt.timedelta(days=32)).replace(day=1)
+            elif not self.__day_matches(t):
+                t = t.replace(hour=0, minute=0) + dt.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + dt.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += dt.timedelta(minutes=1)
+            else:
+                return t.timestamp()
+
+        raise ValueError(f'Cron schedule never fires: {self.spec}')
+
+
+    def __day_matches(self, t):
+        """
+        Check the day and weekday fields against a date, with cron's either-or rule.
+
+        Args:
+            t: The datetime to check
+
+        Returns:
+            True if the schedule can fire on that date, False otherwise
+        """
+
+        day = t.day in self.days
+        weekday = (t.weekday() + 1) % 7 in self.weekdays # cron counts from Sunday
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+class Every:
+    """
+    A fixed interval schedule
+    """
+
+    def __init__(self, seconds):
+        """
+        Initializes a new Every schedule.
+
+        Args:
+            seconds: The number of seconds between runs
+
+        Returns:
+            A newly initialized Every object
+        """
+
+        self.seconds = seconds
+
+
+    def next(self, after):
+        """
+        Find the next time this schedule fires.
+
+        Args:
+            after: The epoch time to look after
+
+        Returns:
+            The epoch time one interval after the given time
+        """
+
+        return after + self.seconds
+
+
+def parse_when(when, now=None):
+    """
+    Parse a schedule. The forms are:
+        every <duration>         - repeat on an interval, e.g. 'every 6h'
+        daily <HH:MM>            - every day at a local time
+        cron <m> <h> <d> <M> <w> - a standard cron schedule
+        in <duration>            - once, after a delay, e.g. 'in 30m'
+        at <HH:MM>               - once, at the next time the clock hits that local time
+        at <YYYY-MM-DDTHH:MM>    - once, at a local date and time
+
+    Args:
+        when: The schedule
+        now:  (Optional) The epoch time to schedule from. Defaults to now
+
+    Returns:
+        The epoch time of the first run and the repeating schedule (None for one-shot schedules)
+
+    Raises:
+        ValueError: If the schedule is invalid
+    """
+
+    now = time.time() if now is None else now
+    kind, _, arg = when.strip().partition(' ')
+    arg = arg.strip()
+
+    if kind == 'every':
+        schedule = Every(parse_duration(arg))
+        return schedule.next(now), schedule
+    elif kind == 'daily':
+        hour, minute = _parse_clock(arg)
+        schedule = Cron(f'{minute} {hour} * * *')
+        return schedule.next(now), schedule
+    elif kind == 'cron':
+        schedule = Cron(arg)
+        return schedule.next(now), schedule
+    elif kind == 'in':
+        return now + parse_duration(arg), None
+    elif kind == 'at':
+        if 'T' in arg or '-' in arg:
+            try:
+                at = dt.datetime.fromisoformat(arg).timestamp()
+            except ValueError:
+                raise ValueError(f'Bad date and time: {arg} (use e.g. 2024-05-01T04:00)')
+            if at <= now:
+                raise ValueError(f'{arg} is in the past')
+            return at, None
+        hour, minute = _parse_clock(arg)
+        return Cron(f'{minute} {hour} * * *').next(now), None
+
+    raise ValueError(f'Unknown schedule: {when} (use every, daily, cron, in or at)')
+
+
+def split_when(text):
+    """
+    Split a schedule off the front of a command, e.g. 'every 6h save' into 'every 6h' and 'save'.
+
+    Args:
+        text: The schedule followed by the action
+
+    Returns:
+        The schedule and the action
+
+    Raises:
+        ValueError: If there's no action after the schedule
+    """
+
+    tokens = text.split()
+    count = 6 if tokens and tokens[0] == 'cron' else 2
+    if len(tokens) <= count:
+        raise ValueError('Expected a schedule followed by an action')
+    return ' '.join(tokens[:count]), ' '.join(tokens[count:])
+
+
+class Job:
+    """
+    A scheduled action. The action is just a string for the owner of the Scheduler to interpret.
+    """
+
+    def __init__(self, job_id, when, action, at, schedule):
+        """
+        Initializes a new Job.
+
+        Args:
+            job_id:   The id of the job, used to remove it
+            when:     The schedule as the user gave it
+            action:   The action to run
+            at:       The epoch time of the next run
+            schedule: The repeating schedule, or None for a one-shot job
+
+        Returns:
+            A newly initialized Job object
+        """
+
+        self.id = job_id
+        self.when = when
+        self.action = action
+        self.at = at
+        self.schedule = schedule
+        self.run_no = 0 # Bumped whenever the job is rescheduled, so stale heap entries are skipped
+
+
+    def __str__(self):
+        """
+        Describe the job for the schedule list
+        """
+
+        next_run = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.at))
+        return f'#{self.id} [{self.when}] {self.action} (next: {next_run})'
+
+
+class Scheduler:
+    """
+    Runs actions on cron-like, interval and one-shot schedules from a single thread. Upcoming runs
+    and warnings sit in a heap ordered by time, so the thread just sleeps until the earliest one.
+    Jobs are saved to a JSON file whenever they change so they survive a controller restart.
+
+    Before each run the warn callback is called at each of the warning offsets (e.g. 10 minutes, 5
+    minutes, ... before) so players can be told about restarts. Actions and warnings run on the
+    scheduler thread, so a slow one holds up the ones after it.
+    """
+
+    def __init__(self, run, warn=None, path=None, warnings=SCHEDULE_WARNINGS):
+        """
+        Initializes a new Scheduler, loads any saved jobs and starts the scheduler thread.
+
+        Args:
+            run:      Callback taking a Job to run its action
+            warn:     (Optional) Callback taking a Job and the number of seconds until it runs.
+                      Defaults to None (no warnings)
+            path:     (Optional) The file to save jobs to. Defaults to None (don't save)
+            warnings: (Optional) The list of seconds before a run to warn at. Defaults to env var
+
+        Returns:
+            A newly initialized Scheduler object
+        """
+
+        self.run = run
+        self.warn = warn
+        self.path = path
+        self.warnings = warnings
+        self.closed = False
+        self.__jobs = {}
+        self.__heap = []
+        self.__seq = 0
+        self.__next_id = 1
+        self.__cond = threading.Condition()
+
+        self.__load()
+
+        thread = threading.Thread(target=self.__run_thread)
+        thread.daemon = True
+        thread.start()
+
+
+    def add(self, when, action):
+        """
+        Schedule an action.
+
+        Args:
+            when:   The schedule (see parse_when())
+            action: The action to run
+
+        Returns:
+            The new Job
+
+        Raises:
+            ValueError: If the schedule is invalid
+        """
+
+        at, schedule = parse_when(when)
+
+        with self.__cond:
+            job = Job(self.__next_id, ' '.join(when.split()), action, at, schedule)
+            self.__next_id += 1
+            self.__jobs[job.id] = job
+            self.__push(job)
+            self.__save()
+            self.__cond.notify()
+
+        return job
+
+
+    def remove(self, job_id):
+        """
+        Unschedule a job. Its pending runs and warnings are skipped.
+
+        Args:
+            job_id: The id of the job
+
+        Returns:
+            True if the job was removed, False if there's no such job
+        """
+
+        with self.__cond:
+            if self.__jobs.pop(job_id, None) is None:
+                return False
+            self.__save()
+            self.__cond.notify()
+
+        return True
+
+
+    def jobs(self):
+        """
+        Get the scheduled jobs.
+
+        Returns:
+            A list of Jobs in the order they'll next run
+        """
+
+        with self.__cond:
+            return sorted(self.__jobs.values(), key=lambda job: job.at)
+
+
+    def close(self):
+        """
+        Stop the scheduler thread. Saved jobs are kept.
+        """
+
+        with self.__cond:
+            self.closed = True
+            self.__cond.notify()
+
+
+    def __push(self, job):
+        """
+        Queue a job's next run and the warnings before it. Must hold the lock.
+
+        Args:
+            job: The Job to queue
+        """
+
+        job.run_no += 1
+        now = time.time()
+
+        entries = [(job.at, None)]
+        if self.warn is not None:
+            entries += [(job.at - w, w) for w in self.warnings if job.at - w > now]
+
+        for at, warning in entries:
+            self.__seq += 1
+            heapq.heappush(self.__heap, (at, self.__seq, job.id, job.run_no, warning))
+
+
+    def __is_stale(self, entry):
+        """
+        Check if a heap entry is for a job that was removed or rescheduled since. Must hold the
+        lock.
+
+        Args:
+            entry: The heap entry
+
+        Returns:
+            True if the entry should be skipped, False otherwise
+        """
+
+        _, _, job_id, run_no, _ = entry
+        job = self.__jobs.get(job_id)
+        return job is None or job.run_no != run_no
+
+
+    def __run_thread(self):
+        """
+        Scheduler thread. Sleeps until the next run or warning is due, then handles it.
+        """
+
+        while True:
+            with self.__cond:
+                while not self.closed:
+                    while self.__heap and self.__is_stale(self.__heap[0]):
+                        heapq.heappop(self.__heap)
+                    now = time.time()
+                    if self.__heap and self.__heap[0][0] <= now:
+                        break
+                    wait = min(self.__heap[0][0] - now, MAX_SLEEP) if self.__heap else None
+                    self.__cond.wait(wait)
+                if self.closed:
+                    break
+
+                _, _, job_id, _, warning = heapq.heappop(self.__heap)
+                job = self.__jobs[job_id]
+
+                # Queue up the next run (or drop a one-shot job) before running this one
+                if warning is None:
+                    if job.schedule is None:
+                        del self.__jobs[job_id]
+                    else:
+                        job.at = job.schedule.next(time.time())
+                        self.__push(job)
+                    self.__save()
+
+            # Run outside the lock so the schedule can still be changed while an action runs
+            try:
+                if warning is None:
+                    self.run(job)
+                else:
+                    self.warn(job, warning)
+            except Exception as e:
+                print(f'scheduler: Job #{job.id} ({job.action}) failed: {e}')
+
+
+    def __load(self):
+        """
+        Load saved jobs. Jobs keep their next run time, so restarting the controller more often
+        than a job's interval doesn't keep putting it off. A run missed by more than MISSED_GRACE
+        while we were down is dropped: one-shot jobs go, recurring ones move to their next run
+        after now. Recurring jobs saved without a next run time are scheduled from now.
+        """
+
+        if not self.path:
+            return
+
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f'scheduler: Unable to load {self.path}: {e}')
+            return
+
+        now = time.time()
+        self.__next_id = saved.get('next_id', 1)
+        for entry in saved.get('jobs', []):
+            try:
+                schedule = None
+                if entry.get('repeats') or 'at' not in entry:
+                    at, schedule = parse_when(entry['when'], now)
+                if 'at' in entry and entry['at'] >= now - MISSED_GRACE:
+                    at = max(entry['at'], now)
+                elif schedule is None:
+                    print(f'scheduler: Dropping missed job #{entry["id"]} ({entry["action"]})')
+                    continue
+                elif 'at' in entry:
+                    print(f'scheduler: Skipping missed run of job #{entry["id"]} '
+                          f'({entry["action"]})')
+                job = Job(entry['id'], entry['when'], entry['action'], at, schedule)
+            except (KeyError, TypeError, ValueError) as e:
+                print(f'scheduler: Skipping bad saved job {entry}: {e}')
+                continue
+
+            self.__jobs[job.id] = job
+            self.__push(job)
+            self.__next_id = max(self.__next_id, job.id + 1)
+
+        # Forget anything we dropped
+        self.__save()
+
+
+    def __save(self):
+        """
+        Write the jobs out. Jobs are saved with their next run time so a restart doesn't push them
+        back. Must hold the lock.
+        """
+
+        if not self.path:
+            return
+
+        jobs = []
+        for job in self.__jobs.values():
+            jobs.append({'id': job.id,
+                         'when': job.when,
+                         'action': job.action,
+                         'at': job.at,
+                         'repeats': job.schedule is not None})
+
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'next_id': self.__next_id, 'jobs': jobs}, f, indent=2)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f'scheduler: Unable to save {self.path}: {e}')
+
+
+def _cron_field(field, lo, hi):
+    """
+    Parse a single cron field.
+
+    Args:
+        field: The field, e.g. '*', '5', '1-5', '*/15' or '0,30'
+        lo:    The lowest allowed value
+        hi:    The highest allowed value
+
+    Returns:
+        The set of values the field matches
+
+    Raises:
+        ValueError: If the field is invalid
+    """
+
+    values = set()
+    for part in field.split(','):
+        rng, slash, step = part.partition('/')
+        try:
+            step = int(step) if slash else 1
+            if rng == '*':
+                start, end = lo, hi
+            elif '-' in rng:
+                start, end = [int(n) for n in rng.split('-', 1)]
+            else:
+                start = int(rng)
+                end = hi if slash else start
+        except ValueError:
+            raise ValueError(f'Bad cron field: {field}')
+
+        if start < lo or end > hi or start > end or step < 1:
+            raise ValueError(f'Bad cron field: {field} (must be within {lo}-{hi})')
+        values.update(range(start, end + 1, step))
+
+    return values
+
+
+def _parse_clock(text):
+    """
+    Parse a local time of day.
+
+    Args:
+        text: The time, as HH:MM
+
+    Returns:
+        The hour and minute
+
+    Raises:
+        ValueError: If the time is invalid
+    """
+
+    match = re.fullmatch(r'(\d{1,2}):(\d{2})', text)
+    if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        raise ValueError(f'Bad time: {text} (use HH:MM)')
+    return int(match.group(1)), int(match.group(2))
@@ -1,33 +1,83 @@
 import asyncio
 import discord
-import dotenv as de
-import multiprocessing as mp
-import multiprocessing.connection as mpc
-import os
 import threading
+import time
 
-# Plugins
-import minecraft as mc
-import terraria as te
+import config
+import metrics
+import plugins
+import tracing
 
 
 # Load Env
-de.load_dotenv()
-TOKEN = os.getenv('DISCORD_TOKEN')
-GUILD_ID = int(os.getenv('GUILD_ID'))
-BOT_CHAN_ID=int(os.getenv('BOT_CHAN_ID'))
-SECRET = str.encode(os.getenv('SECRET'))
+CONFIG = config.load()
+TOKEN = CONFIG.get('DISCORD_TOKEN')
+GUILD_ID = CONFIG.get('GUILD_ID', int)
+BOT_CHAN_ID = CONFIG.get('BOT_CHAN_ID', int)
+SECRET = CONFIG.secret
+RATE_LIMIT_CAPACITY = CONFIG.get('RATE_LIMIT_CAPACITY', float, 10)
+RATE_LIMIT_REFILL = CONFIG.get('RATE_LIMIT_REFILL', float, 0.2)
+METRICS_PORT = CONFIG.get('METRICS_PORT', int, None)
+CMD_COSTS = {'lifecycle': CONFIG.get('RATE_COST_LIFECYCLE', float, 10),
+             'command': CONFIG.get('RATE_COST_COMMAND', float, 3),
+             'query': CONFIG.get('RATE_COST_QUERY', float, 1)}
+
+# A command that costs more than a full bucket could never run
+if RATE_LIMIT_REFILL <= 0:
+    raise config.ConfigError(f'RATE_LIMIT_REFILL must be more than 0, not {RATE_LIMIT_REFILL}')
+for cls, cost in CMD_COSTS.items():
+    if cost > RATE_LIMIT_CAPACITY:
+        raise config.ConfigError(f'RATE_COST_{cls.upper()} ({cost}) is more than '
+                                 f'RATE_LIMIT_CAPACITY ({RATE_LIMIT_CAPACITY})')
+
+# Consts
+THROTTLE_NOTICE_INTERVAL = 30 # Seconds between slow down notices to the same user
+RATE_BUCKET_SWEEP_INTERVAL = 60 # Seconds between dropping rate limit buckets that have refilled
+READONLY_TTLS = {'status': 5, 'ping': 2, 'players': 10, 'help': 3600, # Seconds to cache replies for
+                 'hosts': 2}
+LIFECYCLE_CMDS = ('start', 'stop') # These change the answers to the read-only commands
+REQUEST_TIMEOUT = 15 # Seconds to wait for a controller to answer a read-only command
+HELP_MSG = ('ServerBot prefixs:\n'
+            '!halp - print this message\n'
+            '!bot - bot commands ("!bot help" for more info)')
+BOT_HELP_MSG = ('ServerBot bot commands:\n'
+                '!bot help - print this message\n'
+                '!bot cache - show read-only command cache hits and misses\n'
+                '!bot controllers - show controller connections and thread counts\n'
+                '!bot plugins - show loaded plugins and their startup times\n'
+                '!bot reload <plugin> - reload a plugin without restarting the bot\n'
+                '!bot trace <last|on|off> - show the last traced command, or turn tracing on or off\n'
+                '!bot latency - show per-stage command latency over recent traced commands')
 
 
 # Globals
-client = discord.Client()
-controller_handlers = {}
+intents = discord.Intents.default()
+intents.members = True # Whitelist syncs need to see everyone with a role
+client = discord.Client(intents=intents)
+controllers = {}         # controller name -> client, one per controller for the life of the bot
+controller_handlers = {} # prefix -> client
+response_cache = {} # (prefix, command) -> (expiry, reply)
+inflight = {}       # (prefix, command) -> asyncio.Future for the reply
+cache_stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0}
+rate_buckets = {}   # (user id, command class) -> (tokens, last refill time)
+rate_notices = {}   # user id -> time of the last slow down notice
+rate_swept = 0      # Time rate_buckets was last swept
+
+# Metrics
+rate_limited = metrics.counter('serverbot_bot_rate_limited_total',
+                               'Commands dropped for going over the rate limit')
+for result in cache_stats:
+    metrics.counter('serverbot_bot_cache_requests_total',
+                    'Read-only commands by how the cache answered them',
+                    lambda result=result: cache_stats[result], result=result)
+metrics.gauge('serverbot_bot_cache_entries', 'Replies in the read-only command cache',
+              lambda: len(response_cache))
+metrics.gauge('serverbot_bot_inflight_requests', 'Read-only commands waiting on a controller',
+              lambda: len(inflight))
 
 # Ready handler
 @client.event
 async def on_ready():
-    global mcc
-
     # Still a bit ugly
     myguild = None
 
@@ -37,13 +87,110 @@ async def on_ready():
         if guild.id == GUILD_ID:
             myguild = guild
 
-    # Initialize our server controllers
-    mcc = mc.Minecraft(client, myguild)
-    tec = te.Terraria(client, myguild)
+    # Set up our server controllers. This runs again every time Discord reconnects, so the ones we
+    # already have just get pointed at the refreshed guild and channels
+    for plugin in plugins.load_enabled():
+        register_controller(plugin, myguild)
+
+
+def register_controller(plugin, guild):
+    """
+    Get the client for a plugin's controller, creating it the first time. Later calls re-bind the
+    existing client instead, so there's only ever one connection (and one reader thread) per
+    controller.
+
+    Args:
+        plugin: The Plugin for the game
+        guild:  The Discord server (guild) the bot should respond on
+
+    Returns:
+        The client for the controller
+    """
+
+    cls = plugin.client_class
+    ctl = controllers.get(cls.name)
+    if ctl is None:
+        start = time.perf_counter()
+        ctl = cls(client, guild)
+        plugin.init_time = time.perf_counter() - start
+        controllers[cls.name] = ctl
+        controller_handlers[ctl.prefix] = ctl
+    else:
+        ctl.bind(client, guild)
+        ctl.start() # Only does anything if the reader thread died
+    return ctl
+
+
+async def reload_plugin(name, channel):
+    """
+    Reload a plugin's code and swap its controller client for one made from the new code. The new
+    client takes over the old one's connection, buffered log output and waiting requests, so the
+    controller never sees a disconnect.
+
+    Args:
+        name:    The module name of the plugin
+        channel: The channel to report back on
+    """
+
+    plugin = plugins.plugins.get(name)
+    if plugin is None:
+        await channel.send(f'ERR: No such plugin: {name}')
+        return
+
+    # If anything fails, go back to the old code so the registry matches the client that's running
+    start = time.perf_counter()
+    old = controllers.get(plugin.client_class.name)
+    try:
+        plugins.reload(name)
+        state = None
+        if old is not None:
+            state = await client.loop.run_in_executor(None, old.detach)
+    except Exception as e:
+        plugins.revert(name)
+        await channel.send(f'ERR: Failed to reload {name}, keeping the old code: {e!r}')
+        return
+
+    # Swap in the new client
+    cls = plugin.client_class
+    if old is not None:
+        controllers.pop(old.name, None)
+        controller_handlers.pop(old.prefix, None)
+        try:
+            new = cls(client, old.guild, state=state)
+        except Exception as e:
+            # Don't drop the connection on the floor. Carry on with the old code
+            plugins.revert(name)
+            await channel.send(f'ERR: New {name} client failed to start, keeping the old code: '
+                               f'{e!r}')
+            new = type(old)(client, old.guild, state=state)
+        controllers[new.name] = new
+        controller_handlers[new.prefix] = new
+        for key in [key for key in response_cache if key[0] in (old.prefix, new.prefix)]:
+            del response_cache[key]
+        if type(new) is not cls:
+            return
+
+    elapsed = (time.perf_counter() - start) * 1000
+    await channel.send(f'Reloaded {name} in {elapsed:.1f}ms (import '
+                       f'{plugin.import_time * 1000:.1f}ms)')
+
 
-    # Add prefixes
-    controller_handlers[mcc.prefix] = mcc
-    controller_handlers[tec.prefix] = tec
+def controller_stats():
+    """
+    Describe the registered controllers and how many threads and connections we're running.
+
+    Returns:
+        A printable summary, one line per controller plus a totals line
+    """
+
+    lines = []
+    for name, ctl in controllers.items():
+        lines.append(f'{name} (!{ctl.prefix}, {", ".join(ctl.labels)}): '
+                     f'{ctl.connections}/{len(ctl.labels)} connected, '
+                     f'readers {"running" if ctl.reader_alive else "dead"}')
+    connections = sum(ctl.connections for ctl in controllers.values())
+    lines.append(f'Threads: {threading.active_count()}, controller connections: {connections}')
+    return '\n'.join(lines)
 
 
 # Message handler
@@ -61,6 +208,14 @@ async def on_message(message):
         await channel.send('I don\'t recognize this server. Why am I even in here?')
         return
 
+    # Chat bridge channels go to the game instead of being commands. Skip bots, including us
+    # posting the game's chat
+    bridge = next((ctl for ctl in controllers.values() if ctl.chatchanid == channel.id), None)
+    if bridge is not None:
+        if not author.bot and message.clean_content:
+            bridge.chat(author.display_name, message.clean_content)
+        return
+
     if channel.id != BOT_CHAN_ID:
         # Wrong channel, ignore
         return
@@ -73,25 +228,222 @@ async def on_message(message):
         command = None
         if len(tokens) > 1:
             command = tokens[1]
-        await process_cmd(prefix, command, channel, roles)
 
+        # Not one of ours. Leave it for whatever other bot it's meant for
+        if prefix not in ('halp', 'bot') and prefix not in controller_handlers:
+            return
+        trace = tracing.start(content)
+
+        # Drop commands from users going too fast. Only tell them once in a while so the rate
+        # limiting doesn't turn into its own spam
+        wait = take_tokens(author.id, cmd_class(prefix, command))
+        if wait:
+            rate_limited.inc()
+            now = time.monotonic()
+            if now - rate_notices.get(author.id, -THROTTLE_NOTICE_INTERVAL) >= \
+                    THROTTLE_NOTICE_INTERVAL:
+                rate_notices[author.id] = now
+                await channel.send(f'{author.mention} slow down! Ignoring your commands for a '
+                                   f'bit (try again in {wait:.0f}s)')
+            return
+
+        await process_cmd(prefix, command, channel, roles, trace)
+
+
+def cmd_class(prefix, command):
+    """
+    Work out which rate limit class a command falls in.
+
+    Args:
+        prefix:  The command prefix
+        command: The rest of the command, or None
+
+    Returns:
+        'lifecycle' for starting/stopping servers, 'query' for read-only commands and 'command'
+        for everything else
+    """
+
+    name = command_name(command)
+    if prefix in ('halp', 'bot') or name in READONLY_TTLS:
+        return 'query'
+    elif name in LIFECYCLE_CMDS:
+        return 'lifecycle'
+    else:
+        return 'command'
 
-async def process_cmd(prefix, command, channel, roles):
+
+def command_name(command):
+    """
+    Get the name of a controller command, skipping the '@<host>' it might be addressed to.
+
+    Args:
+        command: The command, or None
+
+    Returns:
+        The command name, 'help' for an empty command
+    """
+
+    tokens = command.split() if command else []
+    if tokens and tokens[0].startswith('@'):
+        tokens = tokens[1:]
+    return tokens[0] if tokens else 'help'
+
+
+def take_tokens(user_id, cls):
+    """
+    Charge a user for a command out of their token bucket for that class of command. Buckets hold
+    up to RATE_LIMIT_CAPACITY tokens and refill at RATE_LIMIT_REFILL tokens per second. A missing
+    bucket is full, so every so often buckets that would have refilled by now are dropped (along
+    with slow down notices that have run out).
+
+    Args:
+        user_id: The id of the user sending the command
+        cls:     The command class (see cmd_class)
+
+    Returns:
+        0 if the command can go ahead, otherwise the number of seconds until it could
+    """
+
+    global rate_swept
+
+    key = (user_id, cls)
+    cost = CMD_COSTS[cls]
+    now = time.monotonic()
+
+    if now - rate_swept >= RATE_BUCKET_SWEEP_INTERVAL:
+        rate_swept = now
+        for full in [k for k, (tokens, last) in rate_buckets.items()
+                     if tokens + (now - last) * RATE_LIMIT_REFILL >= RATE_LIMIT_CAPACITY]:
+            del rate_buckets[full]
+        for user in [k for k, noticed in rate_notices.items()
+                     if now - noticed >= THROTTLE_NOTICE_INTERVAL]:
+            del rate_notices[user]
+
+    tokens, last = rate_buckets.get(key, (RATE_LIMIT_CAPACITY, now))
+    tokens = min(RATE_LIMIT_CAPACITY, tokens + (now - last) * RATE_LIMIT_REFILL)
+    if tokens < cost:
+        rate_buckets[key] = (tokens, now)
+        return (cost - tokens) / RATE_LIMIT_REFILL
+
+    rate_buckets[key] = (tokens - cost, now)
+    return 0
+
+
+async def process_cmd(prefix, command, channel, roles, trace=None):
+    # Only commands for the controllers are traced, the rest never leave the bot
     if prefix == 'halp':
-        # TODO: add this to the server file and pull from there
-        help_msg = ('ServerBot prefixs:\n'
-                    '!halp - print this message\n'
-                    '!mc - minecraft prefix ("!mc help" for more info)\n'
-                    '!te - terraria prefix ("!te help" for more info)')
-        await channel.send(help_msg)
+        prefixes = ''.join(f'\n!{ctl.prefix} - {ctl.name.lower()} prefix ("!{ctl.prefix} help" for '
+                           'more info)' for ctl in controller_handlers.values())
+        await channel.send(HELP_MSG + prefixes)
+    elif prefix == 'bot':
+        await bot_cmd(command, channel)
     elif prefix in controller_handlers:
-        controller_handlers[prefix].try_send(command)
+        command = command.strip() if command else 'help'
+        metrics.counter('serverbot_bot_commands_total', 'Commands sent to controllers',
+                        prefix=prefix).inc()
+        if command in READONLY_TTLS:
+            await cached_request(prefix, command, channel, trace)
+        else:
+            # Anything else could change what the read-only commands say
+            if command_name(command) in LIFECYCLE_CMDS:
+                for key in [key for key in response_cache if key[0] == prefix]:
+                    del response_cache[key]
+            controller_handlers[prefix].try_send(command, trace)
     else:
         # Ignore unknown commands
         return
 
 
+async def cached_request(prefix, command, channel, trace=None):
+    """
+    Answer a read-only command. Recent replies are served from the cache. If the same command is
+    already waiting on the controller we don't ask again, the reply to the first one answers
+    everybody.
+
+    Args:
+        prefix:  The prefix of the controller to ask
+        command: The read-only command
+        channel: The channel to reply on
+        trace:   (Optional) The Trace for the command. Coalesced commands aren't traced since they
+                 don't get a reply of their own. Defaults to None
+    """
+
+    key = (prefix, command)
+    now = time.monotonic()
+
+    # Fresh enough cached reply
+    cached = response_cache.get(key)
+    if cached and cached[0] > now:
+        cache_stats['hits'] += 1
+        tracing.mark(trace, 'bot')
+        await channel.send(cached[1])
+        tracing.finish(trace, 'discord')
+        return
+
+    # Somebody already asked. Their reply will show up on the channel
+    if key in inflight:
+        cache_stats['coalesced'] += 1
+        return
+
+    cache_stats['misses'] += 1
+    future = asyncio.wrap_future(controller_handlers[prefix].request(command, trace))
+    inflight[key] = future
+    start = time.perf_counter()
+    try:
+        reply = await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        metrics.histogram('serverbot_bot_request_seconds',
+                          'Round trip time of read-only commands to a controller',
+                          prefix=prefix).observe(time.perf_counter() - start)
+        if not reply.startswith('ERR'):
+            response_cache[key] = (time.monotonic() + READONLY_TTLS[command], reply)
+    except (ConnectionError, asyncio.TimeoutError) as e:
+        cache_stats['errors'] += 1
+        trace = None # Where the time went doesn't mean much for a failed request
+        reply = f'ERR: {str(e) or "Timed out waiting for the server manager"}'
+    finally:
+        del inflight[key]
+
+    await channel.send(reply)
+    tracing.finish(trace, 'discord')
+
+
+async def bot_cmd(command, channel):
+    """
+    Handle commands for the bot itself (the !bot prefix).
+
+    Args:
+        command: The command, or None
+        channel: The channel to reply on
+    """
+
+    tokens = command.split() if command else ['help']
+
+    if tokens[0] == 'reload' and len(tokens) == 2:
+        await reload_plugin(tokens[1], channel)
+    elif tokens[0] == 'plugins':
+        await channel.send(plugins.stats())
+    elif tokens[0] == 'controllers':
+        await channel.send(controller_stats())
+    elif tokens[0] == 'trace' and len(tokens) == 2 and tokens[1] in ('on', 'off'):
+        tracing.enabled = tokens[1] == 'on'
+        await channel.send(f'Command tracing is {tokens[1]}')
+    elif tokens[0] == 'trace' and tokens[1:] in ([], ['last']):
+        await channel.send(tracing.format_last())
+    elif tokens[0] == 'latency':
+        await channel.send(tracing.format_latency())
+    elif tokens[0] == 'cache':
+        cache_stats_msg = ', '.join(f'{name}: {count}' for name, count in cache_stats.items())
+        await channel.send(f'Read-only command cache - {cache_stats_msg}, '
+                           f'cached replies: {len(response_cache)}')
+    else:
+        await channel.send(BOT_HELP_MSG)
+
+
 #TODO: Main is below. Fix this shit
 
-# Run the client
+# Load the enabled plugins up front so a broken one shows up before we connect, serve metrics if
+# asked to, then run the client
+plugins.load_enabled()
+if METRICS_PORT:
+    metrics.serve(METRICS_PORT)
 client.run(TOKEN)
@@ -1,33 +1,116 @@
-import asyncio
-import multiprocessing as mp
+import concurrent.futures as cf
+import json
 import multiprocessing.connection as mpc
 import os
+import re
 import subprocess as sp
 import threading
 import time
-import dotenv as de
+
+import chat
+import config
+import fleet
+import metrics
+from controllerclient import ControllerClient, recv_text, send_text, set_nodelay
+from logburst import LOG_BURST_WINDOW
+from logfilter import LogFilter
+from procholder import HeldProcess
+from procwriter import CMD_ACK_TIMEOUT, CommandWriter
+from scheduler import Scheduler, format_duration, split_when
 
 __all__ = ['Terraria']
 
 # Consts
-DISCORD_MSG_LEN_MAX = 1990 # Leave a little room for error
+IPC_LOG_CHUNK_MAX = 65536 # The client splits or attaches this for Discord as needed
+TE_SCHEDULE_ACTIONS = ('start', 'stop', 'restart', 'save', 'backup', 'say') # For !te schedule
+TE_PLAYER_RE = re.compile(r'^(.+) has (joined|left)\.$') # Joins and leaves
+TE_CHAT_RE = re.compile(r'^<(.+?)> (.*)$') # In-game chat
+TE_SERVER_MSG = r'^(?:: )*' # Start of a line the server wrote itself, after any console prompts
+TE_PLAYING_RE = re.compile(TE_SERVER_MSG + r'([^<].*) \([^()]*\)$') # A player from playing
+TE_CHAT_CMD_MAX = 400 # Max characters in one say
+TE_CMD_INTERVALS = {'save': 10, 'say': 0.5} # Min seconds between these commands
+READER_JOIN_TIMEOUT = 30 # Seconds to wait for the last server's reader to finish before a start
 
 # Load Env
-de.load_dotenv()
-SECRET = str.encode(os.getenv('SECRET'))
-BOT_CHAN_ID = int(os.getenv('BOT_CHAN_ID'))
-TE_LOG_CHAN_ID = int(os.getenv('TE_LOG_CHAN_ID'))
-TE_DIR = os.getenv('TE_DIR')
-TEC_PORT = int(os.getenv('TEC_PORT'))
-TE_PREFIX = os.getenv('TE_PREFIX')
-TE_START_TIMEOUT = int(os.getenv('TE_START_TIMEOUT'))
+CONFIG = config.load()
+TE_CONFIG = CONFIG.game('TE')
+SECRET = CONFIG.secret
+BOT_CHAN_ID = CONFIG.bot_chan_id
+TE_LOG_CHAN_ID = TE_CONFIG.log_chan_id
+TE_CHAT_CHAN_ID = TE_CONFIG.chat_chan_id
+TE_DIR = TE_CONFIG.dir
+TEC_PORT = TE_CONFIG.port
+TEC_HOST = TE_CONFIG.listen_host
+TE_CONTROLLERS = TE_CONFIG.controllers
+TE_SERVERS = TE_CONFIG.servers
+TE_MIN_FREE_MB = TE_CONFIG.min_free_mb
+TE_PREFIX = TE_CONFIG.prefix
+TE_START_TIMEOUT = TE_CONFIG.start_timeout
+TE_LOG_FILTER = TE_CONFIG.log_filter
+TE_STATE_DIR = TE_CONFIG.state_dir
+TE_BACKUP_CMD = CONFIG.get('TE_BACKUP_CMD', default=None)
+TE_METRICS_PORT = TE_CONFIG.metrics_port
+
+# Help. The client serves it too, so it doesn't need a round trip to the controller
+TE_HELP_MSG = ('ServerBot Terraria commands:\n'
+               f'!{TE_PREFIX} help - print this message\n'
+               f'!{TE_PREFIX} ping - ping the server\n'
+               f'!{TE_PREFIX} status - check the server status\n'
+               f'!{TE_PREFIX} players - list who is online\n'
+               f'!{TE_PREFIX} start [server] - start the server (on the least loaded host with '
+               'it, if there are several)\n'
+               f'!{TE_PREFIX} hosts - show the controllers and how busy their hosts are\n'
+               f'!{TE_PREFIX} @<host> <command> - send a command to the controller on one host\n'
+               f'!{TE_PREFIX} stop - stop the server\n'
+               f'!{TE_PREFIX} logfilter - show log filter rule hit counts\n'
+               f'!{TE_PREFIX} schedule <list|add|remove> [when action|id] - list or change '
+               'scheduled actions (start, stop, restart, save, backup, say <message>)')
 
 # Globals (for controller)
 proc = None
+writer = None
+reader = None # Reader thread for the current (or last) server
 conn = None
-
-
-class Terraria:
+log_filter = LogFilter()
+request = threading.local() # Tag and trace of the client request being handled on this thread
+command_lock = threading.Lock() # Held while running a client command or a scheduled action
+send_lock = threading.Lock() # Connection.send isn't thread safe and the reader sends too
+scheduler = None
+players = set() # Who's online, going by the joins and leaves seen since the controller started
+server = next(iter(TE_SERVERS)) # Name of the server that's running, or the one to start by default
+heartbeat_now = threading.Event() # Set to send a heartbeat without waiting for the interval
+
+# Metrics (for controller). These are only served by the controller, the bot has its own
+registry = metrics.Registry()
+lines_read = registry.counter('serverbot_game_lines_read_total',
+                              'Lines read from the game server console', game='terraria')
+ipc_messages = registry.counter('serverbot_ipc_messages_sent_total',
+                                'Messages sent to the bot', game='terraria')
+ipc_chars = registry.counter('serverbot_ipc_chars_sent_total',
+                             'Characters of log output and replies sent to the bot',
+                             game='terraria')
+ipc_errors = registry.counter('serverbot_ipc_send_errors_total',
+                              'Sends to the bot that failed', game='terraria')
+client_connections = registry.counter('serverbot_client_connections_total',
+                                      'Times the bot has connected', game='terraria')
+chat_to_game = registry.counter('serverbot_chat_messages_total', 'Chat messages bridged',
+                                game='terraria', direction='to_game')
+chat_to_discord = registry.counter('serverbot_chat_messages_total', 'Chat messages bridged',
+                                   game='terraria', direction='to_discord')
+command_seconds = registry.histogram('serverbot_command_seconds',
+                                     'Time taken to handle a command from the bot',
+                                     game='terraria')
+registry.gauge('serverbot_game_up', 'Whether the game server is running',
+               lambda: 1 if te_running() else 0, game='terraria')
+registry.gauge('serverbot_game_uptime_seconds', 'How long the game server has been running',
+               lambda: proc.uptime() if te_running() else 0, game='terraria')
+registry.gauge('serverbot_game_players', 'Players online, going by joins and leaves in the log',
+               lambda: len(players) if te_running() else 0, game='terraria')
+registry.gauge('serverbot_command_queue_depth', 'Console commands waiting to be written',
+               lambda: writer.queued if writer is not None else 0, game='terraria')
+
+
+class Terraria(ControllerClient):
     """
     Class for importing by the serverbot. It will handle all communication with the Terraria
     Controller (the functionality implemented by the rest of this module.
@@ -35,126 +118,52 @@ class Terraria:
     Just initialize it and register the send function for callback with the prefix
     """
 
+    name = 'Terraria'
+    help_msg = TE_HELP_MSG
+
     def __init__(self,
                  client,
                  guild,
                  prefix=TE_PREFIX,
                  port=TEC_PORT,
                  botchanid=BOT_CHAN_ID,
-                 logchanid=TE_LOG_CHAN_ID
-                 ):
+                 logchanid=TE_LOG_CHAN_ID,
+                 chatchanid=TE_CHAT_CHAN_ID,
+                 state=None,
+                 controllers=TE_CONTROLLERS,
+                 min_free_mb=TE_MIN_FREE_MB):
         """
         Initializes a new Terraria object for communicating with a Terraria Controller.
 
         Args:
-            client:    The Discord client to interact with
-            guild:     The Discord server (guild) the bot should respond on
-            prefix:    (Optional) The Discord server prefix. Defaults to env var
-            port:      (Optional) The port to run the Terraria controller on. Defaults to
-                       environment variable
-            botchanid: (Optional) The id of the Discord server bot channel. Defaults to environment
-                       variable
-            logchanid: (Optional) The id of the Discord server Terraria log channel. Defaults to
-                       environment variable
+            client:      The Discord client to interact with
+            guild:       The Discord server (guild) the bot should respond on
+            prefix:      (Optional) The Discord server prefix. Defaults to env var
+            port:        (Optional) The port to run the Terraria controller on. Defaults to
+                         environment variable
+            botchanid:   (Optional) The id of the Discord server bot channel. Defaults to
+                         environment variable
+            logchanid:   (Optional) The id of the Discord server Terraria log channel. Defaults to
+                         environment variable
+            chatchanid:  (Optional) The id of the Discord channel to bridge to in-game chat.
+                         Defaults to environment variable
+            state:       (Optional) State from detach() on the client this one replaces. Defaults
+                         to None
+            controllers: (Optional) The list of (host, port) of the Terraria controllers. Defaults
+                         to environment variable
+            min_free_mb: (Optional) The free memory in MB a host needs to start a server on it.
+                         Defaults to environment variable
 
         Returns:
             A newly initialized Terraria object
         """
 
-        # Set up members
-        self.prefix = prefix
-        self.port = port
-        self.guild = guild
-        self.client = client
-        self.logchan = guild.get_channel(logchanid)
-        self.botchan = guild.get_channel(botchanid)
-        self.__conn = None
-
-        def read_thread():
-            """
-            Launch the read thread. This will attempt to create a connection to a te server
-            controller and listen for incoming data. This thread will stay alive until the process
-            closes.
-            """
-
-            while True:
-
-                # First connect to the server
-                try:
-                    self.__conn = mpc.Client(('localhost', port), authkey=SECRET)
-                    self.__botchan_send('Terraria server manager connected!')
-
-                # Leaving unassigned or closing skips the next loop
-                except (EOFError, ConnectionRefusedError, ConnectionResetError, BrokenPipeError):
-                    if self.__conn is not None:
-                        self.__conn.close()
-                        time.sleep(10) # Wait a reasonable amount of time and chek again
-
-                # Read loop
-                while self.__conn and (not self.__conn.closed):
-
-                    # Try to read and direct messages appropriately
-                    try:
-                        line = self.__conn.recv()
-                        [status, msg] = line.split('|', 1)
-                        status = status.strip()
-                        if status == 'LOG':
-                            self.__logchan_send(msg)
-                        elif status == 'OK':
-                            self.__botchan_send(msg)
-                        else:
-                            self.__botchan_send(f'{status}: {msg}')
-
-                    # Close the connection so we end the loop and try to reconnect at the top
-                    except (EOFError, ConnectionResetError, BrokenPipeError):
-                        self.__botchan_send('ERR: The Terraria server manager crashed. Attempting '
-                                            'to reconnect')
-                        self.__conn.close()
-
-        # Start a daemon reader thread
-        reader = threading.Thread(target=read_thread)
-        reader.daemon = True
-        reader.start()
-
-
-    def try_send(self, msg):
-        """
-        Try to send a message to the controller. If we fail, print an error to the bot channel. We
-        don't need to handle the failure here since the reader reads in a tight loop so a connection
-        failure will be caught there as well and will trigger a reconnect.
-
-        Args:
-            msg: The message to try to send
-        """
-
-        try:
-            self.__conn.send(msg)
-        except (OSError, AttributeError):
-            # We lost connection. We'll just log it and let the read loop handle reconnecting
-            self.__botchan_send('Could not send command to Terraria server manager')
-
+        super().__init__(client, guild, prefix, port, botchanid, logchanid, chatchanid, state,
+                         controllers, min_free_mb)
 
-    def __logchan_send(self, msg):
-        """
-        Send a message to the log channel.
-
-        Args:
-            msg: The message to send
-        """
-
-        asyncio.run_coroutine_threadsafe(self.logchan.send(msg), self.client.loop)
-
-
-    def __botchan_send(self, msg):
-        """
-        Send a message to the bot channel.
-
-        Args:
-            msg: The message to send
-        """
-
-        asyncio.run_coroutine_threadsafe(self.botchan.send(msg), self.client.loop)
 
+# For the plugin registry
+CLIENT_CLASS = Terraria
 
 
 def te_running():
@@ -175,143 +184,392 @@ def try_send(msg):
     as well and will trigger a reconnect. We also can't send an error message since the client isn't
     connected to receive the message so we'll just fail silently.
 
+    Replies sent while handling a tagged request carry the tag (e.g. 'OK  @12|pong') so the client
+    can match them up with the request. Traced requests (tags ending in '+') also get when we
+    received the request, how long we waited on the game and when we sent the reply.
+
     Args:
         msg: The message to try to send
     """
 
+    tag = getattr(request, 'tag', None)
+    if tag is not None and not msg.startswith('LOG'):
+        trace = getattr(request, 'trace', None)
+        if trace is not None:
+            tag += f'{trace[0]:.6f},{trace[1]:.6f},{time.time():.6f}'
+        [status, body] = msg.split('|', 1)
+        msg = f'{status.rstrip()}@{tag}|{body}'
+
     try:
-        conn.send(msg + '\n')
+        with send_lock:
+            send_text(conn, msg + '\n')
+        ipc_messages.inc()
+        ipc_chars.inc(len(msg) + 1)
     except (OSError, AttributeError):
         # Since we lost connection to the client we can't really notify them there's an issues so
         # just log it and fail
+        ipc_errors.inc()
         print(f'try_send: Failed to send: {msg}')
 
 
-def te_writeline(cmd):
+def te_writeline(cmd, ack=None, collect=None):
     """
-    Try to send a message to the Terraria process. We don't need to hand the failure here since the
-    reader will catch it and mark the server dead.
+    Queue a command for the Terraria process. All writes go through the command writer so they're
+    serialized, batched and rate limited no matter which thread they come from. We don't need to
+    handle write failures here since the reader will catch them and mark the server dead.
 
     Args:
-        cmd: The Terraria command to send
+        cmd:     The Terraria command to send
+        ack:     (Optional) A regex matching the log line that confirms the command. Defaults to
+                 None
+        collect: (Optional) A regex matching the lines of the answer before the ack (see
+                 CommandWriter.submit()). Defaults to None
 
     Returns:
-        True if successful, False otherwise
+        A Future that completes once the command is written (or acked, if ack is set) if the
+        command was queued, None otherwise (e.g. if the server is dead)
     """
 
-    try:
-        proc.stdin.write(str.encode(f'{cmd}\n'))
-        proc.stdin.flush()
-        return True
-    except AttributeError:
+    current = writer
+    if not te_running() or current is None:
         print(f'te_writeline: Server is dead')
-        return False
+        return None
+    return current.submit(cmd, ack, collect)
+
+
+def te_reply_later(future, reply):
+    """
+    Answer the request being handled once a console command is done, without holding up the
+    command loop while the game gets to it. The request's tag and trace go along, so the reply is
+    still matched up and the wait is charged to the game if the request is being traced.
+
+    Args:
+        future: The Future from te_writeline(). The command writer fails it if the server never
+                acknowledges the command
+        reply:  Called with the finished future. Returns the message to send
+    """
+
+    tag = getattr(request, 'tag', None)
+    trace = getattr(request, 'trace', None)
+    start = time.time()
+
+    def done(future):
+        # This runs on whichever thread finished the future, so borrow its request for the send
+        saved = (getattr(request, 'tag', None), getattr(request, 'trace', None))
+        request.tag = tag
+        request.trace = trace
+        if trace is not None:
+            trace[1] += time.time() - start
+        try:
+            try_send(reply(future))
+        finally:
+            request.tag, request.trace = saved
 
+    future.add_done_callback(done)
 
-def te_start():
+
+def te_players_reply(future):
+    """
+    Turn the answer to the players console command into the reply for the client. The server
+    prints a line per player (name and address) and then how many there are.
+
+    Args:
+        future: The finished Future for the command, with the player lines and the count line
+
+    Returns:
+        The message to send
+    """
+
+    try:
+        lines = future.result()
+    except (OSError, TimeoutError, cf.TimeoutError):
+        return 'ERR |Terraria Server did not answer'
+    names = [TE_PLAYING_RE.match(line.rstrip()).group(1) for line in lines[:-1]]
+    count = lines[-1].strip(': ').rstrip()
+    return f'OK  |{count}' + ''.join(f'\n{name}' for name in names)
+
+
+def te_start(name=None):
     """
     Start a new Terraria process and spin up a listener thread to handle incoming data.
 
+    Args:
+        name: (Optional) Which of TE_SERVERS to start. Defaults to the last one started
+
     Returns:
         True if the server was started successfully, False otherwise (e.g. if server is already
         running)
     """
 
-    global proc
+    global proc, writer, server
 
     # Fastfail if the server is running, else start it
     if te_running():
         return False
     else:
-        proc = sp.Popen(['bash', 'TerrariaServer', '-config', 'serverconfig.txt'],
-                        stdin=sp.PIPE,
-                        stdout=sp.PIPE,
-                        stderr=sp.STDOUT,
-                        cwd=TE_DIR)
+        # The last server's reader has to be done with the console log before a launch empties it
+        if reader is not None and reader.is_alive():
+            reader.join(READER_JOIN_TIMEOUT)
+            if reader.is_alive():
+                print(f'te_start: Still sending the last server\'s log, not starting')
+                return False
+
+        # The server is held outside the controller so restarting the controller doesn't kill it
+        server = name or server
+        held = HeldProcess.launch(['bash', 'TerrariaServer', '-config', 'serverconfig.txt'],
+                                  te_server_dir(),
+                                  TE_STATE_DIR)
+        proc = held
+        writer = CommandWriter(held.stdin, intervals=TE_CMD_INTERVALS)
+        cmd_writer = writer
+        players.clear()
 
         # Wait for the server to start up to the specified timeout
-        line = ''
+        stdout = held.output()
+        started = False
         startup_buf = ''
         start_time = time.time()
         timeout = TE_START_TIMEOUT #seconds
 
         # Look for the startup line
-        while line.strip() != ': Server started':
+        while not started:
 
             # Check timeout
-            if time.time() > (start_time + timeout):
+            remaining = start_time + timeout - time.time()
+            if remaining <= 0:
                 try_send(f'LOG |{startup_buf}')
                 return False
 
-            # Fetch a new line. If the read fails, dump the log and fail
-            try:
-                line = bytes.decode(proc.stdout.readline())
-            except BrokenPipeError:
+            # Fetch whatever lines are ready. If the process went away, dump the log and fail
+            lines = stdout.read(remaining)
+            if stdout.eof and not lines:
                 try_send(f'LOG |{startup_buf}')
                 return False
 
-            # Dump the current log if we would go over the max message size
-            if len(startup_buf) > (DISCORD_MSG_LEN_MAX - len(line)):
+            # Add the lines that make it through the filter to the buf
+            cmd_writer.feed(lines)
+            for line in lines:
+                started = started or line.strip() == ': Server started'
+                startup_buf += ''.join(log_filter.filter(line))
+
+            # Dump the current log if we've gone over the max message size
+            if len(startup_buf) > IPC_LOG_CHUNK_MAX:
                 try_send(f'LOG |{startup_buf}')
                 startup_buf = ''
 
-            # Add the current line to the buf
-            startup_buf += line
-
         # Dump the buffer
         if startup_buf:
             try_send(f'LOG |{startup_buf}')
+        held.save_offset(stdout.consumed)
 
-        # TODO: add an Event to use to stop the reader during shutdown so we don't need to see the giant log spam. Also consume all those lines and verify that we stopped cleanly
-
-        # Start a reader for this process
-        def read_thread():
-            """
-            Launch the reader thread. This will attempt to read from the Terraria process and send
-            it to the client (serverbot) to process. If a send fails, it will keep retrying until it
-            succeeds. If a read fails, we continue and the top loop will catch the dead proces and
-            report it to the client (serverbot)
-            """
-
-            line = None
-            while te_running():
-
-                # Grab a new line if we're not holding onto a failed send
-                if not line:
-
-                    # Try reading a line. If this fails, check that the proc didn't die
-                    try:
-                        line = proc.stdout.readline()
-                    except BrokenPipeError:
-                        print('reader: Pipe read failed!')
-                        continue # Top loop will handle dead process, otherwise we retry
-
-                # Check that we have something to send
-                if line:
-
-                    # Wait for a connection to be established
-                    while not conn or conn.closed:
-                        time.sleep(10) # wait for the connection to come back up
-
-                    # Try to send the thing
-                    try:
-                        conn.send(f'LOG |{bytes.decode(line)}')
-                        line = None
-
-                    # If we fail, close the connection (remote probably disconnected) and leave the
-                    # line so we can retry it
-                    except OSError:
-                        print('reader: Client disconnected!')
-                        conn.close()
+        te_start_reader(held, stdout, cmd_writer)
+        return True
 
-            print('reader: Process exited. Exiting reader thread.')
 
-        # Start up the reader thread
-        reader = threading.Thread(target=read_thread)
-        reader.daemon = True
-        reader.start()
+def te_adopt():
+    """
+    Pick up a Terraria server left running by a previous controller (e.g. after the controller was
+    restarted for an update) and resume forwarding its log from where the old controller stopped.
 
-        return True
+    Returns:
+        True if a running server was adopted, False if there wasn't one
+    """
+
+    global proc, writer, server
+
+    held = HeldProcess.adopt(TE_STATE_DIR)
+    if held is None:
+        return False
+
+    # Work out which server it is from the directory it runs in
+    try:
+        cwd = os.path.realpath(f'/proc/{held.pid}/cwd')
+    except OSError:
+        cwd = None
+    server = next((name for name, path in TE_SERVERS.items() if os.path.realpath(path) == cwd),
+                  server)
+
+    proc = held
+    writer = CommandWriter(held.stdin, intervals=TE_CMD_INTERVALS)
+    te_start_reader(held, held.output(), writer)
+    print(f'main: Adopted running server {server} (pid {held.pid})')
+    return True
+
+
+def te_server_dir():
+    """
+    Get the directory of the server that's running, or that will be started by default.
+
+    Returns:
+        The server directory
+    """
+
+    return TE_SERVERS.get(server, TE_DIR)
+
+
+def te_heartbeat():
+    """
+    Send the client our host's load and what we're running every HEARTBEAT_INTERVAL, so the bot
+    can tell we're alive and pick a host to start servers on. Runs on its own thread for the life
+    of the controller, so heartbeats keep going while a command (e.g. a slow start) is running.
+    """
+
+    sampler = fleet.LoadSampler()
+    while True:
+        load = sampler.sample()
+        running = te_running()
+        load.update(servers=list(TE_SERVERS),
+                    running=server if running else None,
+                    players=len(players) if running else 0)
+        if conn is not None and not conn.closed:
+            try_send(f'LOAD|{json.dumps(load)}')
+        heartbeat_now.wait(fleet.HEARTBEAT_INTERVAL)
+        heartbeat_now.clear()
+
+
+def te_start_reader(held, stdout, cmd_writer):
+    """
+    Spin up the listener thread for a running Terraria process.
+
+    Args:
+        held:       The HeldProcess for the server
+        stdout:     The LineReader for its console log
+        cmd_writer: The CommandWriter for its console
+    """
+
+    global reader
+
+    # TODO: add an Event to use to stop the reader during shutdown so we don't need to see the giant log spam. Also consume all those lines and verify that we stopped cleanly
+
+    # Start a reader for this process
+    def read_thread():
+        """
+        Launch the reader thread. This will attempt to read from the Terraria process and send it
+        to the client (serverbot) to process in batches. If a send fails, it will keep retrying
+        until it succeeds. The thread exits once the process is gone and its log is read, so
+        whatever it printed on the way down (e.g. a crash) still gets sent. How far we've sent is
+        saved so a restarted controller doesn't repeat or skip anything
+        """
+
+        batch = ''
+        while batch or not stdout.eof:
+
+            # Grab new lines if we're not holding onto a failed send
+            if not batch:
+
+                # Run them through the filter. They might get dropped or held for deduping
+                lines = []
+                read_lines = stdout.read()
+                cmd_writer.feed(read_lines)
+                if read_lines:
+                    lines_read.inc(len(read_lines))
+                    te_track_players(read_lines)
+                    te_forward_chat(read_lines)
+                for line in read_lines:
+                    lines.extend(log_filter.filter(line))
+                lines.extend(log_filter.expire(LOG_BURST_WINDOW))
+                batch = ''.join(lines)
+
+                # Nothing left to send from this read, so we're caught up to here
+                if not batch:
+                    held.checkpoint(stdout)
+
+            # Check that we have something to send
+            if batch:
+
+                # Wait for a connection to be established
+                while not conn or conn.closed:
+                    time.sleep(10) # wait for the connection to come back up
+
+                # Try to send the thing
+                try:
+                    with send_lock:
+                        send_text(conn, f'LOG |{batch}')
+                    ipc_messages.inc()
+                    ipc_chars.inc(len(batch) + 5)
+                    batch = ''
+                    held.checkpoint(stdout)
+
+                # If we fail, close the connection (remote probably disconnected) and leave the
+                # batch so we can retry it
+                except OSError:
+                    ipc_errors.inc()
+                    print('reader: Client disconnected!')
+                    conn.close()
+
+        # Don't lose the end of a deduped run
+        for line in log_filter.flush():
+            try_send(f'LOG |{line}')
+
+        cmd_writer.close()
+        held.close()
+        print('reader: Process exited. Exiting reader thread.')
+
+    # Start up the reader thread
+    reader = threading.Thread(target=read_thread)
+    reader.daemon = True
+    reader.start()
+
+
+def te_track_players(lines):
+    """
+    Keep track of who's online from the joins and leaves in a batch of console output.
+
+    Args:
+        lines: The list of lines read from the game process
+    """
+
+    for line in lines:
+        # Cheap check first, almost none of the lines are joins or leaves
+        if ' has ' in line:
+            match = TE_PLAYER_RE.search(line.rstrip())
+            if match and match.group(2) == 'joined':
+                players.add(match.group(1))
+            elif match:
+                players.discard(match.group(1))
+
+
+def te_forward_chat(lines):
+    """
+    Send the in-game chat in a batch of console output to the client as one message, for the chat
+    channel. Does nothing if there's no chat channel.
+
+    Args:
+        lines: The list of lines read from the game process
+    """
+
+    if TE_CHAT_CHAN_ID is None:
+        return
+
+    said = []
+    for line in lines:
+        # Cheap check first, almost none of the lines are chat
+        if line.startswith('<'):
+            match = TE_CHAT_RE.match(line.rstrip())
+            if match and match.group(1) != 'Server': # Our own says come back as the server
+                said.append(f'<{match.group(1)}> {match.group(2)}\n')
+    if said:
+        try_send(f'CHAT|{"".join(said)}')
+        chat_to_discord.inc(len(said))
+
+
+def te_chat(args):
+    """
+    Put a batch of messages from the Discord chat channel in game, in as few say commands as
+    possible. The batch comes from the client, already encoded by chat.encode_batch().
+
+    Args:
+        args: The encoded batch
+    """
+
+    messages = chat.decode_batch(args)
+    if not messages or not te_running():
+        return
+
+    lines = [f'<{name}> {text}' for name, text in messages]
+    for chunk in chat.pack(lines, TE_CHAT_CMD_MAX, ' | '):
+        te_writeline(f'say [Discord] {" | ".join(chunk)}')
+    chat_to_game.inc(len(messages))
 
 
 def te_stop():
@@ -322,7 +580,7 @@ def te_stop():
         True if successful, False otherwise (e.g. if server isn't running)
     """
 
-    global proc
+    global proc, writer
 
     if not te_running():
         return False
@@ -331,10 +589,145 @@ def te_stop():
         # wait to stop
         while proc.poll() is None:
             time.sleep(1)
+        writer.close()
         proc = None
+        writer = None
         return True
 
 
+def te_restart():
+    """
+    Stop the Terraria server if it's running and start the same one back up.
+
+    Returns:
+        True if the server came back up, False otherwise
+    """
+
+    te_stop()
+    return te_start()
+
+
+def te_backup():
+    """
+    Run the backup command (TE_BACKUP_CMD) in the server directory. If the server is running it
+    saves first.
+
+    Returns:
+        True if the backup command succeeded, False otherwise
+    """
+
+    if not TE_BACKUP_CMD:
+        print('te_backup: TE_BACKUP_CMD is not set')
+        return False
+
+    if te_running():
+        saved = te_writeline('save', ack=TE_SERVER_MSG + r'Backing up world file')
+        try:
+            if saved is not None:
+                saved.result(CMD_ACK_TIMEOUT)
+        except (OSError, TimeoutError, cf.TimeoutError):
+            print('te_backup: Server did not confirm the save, backing up anyway')
+
+    return sp.run(TE_BACKUP_CMD, shell=True, cwd=te_server_dir()).returncode == 0
+
+
+def te_scheduled(job):
+    """
+    Run a scheduled action and report how it went in the log channel. Called on the scheduler
+    thread.
+
+    Args:
+        job: The scheduler Job to run
+    """
+
+    action, _, message = job.action.partition(' ')
+
+    with command_lock:
+        if action == 'start':
+            result = te_start()
+        elif action == 'stop':
+            result = te_stop()
+        elif action == 'restart':
+            result = te_restart()
+        elif action == 'save':
+            result = te_writeline('save') is not None
+        elif action == 'backup':
+            result = te_backup()
+        elif action == 'say':
+            result = te_writeline(f'say {message}') is not None
+        else:
+            result = False
+
+    try_send(f'LOG |Scheduled {job.action} (#{job.id}) {"done" if result else "failed"}\n')
+
+
+def te_schedule_warning(job, seconds):
+    """
+    Warn players about an upcoming scheduled stop or restart. Called on the scheduler thread.
+
+    Args:
+        job:     The scheduler Job that's coming up
+        seconds: How long until it runs
+    """
+
+    action = job.action.split()[0]
+    if action in ('stop', 'restart') and te_running():
+        te_writeline(f'say Server {action} in {format_duration(seconds)}')
+
+
+def te_schedule(args):
+    """
+    Handle the schedule command: list, add or remove scheduled actions.
+
+    Args:
+        args: The arguments to the schedule command, if any
+    """
+
+    usage = (f'ERR |Usage: !{TE_PREFIX} schedule list | add <when> <action> | remove <id>\n'
+             '<when> is every <duration>, daily <HH:MM>, cron <m h dom mon dow>, in <duration> or '
+             'at <HH:MM|YYYY-MM-DDTHH:MM> (durations like 30m or 1h30m)')
+
+    [sub_cmd, sub_args] = ((args or 'list').split(None, 1) + [''])[:2]
+
+    # Show what's coming up
+    if sub_cmd == 'list':
+        jobs = scheduler.jobs()
+        try_send(f'OK  |' + ('\n'.join(str(job) for job in jobs) or 'Nothing scheduled'))
+
+    # Schedule something new
+    elif sub_cmd == 'add':
+        try:
+            when, action = split_when(sub_args)
+        except ValueError:
+            try_send(usage)
+            return
+
+        action_name, _, message = action.partition(' ')
+        if action_name not in TE_SCHEDULE_ACTIONS or (action_name == 'say') != bool(message):
+            try_send(f'ERR |Unknown action: {action} '
+                     f'(use {", ".join(TE_SCHEDULE_ACTIONS)} <message>)')
+            return
+
+        try:
+            job = scheduler.add(when, action)
+        except ValueError as e:
+            try_send(f'ERR |{e}')
+            return
+        try_send(f'OK  |Scheduled {job}')
+
+    # Unschedule something
+    elif sub_cmd == 'remove' and sub_args.strip().lstrip('#').isdigit():
+        job_id = int(sub_args.strip().lstrip('#'))
+        if scheduler.remove(job_id):
+            try_send(f'OK  |Removed #{job_id}')
+        else:
+            try_send(f'ERR |No scheduled action #{job_id}')
+
+    # We didn't hit any valid cases
+    else:
+        try_send(usage)
+
+
 def te_command(cmd, args):
     """
     Interpret a command given by the client (serverbot) and execute the appropriate action
@@ -350,22 +743,19 @@ def te_command(cmd, args):
 
     print(f'te_command: {cmd} {args}')
 
-    help_msg = ('ServerBot Terraria commands:\n'
-                f'!{TE_PREFIX} help - print this message\n'
-                f'!{TE_PREFIX} ping - ping the server\n'
-                f'!{TE_PREFIX} status - check the server status\n'
-                f'!{TE_PREFIX} start - start the server\n'
-                f'!{TE_PREFIX} stop - stop the server')
-
     # Print help message
     if cmd == 'help':
-        try_send(f'OK  |{help_msg}')
+        try_send(f'OK  |{TE_HELP_MSG}')
 
     # Start the server
     elif cmd == 'start':
-        result = te_start()
+        if args and args not in TE_SERVERS:
+            try_send(f'ERR |Unknown server: {args} (have {", ".join(TE_SERVERS)})')
+            return
+        result = te_start(args)
+        heartbeat_now.set()
         if result:
-            try_send('OK  |Terraria server started')
+            try_send(f'OK  |Terraria server {server} started')
         elif te_running():
             try_send('ERR |Terraria server is already running')
         else:
@@ -374,6 +764,7 @@ def te_command(cmd, args):
     # Stop the server
     elif cmd == 'stop':
         result = te_stop()
+        heartbeat_now.set()
         if result:
             try_send('OK  |Terraria server stopped')
         elif te_running():
@@ -381,38 +772,84 @@ def te_command(cmd, args):
         else:
             try_send('ERR |Terraria Server is not running')
 
+    # Show the log filter hit counters
+    elif cmd == 'logfilter':
+        try_send(f'OK  |```\n{log_filter.stats()}\n```')
+
+    # Show or change the schedule
+    elif cmd == 'schedule':
+        te_schedule(args)
+
+    # Put chat from the Discord chat channel in game. The client sends these, so it's not in help
+    elif cmd == 'chat':
+        te_chat(args)
+
     # Ping
     elif cmd == 'ping':
         try_send(f'OK  |pong')
 
+    # Ask the server who's online. The answer goes out when the server gives it, so other commands
+    # don't wait behind it
+    elif cmd == 'players':
+        future = te_writeline('playing', ack=TE_SERVER_MSG + r'(?:\d+|No) players? connected',
+                              collect=TE_PLAYING_RE)
+        if future is None:
+            try_send('ERR |Terraria Server is not running')
+        else:
+            te_reply_later(future, te_players_reply)
+
     # Print the server status
     elif cmd == 'status':
         if te_running():
-            try_send('OK  |Terraria Server is running')
+            try_send(f'OK  |Terraria Server {server} is running')
         else:
             try_send('OK  |Terraria Server is not running')
 
     # We didn't get a valid command
     else:
         try_send(f'ERR |Unknown command: {cmd}')
-        try_send(f'OK  |{help_msg}')
+        try_send(f'OK  |{TE_HELP_MSG}')
 
 
 # Main
 if __name__ == '__main__':
 
+    # Load the log filter rules
+    log_filter = LogFilter.from_file(TE_LOG_FILTER)
+
+    # Take over the server if it kept running while the controller was down
+    te_adopt()
+
+    # Pick the schedule back up
+    scheduler = Scheduler(te_scheduled,
+                          te_schedule_warning,
+                          os.path.join(TE_STATE_DIR, 'schedule.json'))
+
+    # Serve metrics for scraping
+    if TE_METRICS_PORT:
+        metrics.serve(TE_METRICS_PORT, registry=registry)
+
     # Open IPC channel
-    listener = mpc.Listener(('localhost', TEC_PORT), authkey=SECRET)
+    listener = mpc.Listener((TEC_HOST, TEC_PORT), authkey=SECRET)
+
+    # Tell the bot how busy we are
+    heartbeat = threading.Thread(target=te_heartbeat)
+    heartbeat.daemon = True
+    heartbeat.start()
 
     while True:
 
         # Wait until we connect to a client (serverbot)
         try:
             conn = listener.accept()
+            set_nodelay(conn)
+            client_connections.inc()
+            heartbeat_now.set()
         except (EOFError, ConnectionResetError, BrokenPipeError):
             print('main: Failed to connect to client')
             continue
         print('main: Client connected!')
+        heard = None # When the client last sent a heartbeat, None if it doesn't send them
 
         # If connection succeeded, listen for incoming commands
         while conn and (not conn.closed):
@@ -420,13 +857,42 @@ if __name__ == '__main__':
             # Try the receive a command and execute it. If there's a failure, we assume the
             # conneciton failed and close it (in order to reopen it)
             try:
-                line = conn.recv()
+                # A client that sends heartbeats and goes quiet is gone (e.g. its host died without
+                # closing the connection), so drop it and wait for it to connect again
+                if heard is not None:
+                    remaining = heard + fleet.HEARTBEAT_TIMEOUT - time.monotonic()
+                    if not conn.poll(max(0, remaining)):
+                        print('main: Client stopped sending heartbeats!')
+                        conn.close()
+                        break
+
+                line = recv_text(conn)
+                if line == 'heartbeat':
+                    heard = time.monotonic()
+                    continue
+
+                # Requests the client wants the reply to come back for start with '@<tag> '. A
+                # '+' on the end of the tag means it's being traced, so we time it
+                request.tag = None
+                request.trace = None
+                if line.startswith('@'):
+                    [tag, line] = (line[1:].split(None, 1) + [''])[:2]
+                    request.tag = tag
+                    if tag.endswith('+'):
+                        request.trace = [time.time(), 0.0] # [received, seconds waiting on the game]
+
                 tokens = line.split(None, 1)
+                if not tokens:
+                    try_send('ERR |Empty command')
+                    continue
                 cmd = tokens[0]
                 args = None
                 if len(tokens) > 1:
                     args = tokens[1].rstrip()
-                te_command(cmd, args)
+                with command_lock:
+                    start = time.perf_counter()
+                    te_command(cmd, args)
+                    command_seconds.observe(time.perf_counter() - start)
             except (EOFError, ConnectionResetError, BrokenPipeError):
                 print(f'main: Client disconnected!')
                 conn.close()
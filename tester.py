@@ -1,30 +1,450 @@
-import multiprocessing as mp
+import argparse
+import json
 import multiprocessing.connection as mpc
-import threading
 import os
+import random
+import subprocess as sp
 import sys
+import threading
+import time
+
+import config
+from controllerclient import recv_text, send_text
+from tracing import percentiles
 
-from dotenv import load_dotenv
+# Consts
+DEFAULT_MIX = 'status=4,ping=4,players=2,whitelist list=1'
+HISTOGRAM_BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10] # Seconds
+RESULTS_VERSION = 1 # Bump if the JSON layout changes
 
 # Load Env
-load_dotenv()
-SECRET = str.encode(os.getenv('SECRET'))
-
-# Connect
-address = ('localhost', int(sys.argv[1]))
-conn = mpc.Client(address, authkey=SECRET)
-
-def read_thread():
-    while not conn.closed:
-        line = conn.recv()
-        print(line, end='')
-
-reader = threading.Thread(target=read_thread)
-reader.daemon = True
-reader.start()
-
-cmd = 'x'
-while cmd:
-    cmd = input()
-    conn.send(cmd)
-conn.close()
+SECRET = config.load().secret
+
+
+class LoadClient:
+    """
+    One connection to a controller that many threads can send tagged commands over at once. Replies
+    come back tagged the same way serverbot's requests do, so each one is matched to its command.
+    Everything untagged (log output, broadcasts) is just counted.
+    """
+
+    def __init__(self, port):
+        """
+        Initializes a new LoadClient, connects to the controller and starts the reader thread.
+
+        Args:
+            port: The port the controller runs on
+
+        Returns:
+            A newly initialized LoadClient object
+        """
+
+        self.conn = mpc.Client(('localhost', port), authkey=SECRET)
+        self.untagged = 0
+        self.__pending = {}
+        self.__next_tag = 0
+        self.__lock = threading.Lock()
+        self.__send_lock = threading.Lock()
+
+        reader = threading.Thread(target=self.__read_thread)
+        reader.daemon = True
+        reader.start()
+
+
+    def request(self, cmd, timeout):
+        """
+        Send a command and wait for its reply.
+
+        Args:
+            cmd:     The command to send
+            timeout: Max seconds to wait for the reply
+
+        Returns:
+            The status ('OK', 'ERR', 'TIMEOUT' or 'DISCONNECTED') and the reply text
+        """
+
+        done = threading.Event()
+        with self.__lock:
+            self.__next_tag += 1
+            tag = str(self.__next_tag)
+            self.__pending[tag] = [done, None, None]
+
+        try:
+            with self.__send_lock:
+                send_text(self.conn, f'@{tag} {cmd}')
+        except OSError as e:
+            with self.__lock:
+                self.__pending.pop(tag, None)
+            return 'DISCONNECTED', str(e)
+
+        if not done.wait(timeout):
+            with self.__lock:
+                self.__pending.pop(tag, None)
+            return 'TIMEOUT', ''
+
+        with self.__lock:
+            _, status, msg = self.__pending.pop(tag)
+        return status, msg
+
+
+    def close(self):
+        """
+        Close the connection.
+        """
+
+        self.conn.close()
+
+
+    def __read_thread(self):
+        """
+        Reader thread. Hands each tagged reply to whoever is waiting for it.
+        """
+
+        while True:
+            try:
+                line = recv_text(self.conn)
+            except (EOFError, OSError, TypeError): # TypeError if closed under us
+                break
+
+            [status, msg] = line.split('|', 1)
+            if '@' not in status:
+                self.untagged += 1
+                continue
+
+            [status, tag] = [part.strip() for part in status.split('@', 1)]
+            with self.__lock:
+                waiter = self.__pending.get(tag)
+
+            # Some commands answer more than once (e.g. an error followed by help). First one wins
+            if waiter is not None and waiter[1] is None:
+                waiter[1] = status
+                waiter[2] = msg
+                waiter[0].set()
+
+        # Wake everyone still waiting
+        with self.__lock:
+            for waiter in self.__pending.values():
+                if waiter[1] is None:
+                    waiter[1] = 'DISCONNECTED'
+                    waiter[2] = ''
+                    waiter[0].set()
+
+
+class Stats:
+    """
+    Latencies and outcomes for one command, with a fixed bucket histogram so runs are comparable
+    """
+
+    def __init__(self):
+        """
+        Initializes a new, empty Stats.
+
+        Returns:
+            A newly initialized Stats object
+        """
+
+        self.latencies = []
+        self.statuses = {}
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+
+    def add(self, status, latency):
+        """
+        Record the outcome of one command.
+
+        Args:
+            status:  The reply status ('OK', 'ERR', 'TIMEOUT' or 'DISCONNECTED')
+            latency: Seconds from sending the command to getting the reply
+        """
+
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status in ('OK', 'ERR'):
+            self.latencies.append(latency)
+            bucket = 0
+            while bucket < len(HISTOGRAM_BOUNDS) and latency > HISTOGRAM_BOUNDS[bucket]:
+                bucket += 1
+            self.histogram[bucket] += 1
+
+
+    def summary(self):
+        """
+        Summarize the recorded outcomes.
+
+        Returns:
+            A JSON friendly dict of counts, error rate, latency percentiles and histogram
+        """
+
+        count = sum(self.statuses.values())
+        return {'count': count,
+                'statuses': self.statuses,
+                'error_rate': (count - self.statuses.get('OK', 0)) / count if count else 0,
+                'latency': percentiles(self.latencies),
+                'histogram': {'bounds': HISTOGRAM_BOUNDS, 'counts': self.histogram}}
+
+
+def parse_mix(text):
+    """
+    Parse a command mix like 'status=4,ping=4,whitelist list=1' (weight defaults to 1).
+
+    Args:
+        text: The mix
+
+    Returns:
+        A list of (command, weight) pairs
+
+    Raises:
+        ValueError: If a weight isn't a positive number
+    """
+
+    mix = []
+    for entry in text.split(','):
+        cmd, _, weight = entry.partition('=')
+        if not cmd.strip():
+            continue
+        weight = float(weight) if weight.strip() else 1
+        if weight <= 0:
+            raise ValueError(f'Weight must be positive: {entry}')
+        mix.append((cmd.strip(), weight))
+    if not mix:
+        raise ValueError('Empty command mix')
+    return mix
+
+
+def load_script(path):
+    """
+    Load a command script: one command per line, '# comments', and 'sleep <seconds>' to pause.
+    Each worker plays the script from the top, over and over.
+
+    Args:
+        path: The path to the script
+
+    Returns:
+        The list of script lines
+    """
+
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def run_load(client, args):
+    """
+    Hammer a controller with commands from a number of worker threads sharing one connection.
+
+    Args:
+        client: The LoadClient to send over
+        args:   The parsed command line arguments
+
+    Returns:
+        The dict of command to Stats, and the number of seconds the run took
+    """
+
+    script = load_script(args.script) if args.script else None
+    mix = None if script else parse_mix(args.mix)
+    stats = {}
+    stats_lock = threading.Lock()
+    sent = [0]
+    next_send = [time.monotonic()] # Shared schedule when rate limited
+    deadline = time.monotonic() + args.duration if args.duration else None
+
+    def take_turn():
+        """
+        Claim the next command slot, waiting for it if rate limited.
+
+        Returns:
+            True if the worker should send, False if the run is over
+        """
+
+        with stats_lock:
+            if args.count and sent[0] >= args.count:
+                return False
+            sent[0] += 1
+            if args.rate:
+                at = next_send[0]
+                next_send[0] = max(at, time.monotonic()) + 1 / args.rate
+            else:
+                at = 0
+        if deadline is not None and max(at, time.monotonic()) >= deadline:
+            return False
+        if at:
+            time.sleep(max(0, at - time.monotonic()))
+        return True
+
+    def worker(seed):
+        """
+        Send commands from the script or mix until the run is over.
+
+        Args:
+            seed: The random seed for picking from the mix
+        """
+
+        rand = random.Random(seed)
+        step = 0
+        while True:
+            if script:
+                cmd = script[step % len(script)]
+                step += 1
+                if cmd.startswith('sleep '):
+                    time.sleep(float(cmd.split()[1]))
+                    continue
+            else:
+                cmd = rand.choices([cmd for cmd, _ in mix], [weight for _, weight in mix])[0]
+
+            if not take_turn():
+                break
+
+            start = time.perf_counter()
+            status, _ = client.request(cmd, args.timeout)
+            latency = time.perf_counter() - start
+            with stats_lock:
+                stats.setdefault(cmd, Stats()).add(status, latency)
+            if status == 'DISCONNECTED':
+                break
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(args.seed + i,))
+               for i in range(args.concurrency)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return stats, time.perf_counter() - start
+
+
+def version():
+    """
+    Work out which version of serverbot we're testing, for comparing results across releases.
+
+    Returns:
+        The git description of the checkout, or None if it isn't one
+    """
+
+    try:
+        return sp.run(['git', 'describe', '--always', '--dirty'],
+                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                      capture_output=True,
+                      text=True,
+                      check=True).stdout.strip()
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def report(results):
+    """
+    Print a results table.
+
+    Args:
+        results: The results dict
+    """
+
+    total = results['total']
+    print(f'{total["count"]:,} commands in {results["elapsed"]:.1f}s '
+          f'({results["throughput"]:,.1f}/sec), {total["error_rate"] * 100:.2f}% errors, '
+          f'{results["untagged"]:,} untagged messages')
+    print(f'  {"command":<20} {"count":>8} {"err%":>6} {"p50":>9} {"p90":>9} {"p99":>9} {"max":>9}')
+    for cmd, summary in sorted(results['commands'].items()) + [('(total)', total)]:
+        latency = summary['latency']
+        times = ' '.join(f'{latency[p] * 1000:>7.1f}ms' if p in latency else f'{"-":>9}'
+                         for p in ('p50', 'p90', 'p99', 'max'))
+        print(f'  {cmd:<20} {summary["count"]:>8,} {summary["error_rate"] * 100:>5.1f}% {times}')
+
+    # Histogram of everything
+    counts = total['histogram']['counts']
+    width = max(counts) or 1
+    print('  latency histogram:')
+    for i, count in enumerate(counts):
+        bound = (f'<= {HISTOGRAM_BOUNDS[i] * 1000:g}ms' if i < len(HISTOGRAM_BOUNDS)
+                 else f'>  {HISTOGRAM_BOUNDS[-1] * 1000:g}ms')
+        print(f'  {bound:>12} {count:>8,} {"#" * round(40 * count / width)}')
+
+
+def interactive(port):
+    """
+    The old tester: send whatever is typed and print everything that comes back.
+
+    Args:
+        port: The port the controller runs on
+    """
+
+    conn = mpc.Client(('localhost', port), authkey=SECRET)
+
+    def read_thread():
+        while not conn.closed:
+            line = recv_text(conn)
+            print(line, end='')
+
+    reader = threading.Thread(target=read_thread)
+    reader.daemon = True
+    reader.start()
+
+    cmd = 'x'
+    while cmd:
+        cmd = input()
+        send_text(conn, cmd)
+    conn.close()
+
+
+# Main
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Talk to a controller, or load test it. With no '
+                                                 'load options, sends whatever you type')
+    parser.add_argument('port', type=int, help='controller port')
+    parser.add_argument('-m', '--mix', help=f'weighted command mix (default: "{DEFAULT_MIX}")')
+    parser.add_argument('-s', '--script', help='file of commands to replay instead of a mix')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='commands in flight at once (default: 8)')
+    parser.add_argument('-d', '--duration', type=float, help='seconds to run for')
+    parser.add_argument('-n', '--count', type=int, help='total commands to send')
+    parser.add_argument('-r', '--rate', type=float, help='max commands/sec (default: no limit)')
+    parser.add_argument('-t', '--timeout', type=float, default=10,
+                        help='seconds to wait for a reply (default: 10)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the mix')
+    parser.add_argument('--json', metavar='PATH', help='write results as JSON ("-" for stdout)')
+    args = parser.parse_args()
+
+    if not (args.mix or args.script or args.duration or args.count):
+        interactive(args.port)
+        sys.exit(0)
+
+    args.mix = args.mix or DEFAULT_MIX
+    if not (args.duration or args.count):
+        args.duration = 10
+
+    client = LoadClient(args.port)
+    stats, elapsed = run_load(client, args)
+    client.close()
+
+    total = Stats()
+    for cmd_stats in stats.values():
+        for status, count in cmd_stats.statuses.items():
+            total.statuses[status] = total.statuses.get(status, 0) + count
+        total.latencies += cmd_stats.latencies
+        total.histogram = [a + b for a, b in zip(total.histogram, cmd_stats.histogram)]
+
+    results = {'results_version': RESULTS_VERSION,
+               'serverbot_version': version(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'config': {'port': args.port,
+                          'mix': None if args.script else args.mix,
+                          'script': args.script,
+                          'concurrency': args.concurrency,
+                          'duration': args.duration,
+                          'count': args.count,
+                          'rate': args.rate,
+                          'timeout': args.timeout,
+                          'seed': args.seed},
+               'elapsed': elapsed,
+               'throughput': total.summary()['count'] / elapsed if elapsed else 0,
+               'untagged': client.untagged,
+               'total': total.summary(),
+               'commands': {cmd: cmd_stats.summary() for cmd, cmd_stats in stats.items()}}
+
+    if args.json == '-':
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,221 @@
+import collections
+import time
+
+import config
+
+__all__ = ['Trace', 'start', 'mark', 'reply', 'finish', 'percentiles', 'format_last',
+           'format_latency']
+
+# Consts
+STAGES = ('bot', 'ipc', 'controller', 'game', 'ipc_back', 'discord', 'total') # In command order
+WINDOW = 1000 # Traces the latency percentiles are worked out over
+PERCENTILES = (50, 90, 99)
+
+# Load Env
+TRACE = bool(config.load().get('TRACE', int, 0))
+
+# Globals
+enabled = TRACE # Flipped at runtime with !bot trace on|off
+last = None     # The most recently finished Trace
+samples = {stage: collections.deque(maxlen=WINDOW) for stage in STAGES} # stage -> seconds
+
+
+class Trace:
+    """
+    Timestamps for one command on its way from Discord to a controller and back. Stages are
+    measured back to back: each mark() charges the time since the previous one to a stage.
+
+    The stages are:
+        bot:        on_message until the command is handed to the controller connection
+        ipc:        the hop to the controller process
+        controller: the controller working out the reply, minus waiting on the game
+        game:       waiting for the game server to answer a console command
+        ipc_back:   the hop back to the bot's reader thread
+        discord:    posting the reply, including waiting for the event loop
+
+    Timestamps are wall clock time so they can be compared across processes on the same host.
+    """
+
+    def __init__(self, name):
+        """
+        Initializes a new Trace starting now.
+
+        Args:
+            name: What's being traced (e.g. the command as typed)
+
+        Returns:
+            A newly initialized Trace object
+        """
+
+        self.name = name
+        self.start = time.time()
+        self.last = self.start
+        self.stages = {}
+
+
+    def mark(self, stage, now=None):
+        """
+        Charge the time since the last mark to a stage.
+
+        Args:
+            stage: The stage that just finished
+            now:   (Optional) When it finished. Defaults to now
+        """
+
+        now = time.time() if now is None else now
+        self.add(stage, now - self.last)
+        self.last = now
+
+
+    def add(self, stage, seconds):
+        """
+        Charge time to a stage without moving the last mark.
+
+        Args:
+            stage:   The stage to charge
+            seconds: How long it took
+        """
+
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+
+    def reply(self, stamps, now=None):
+        """
+        Fill in the controller's side from the timestamps it put on its reply.
+
+        Args:
+            stamps: '<received>,<seconds waiting on the game>,<sent>' from the reply tag
+            now:    (Optional) When the reply came in. Defaults to now
+        """
+
+        [received, game, sent] = [float(stamp) for stamp in stamps.split(',')]
+        self.mark('ipc', received)
+        self.add('game', game)
+        self.add('controller', sent - received - game)
+        self.last = sent
+        self.mark('ipc_back', now)
+
+
+def start(name):
+    """
+    Start tracing a command if tracing is on.
+
+    Args:
+        name: What's being traced
+
+    Returns:
+        A new Trace, or None if tracing is off
+    """
+
+    return Trace(name) if enabled else None
+
+
+def mark(trace, stage):
+    """
+    Trace.mark() that does nothing for untraced commands.
+
+    Args:
+        trace: The Trace, or None
+        stage: The stage that just finished
+    """
+
+    if trace is not None:
+        trace.mark(stage)
+
+
+def reply(trace, stamps):
+    """
+    Trace.reply() that does nothing for untraced commands or replies without timestamps.
+
+    Args:
+        trace:  The Trace, or None
+        stamps: The timestamps from the reply tag, or an empty string
+    """
+
+    if trace is not None and stamps:
+        try:
+            trace.reply(stamps)
+        except ValueError:
+            pass # Garbled stamps aren't worth losing the reply over
+
+
+def finish(trace, stage=None):
+    """
+    Finish a trace and add it to the rolling latency window.
+
+    Args:
+        trace: The Trace, or None
+        stage: (Optional) The last stage, to mark first. Defaults to None
+    """
+
+    global last
+
+    if trace is None:
+        return
+
+    if stage is not None:
+        trace.mark(stage)
+    trace.stages['total'] = trace.last - trace.start
+    for name, seconds in trace.stages.items():
+        samples[name].append(seconds)
+    last = trace
+
+
+def percentiles(values, points=PERCENTILES):
+    """
+    Summarize a list of measurements.
+
+    Args:
+        values: The measurements
+        points: (Optional) The percentiles to report. Defaults to PERCENTILES (p50, p90 and p99)
+
+    Returns:
+        A dict of 'p<n>' to value, plus 'max' and 'count'. Empty if there are no values
+    """
+
+    if not values:
+        return {}
+    values = sorted(values)
+    summary = {f'p{p}': values[min(len(values) - 1, len(values) * p // 100)] for p in points}
+    summary['max'] = values[-1]
+    summary['count'] = len(values)
+    return summary
+
+
+def format_last():
+    """
+    Describe the most recently finished trace.
+
+    Returns:
+        A printable breakdown of where the time went
+    """
+
+    if last is None:
+        return 'No traced commands yet' + ('' if enabled else ' (tracing is off)')
+
+    stages = ', '.join(f'{stage} {last.stages[stage] * 1000:.1f}ms' for stage in STAGES[:-1]
+                       if stage in last.stages)
+    return f'{last.name}: {last.stages["total"] * 1000:.1f}ms total ({stages})'
+
+
+def format_latency():
+    """
+    Describe the latency of each stage over the rolling window.
+
+    Returns:
+        A printable table of percentiles per stage
+    """
+
+    if not samples['total']:
+        return 'No traced commands yet' + ('' if enabled else ' (tracing is off)')
+
+    header = ''.join(f'{f"p{point}":>9}' for point in PERCENTILES)
+    lines = [f'Latency over the last {len(samples["total"])} traced commands (ms)',
+             f'{"stage":<11}{header}{"max":>9}']
+    for stage in STAGES:
+        summary = percentiles(samples[stage])
+        if not summary:
+            continue
+        cols = ''.join(f'{summary[f"p{point}"] * 1000:9.1f}' for point in PERCENTILES)
+        lines.append(f'{stage:<11}{cols}{summary["max"] * 1000:9.1f}')
+    return '```\n' + '\n'.join(lines) + '\n```'
@@ -1 +1 @@
-cp /opt/serverbot/*.py .
+cp /opt/serverbot/*.py /opt/serverbot/*.rules .